@@ -1,5 +1,6 @@
 import numpy as np
 import os
+from collections import OrderedDict
 
 np.seterr(over='raise')
 
@@ -22,34 +23,466 @@ except ImportError:
 except:
 	raise
 
+# Lowest valid values of the climatic rasters. Lower values are taken as nodata
+# and replaced by the average of the nearest valid pixels.
+e_min_value = -10.0
+altitude_min_value = -100
+precipitation_min_value = -10
+if raster_api == "gdal":
+	precipitation_min_value = 0
 
-def fornofor(longitude, latitude, raster):
+
+###################################
+# Raster pool
+###################################
+
+# Maximum number of raster files kept open at the same time by `open_raster`.
+# Rasters loaded in memory through `load_raster` are never evicted.
+raster_pool_size = 8
+
+_raster_pool = OrderedDict()
+
+
+class RasterHandle(object):
 	"""
-	raster = Forest/no-forest raster file path.
+	Open raster file, along with its geotransform and first band. Instances are
+	managed by the raster pool and should be retrieved through `open_raster`.
+	If the band was loaded in memory (`load_raster`) all reads are served from
+	the array attribute.
+
+	Arguments:
+
+	- raster_file (str): Raster file path.
+
+	- array (np.ndarray): Band values, if already available (e.g., memory-mapped
+	from a sidecar file). The raster file is not opened.
+
+	- transform (tuple): Geotransform of `array`, GDAL coefficient order.
+
+	"""
+	def __init__(self, raster_file, array = None, transform = None):
+
+		self.path = raster_file
+		self.dataset = None
+		self.band = None
+		self.array = None # Band values, only if loaded in memory
+		self.transform = None # Geotransform, GDAL coefficient order
+		self.xsize = None
+		self.ysize = None
+		self.block_size = None # Columns and rows of a native raster block
+		self.fill = {} # Nodata fill indices, by lowest valid value
+
+		if array is not None:
+			self.array = array
+			self.transform = tuple(transform)
+			self.ysize, self.xsize = array.shape
+			self.block_size = (self.xsize, self.ysize)
+
+		elif raster_api == "gdal":
+			self.dataset = gdal.Open(raster_file)
+			self.band = self.dataset.GetRasterBand(1)
+			self.transform = self.dataset.GetGeoTransform()
+			self.xsize = self.dataset.RasterXSize
+			self.ysize = self.dataset.RasterYSize
+			self.block_size = tuple(self.band.GetBlockSize())
+
+		elif raster_api == "rasterio":
+			self.dataset = rasterio.open(raster_file)
+			self.transform = self.dataset.transform.to_gdal()
+			self.xsize = self.dataset.width
+			self.ysize = self.dataset.height
+			self.block_size = self.dataset.block_shapes[0][::-1]
+
+		else:
+			raise ValueError("Raster {0} could not be read: no SIG library found.".format(raster_file))
+
+
+	def pixel(self, longitude, latitude):
+		"""
+		Column and row of the pixel containing a location.
+		"""
+		px, py = self.pixels(longitude, latitude)
+
+		return int(px), int(py)
+
+
+	def pixels(self, longitudes, latitudes):
+		"""
+		Vectorized version of `pixel`. Returns two integer arrays (columns, rows).
+		"""
+		cols = (np.asarray(longitudes, dtype = float) - self.transform[0]) / self.transform[1]
+		rows = (np.asarray(latitudes, dtype = float) - self.transform[3]) / self.transform[5]
+
+		# gdal lookups truncate pixel coordinates, rasterio floors them
+		if raster_api != "gdal":
+			cols = np.floor(cols)
+			rows = np.floor(rows)
+
+		return cols.astype(int), rows.astype(int)
+
+
+	def sample(self, px, py):
+		"""
+		Values of the first band at pixels (px, py), given as arrays. Every raster
+		block containing any of the pixels is read only once. Pixels out of the
+		raster are returned as NaN.
+		"""
+		px = np.asarray(px, dtype = int)
+		py = np.asarray(py, dtype = int)
+		out = np.full(px.shape, np.nan)
+
+		inside = np.nonzero((px >= 0) & (py >= 0) & (px < self.xsize) & (py < self.ysize))[0]
+
+		if self.array is not None:
+			out[inside] = self.array[py[inside], px[inside]]
+			return out
+
+		bx, by = self.block_size
+		blocks = (py[inside] // by) * (self.xsize // bx + 1) + px[inside] // bx
+		order = np.argsort(blocks, kind = 'mergesort')
+		bounds = np.nonzero(np.diff(blocks[order]))[0] + 1
+
+		for group in np.split(inside[order], bounds):
+			if group.shape[0] == 0:
+				continue
+			x0 = px[group[0]] // bx * bx
+			y0 = py[group[0]] // by * by
+			block = self.read(x0, y0, min(bx, self.xsize - x0), min(by, self.ysize - y0))
+			out[group] = block[py[group] - y0, px[group] - x0]
+
+		return out
+
+
+	def read(self, px, py, xsize = 1, ysize = 1):
+		"""
+		Reads a window of the first band. Returns a 2-dimensional array.
+		"""
+		out = None
+
+		if self.array is not None:
+			out = self.array[max(py, 0):max(py + ysize, 0), max(px, 0):max(px + xsize, 0)]
+
+		elif raster_api == "gdal":
+			out = self.band.ReadAsArray(px, py, xsize, ysize)
+
+		elif raster_api == "rasterio":
+			out = self.dataset.read(1, window=((py, py + ysize), (px, px + xsize)))
+
+		return out
+
+
+	def load(self):
+		"""
+		Reads the whole first band in memory and releases the raster file.
+		"""
+		if self.array is None:
+			self.array = self.read(0, 0, self.xsize, self.ysize)
+			self.block_size = (self.xsize, self.ysize)
+			self.close_dataset()
+
+		return None
+
+
+	def close_dataset(self):
+		if raster_api == "rasterio" and self.dataset is not None:
+			self.dataset.close()
+		self.band = None
+		self.dataset = None
+
+		return None
+
+
+	def close(self):
+		self.close_dataset()
+		self.array = None
+		self.fill = {}
+
+		return None
+
+
+def open_raster(raster_file):
+	"""
+	Retrieves the handle of a raster file from the raster pool, opening the file
+	only if it is not already open. At most `raster_pool_size` files are kept
+	open; the least recently used is closed when the limit is exceeded. Returns a
+	RasterHandle.
+
+	Arguments:
+
+	- raster_file (str): Raster file path.
+
+	"""
+	key = os.path.abspath(raster_file)
+	handle = _raster_pool.pop(key, None)
+
+	if handle is None:
+		handle = RasterHandle(raster_file)
+
+	_raster_pool[key] = handle
+
+	while len(_raster_pool) > raster_pool_size:
+		lru = [k for k in _raster_pool if _raster_pool[k].array is None and k != key]
+		if not lru:
+			break
+		_raster_pool.pop(lru[0]).close()
+
+	return handle
+
+
+def _fresh_sidecar(sidecar_file, raster_file):
+	"""
+	True if a sidecar cache exists and is not older than its raster file.
+	"""
+	return os.path.exists(sidecar_file) and (not os.path.exists(raster_file) or
+		os.path.getmtime(sidecar_file) >= os.path.getmtime(raster_file))
+
+
+def load_raster(raster_file, sidecar = False):
+	"""
+	Keeps the first band of a raster resident in memory, so that all lookups
+	on it (`getE`, `altitude`, `precipitation`, `fornofor` and their batch
+	versions) become array indexing. Returns the memory footprint of the band
+	(bytes).
+
+	Arguments:
+
+	- raster_file (str): Raster file path.
+
+	- sidecar (bool): If True, the band and its geotransform are cached next to
+	the raster file (`<raster_file>.npy` and `<raster_file>.geo.npy`), and
+	memory-mapped from there in later calls. Sidecars older than the raster are
+	rebuilt. Memory-mapped rasters can be read without SIG libraries.
+
+	"""
+	key = os.path.abspath(raster_file)
+	handle = _raster_pool.get(key)
+	arr_file = raster_file + '.npy'
+	geo_file = raster_file + '.geo.npy'
+
+	if handle is None or handle.array is None:
+
+		if sidecar and _fresh_sidecar(arr_file, raster_file) and _fresh_sidecar(geo_file, raster_file):
+
+			handle = RasterHandle(raster_file, array = np.load(arr_file, mmap_mode = 'r'),
+				transform = np.load(geo_file))
+			old = _raster_pool.pop(key, None)
+			if old is not None:
+				handle.fill = old.fill
+				old.close_dataset()
+			_raster_pool[key] = handle
+
+		else:
+			handle = open_raster(raster_file)
+			handle.load()
+			if sidecar:
+				np.save(arr_file, handle.array)
+				np.save(geo_file, np.asarray(handle.transform, dtype = float))
+
+	return handle.array.nbytes
+
+
+def build_fill_index(raster_file, min_value, sidecar = False):
+	"""
+	Precomputes, for every pixel of a raster, the value returned by the nearest
+	valid neighbour search of `getE`, `altitude` and `precipitation`: valid pixels
+	keep their value, invalid ones get the average of the valid pixels in the
+	smallest neighbourhood containing any. Once built, nodata fallbacks of the
+	raster are a single array lookup. Pixels without any valid neighbour are NaN.
+	Returns the memory footprint of the index (bytes).
+
+	Arguments:
+
+	- raster_file (str): Raster file path.
+
+	- min_value (float): Lowest valid value of the raster (see `e_min_value`,
+	`altitude_min_value` and `precipitation_min_value`).
+
+	- sidecar (bool): If True, the index is cached next to the raster file
+	(`<raster_file>.fill<min_value>.npy`) and memory-mapped from there in later
+	calls. Sidecars older than the raster are rebuilt.
+
+	"""
+	handle = open_raster(raster_file)
+	fill_file = "{0}.fill{1:g}.npy".format(raster_file, min_value)
+
+	if min_value in handle.fill:
+		pass
+
+	elif sidecar and _fresh_sidecar(fill_file, raster_file):
+		handle.fill[min_value] = np.load(fill_file, mmap_mode = 'r')
+
+	else:
+		arr = handle.array
+		if arr is None:
+			arr = handle.read(0, 0, handle.xsize, handle.ysize)
+		arr = np.asarray(arr, dtype = float)
+
+		with np.errstate(invalid = 'ignore'):
+			valid = (arr > min_value) & (np.abs(arr) != np.inf)
+		fill = np.where(valid, arr, np.nan)
+
+		if raster_api == "gdal":
+			# Valid pixel lookups exclude the first row and column
+			valid[0, :] = False
+			valid[:, 0] = False
+			pys, pxs = np.nonzero(~valid)
+		else:
+			pys, pxs = np.nonzero(~valid)
+			# Integral images of valid values and counts, for window sums
+			vsum = np.zeros((arr.shape[0] + 1, arr.shape[1] + 1))
+			vsum[1:, 1:] = np.where(valid, arr, 0).cumsum(0).cumsum(1)
+			vcount = np.zeros((arr.shape[0] + 1, arr.shape[1] + 1))
+			vcount[1:, 1:] = valid.cumsum(0).cumsum(1)
+
+		radius = 1
+		while pys.shape[0] > 0 and radius <= max(arr.shape):
+
+			if raster_api == "gdal":
+				tot = np.zeros(pys.shape[0])
+				count = np.zeros(pys.shape[0])
+				for dx in [-radius, radius]:
+					for dy in [-radius, radius]:
+						nx = pxs + dx
+						ny = pys + dy
+						ok = (nx >= 0) & (ny >= 0) & (nx < arr.shape[1]) & (ny < arr.shape[0])
+						ok[ok] = valid[ny[ok], nx[ok]]
+						tot[ok] += arr[ny[ok], nx[ok]]
+						count[ok] += 1
+
+			else:
+				y0 = np.maximum(pys - radius, 0)
+				x0 = np.maximum(pxs - radius, 0)
+				y1 = np.minimum(pys + radius + 1, arr.shape[0])
+				x1 = np.minimum(pxs + radius + 1, arr.shape[1])
+				tot = vsum[y1, x1] - vsum[y0, x1] - vsum[y1, x0] + vsum[y0, x0]
+				count = vcount[y1, x1] - vcount[y0, x1] - vcount[y1, x0] + vcount[y0, x0]
+
+			done = count > 0
+			fill[pys[done], pxs[done]] = tot[done] / count[done]
+			pys = pys[~done]
+			pxs = pxs[~done]
+			radius += 1
+
+		if sidecar:
+			np.save(fill_file, fill)
+
+		handle.fill[min_value] = fill
+
+	return handle.fill[min_value].nbytes
+
+
+def raster_footprint():
+	"""
+	Memory footprint (bytes) of every raster loaded with `load_raster`. Returns a
+	dict (raster path: bytes). Footprints of memory-mapped rasters correspond to
+	their mapped size.
+	"""
+	out = {}
+
+	for key in _raster_pool:
+		if _raster_pool[key].array is not None:
+			out[_raster_pool[key].path] = _raster_pool[key].array.nbytes
+
+	return out
+
+
+def close_rasters():
+	"""
+	Closes all raster files in the raster pool, including those loaded in
+	memory.
+	"""
+	while _raster_pool:
+		_, handle = _raster_pool.popitem()
+		handle.close()
+
+	return None
+
+
+def _ring_values(handle, px, py, radius):
+	"""
+	Raster values sampled at `radius` pixels from (px, py): the four corners of
+	the ring if using gdal, the whole window otherwise.
+	"""
+	out = []
+
+	if raster_api == "gdal":
+		for npx in [px-radius, px+radius]:
+			for npy in [py-radius, py+radius]:
+				if npx > 0 and npy > 0 and npx <= handle.xsize and npy <= handle.ysize:
+					out.append(handle.read(npx, npy)[0][0])
+
+	else:
+		out = handle.read(px-radius, py-radius, 2 * radius + 1, 2 * radius + 1)
+
+	return np.asarray(out, dtype = float).flatten()
+
+
+def _neighbour_mean(handle, px, py, min_value):
+	"""
+	Average of the valid values (finite and greater than `min_value`) in the
+	smallest neighbourhood of pixel (px, py) containing any of them. Served by
+	the raster fill index if one was built (`build_fill_index`).
 	"""
 	out = None
-	val = None
 	radius = 0
 
+	fill = handle.fill.get(min_value)
+	if fill is not None and 0 <= px < handle.xsize and 0 <= py < handle.ysize:
+		return fill[py, px]
+
+	while out is None:
+		vals = _ring_values(handle, px, py, radius)
+		vals = vals[(vals > min_value) & (np.abs(vals) != np.inf)]
+		if vals.shape[0] > 0:
+			out = vals.mean()
+		radius += 1
+
+	return out
+
+
+def _batch_neighbour_mean(handle, longitudes, latitudes, min_value):
+	"""
+	Vectorized version of `_neighbour_mean` for arrays of coordinates. The
+	neighbourhood search only runs for locations falling on invalid pixels.
+	Locations with missing coordinates are returned as NaN.
+	"""
+	longitudes = np.asarray(longitudes, dtype = float)
+	latitudes = np.asarray(latitudes, dtype = float)
+	out = np.full(longitudes.shape, np.nan)
+
+	located = np.nonzero(np.isfinite(longitudes) & np.isfinite(latitudes))[0]
+	px, py = handle.pixels(longitudes[located], latitudes[located])
+	vals = handle.sample(px, py)
+
+	with np.errstate(invalid = 'ignore'):
+		invalid = ~((vals > min_value) & (np.abs(vals) != np.inf))
+
 	if raster_api == "gdal":
-		myras = gdal.Open(raster)
-		transform = myras.GetGeoTransform()
-		xOrigin = transform[0]
-		yOrigin = transform[3]
-		pixelWidth = transform[1]
-		pixelHeight = transform[5]
-		px = int((longitude - xOrigin) / pixelWidth) #x pixel
-		py = int((latitude - yOrigin) / pixelHeight) #y pixel
-		val = myras.ReadAsArray(px,py,1,1).flatten()[0]
-
-	elif raster_api == "rasterio":
-		myras = rasterio.open(raster)
-		py, px = map(lambda x: int(x), myras.index(longitude, latitude))
-		val = myras.read(1, window=((py, py+1), (px, px+1))).flatten()[0]
-		#print val
+		invalid |= (px <= 0) | (py <= 0)
+
+	fill = handle.fill.get(min_value)
+	if fill is not None:
+		indexed = invalid & (px >= 0) & (py >= 0) & (px < handle.xsize) & (py < handle.ysize)
+		vals[indexed] = fill[py[indexed], px[indexed]]
+		invalid &= ~indexed
+
+	for i in np.nonzero(invalid)[0]:
+		vals[i] = _neighbour_mean(handle, px[i], py[i], min_value)
+
+	out[located] = vals
+
+	return out
 
-	else:
-		pass
+
+def fornofor(longitude, latitude, raster):
+	"""
+	raster = Forest/no-forest raster file path.
+	"""
+	out = None
+
+	myras = open_raster(raster)
+	px, py = myras.pixel(longitude, latitude)
+	val = myras.read(px, py).flatten()[0]
 
 	if val == 1:
 		out = 'Bosque'
@@ -65,50 +498,9 @@ def altitude(longitude, latitude, raster):
 	"""
 	rasters = Raster file path.
 	"""
-	out = None
-	radius = 0
-
-	if raster_api == "gdal":
-		while out is None:
-			alt = []
-			myras = gdal.Open(raster)
-			transform = myras.GetGeoTransform()
-			xOrigin = transform[0]
-			yOrigin = transform[3]
-			pixelWidth = transform[1]
-			pixelHeight = transform[5]
-			px = int((longitude - xOrigin) / pixelWidth) #x pixel
-			py = int((latitude - yOrigin) / pixelHeight) #y pixel
-			pxs = [px-radius, px+radius]
-			pys = [py-radius, py+radius]
-			for npx in pxs:
-				for npy in pys:
-					if npx > 0 and npy > 0 and npx <= myras.RasterXSize and npy <= myras.RasterYSize:
-						intval = myras.ReadAsArray(npx,npy,1,1)
-						if intval[0][0] > -100:
-							alt.append(intval[0][0])
-			alt = filter(lambda w: abs(w) != np.inf, alt)
-			if len(alt):
-				out = sum(alt) / float(len(alt))
-			radius += 1
-
-	elif raster_api == "rasterio":
-		while out is None:
-			alt = np.array([])
-			myras = rasterio.open(raster)
-			py, px = map(lambda x: int(x), myras.index(longitude, latitude))
-
-			pxs = (px-radius, px+radius+1)
-			pys = (py-radius, py+radius+1)
-			#val = myras.read(1, window=((py, py+1), (px, px+1))).flatten()[0]
-			alts = myras.read(1, window=(pys, pxs)).flatten()
-			alts = alts[np.where((alts > -100) & (abs(alts) != np.inf))]
-			if alts.shape[0] > 0:
-				out = alts.mean()
-			radius += 1
-
-	else:
-		pass
+	myras = open_raster(raster)
+	px, py = myras.pixel(longitude, latitude)
+	out = _neighbour_mean(myras, px, py, altitude_min_value)
 
 	return out
 
@@ -121,54 +513,56 @@ def precipitation(longitude, latitude, raster_file):
 	follow WorldClim v2 filename standard (*.tif).
 	"""
 	out = None
-	radius = 0
-	if raster_api == "gdal":
-		out = -1
-		while out < 0:
-			prec = []
-			if raster_file.endswith('.tif') or raster_file.endswith('.bil'):
-				prec_raster = gdal.Open(raster_file)
-				transform = prec_raster.GetGeoTransform()
-				xOrigin = transform[0]
-				yOrigin = transform[3]
-				pixelWidth = transform[1]
-				pixelHeight = transform[5]
-				prec_band = prec_raster.GetRasterBand(1)
-				px = int((longitude - xOrigin) / pixelWidth) #x pixel
-				py = int((latitude - yOrigin) / pixelHeight) #y pixel
-				pxs = [px-radius, px+radius]
-				pys = [py-radius, py+radius]
-				for npx in pxs:
-					for npy in pys:
-						if npx > 0 and npy > 0 and npx <= prec_raster.RasterXSize and npy <= prec_raster.RasterYSize:
-							intval = prec_band.ReadAsArray(npx,npy,1,1)
-							if intval[0][0] > 0:
-								prec.append(intval[0][0])
-				prec = filter(lambda w: abs(w) != np.inf, prec)
-			if len(prec):
-				out = sum(prec) / float(len(prec))
 
-			radius += 1
+	if raster_file.endswith('.tif') or raster_file.endswith('.bil'):
+		prec_raster = open_raster(raster_file)
+		px, py = prec_raster.pixel(longitude, latitude)
+		out = _neighbour_mean(prec_raster, px, py, precipitation_min_value)
 
-	if raster_api == "rasterio":
-		out = -1
-		while out < 0:
-			prec = []
-			if raster_file.endswith('.tif') or raster_file.endswith('.bil'):
-				prec_raster = rasterio.open(raster_file)
-				py, px = map(lambda x: int(x), prec_raster.index(longitude, latitude))
-
-				pxs = (px-radius, px+radius+1)
-				pys = (py-radius, py+radius+1)
-				prec = prec_raster.read(1, window=(pys, pxs)).flatten()
-				prec = prec[np.where((prec > -10) & (abs(prec) != np.inf))]
-				if prec.shape[0] > 0:
-					out = prec.mean()
+	return out
 
-			radius += 1
+
+def fornofor_batch(longitudes, latitudes, raster):
+	"""
+	Vectorized version of `fornofor` for arrays of coordinates. Returns an object
+	array of forest categories.
+	"""
+	categories = {1: 'Bosque', 2: 'No-bosque', 3: 'SI'}
+	longitudes = np.asarray(longitudes, dtype = float)
+	latitudes = np.asarray(latitudes, dtype = float)
+	out = np.full(longitudes.shape, None, dtype = object)
+
+	myras = open_raster(raster)
+	located = np.nonzero(np.isfinite(longitudes) & np.isfinite(latitudes))[0]
+	px, py = myras.pixels(longitudes[located], latitudes[located])
+	vals = myras.sample(px, py)
+	out[located] = [categories.get(v) for v in vals]
 
 	return out
 
+
+def altitude_batch(longitudes, latitudes, raster):
+	"""
+	Vectorized version of `altitude` for arrays of coordinates. Returns an array.
+	"""
+	myras = open_raster(raster)
+	return _batch_neighbour_mean(myras, longitudes, latitudes, altitude_min_value)
+
+
+def precipitation_batch(longitudes, latitudes, raster_file):
+	"""
+	Vectorized version of `precipitation` for arrays of coordinates. Returns an
+	array.
+	"""
+	out = np.full(np.shape(longitudes), np.nan)
+
+	if raster_file.endswith('.tif') or raster_file.endswith('.bil'):
+		prec_raster = open_raster(raster_file)
+		out = _batch_neighbour_mean(prec_raster, longitudes, latitudes, precipitation_min_value)
+
+	return out
+
+
 def holdridge_col(altitude, precipitation):
 	"""
 	Estimates the life zone according to Holdridge (1971, `Forest Environments in
@@ -226,6 +620,61 @@ def holdridge_col(altitude, precipitation):
 	return out
 
 
+# Integer codes of the life zones returned by `holdridge_codes`. Code 0 stands
+# for localities out of the forest life zones (`holdridge_col` returns None).
+holdridge_classes = {0: None,
+	1: 'tropical_very_dry',
+	2: 'tropical_dry',
+	3: 'tropical_moist',
+	4: 'tropical_wet',
+	5: 'tropical_rain',
+	6: 'premontane_dry',
+	7: 'premontane_moist',
+	8: 'premontane_wet',
+	9: 'premontane_rain',
+	10: 'lower_montane_dry',
+	11: 'lower_montane_moist',
+	12: 'lower_montane_wet',
+	13: 'lower_montane_rain',
+	14: 'montane_moist',
+	15: 'montane_wet'}
+
+# Life zone codes by altitude belt (rows) and precipitation belt (columns), as
+# delimited by the bins below.
+_holdridge_altitude_bins = [1000, 2000, 3000, 4000]
+_holdridge_precipitation_bins = [500, 1000, 2000, 4000, 8000]
+_holdridge_table = np.array([
+	[0, 1, 2, 3, 4, 5],
+	[0, 6, 7, 8, 9, 0],
+	[0, 10, 11, 12, 13, 0],
+	[0, 14, 15, 15, 0, 0],
+	[0, 0, 0, 0, 0, 0]])
+
+
+def holdridge_codes(altitude, precipitation):
+	"""
+	Vectorized version of `holdridge_col`, suitable for whole rasters. Returns
+	an integer array of life zone codes, with the shape of the arguments, and the
+	dictionary mapping codes to life zone names (`holdridge_classes`).
+
+	Arguments:
+
+	- altitude (array): Altitude (m).
+
+	- precipitation (array): Precipitation (mm / year).
+
+	"""
+	altitude = np.asarray(altitude, dtype = float)
+	precipitation = np.asarray(precipitation, dtype = float)
+
+	alt_belt = np.digitize(altitude, _holdridge_altitude_bins)
+	prec_belt = np.digitize(precipitation, _holdridge_precipitation_bins)
+	codes = _holdridge_table[alt_belt, prec_belt]
+	codes[np.isnan(altitude) | np.isnan(precipitation)] = 0
+
+	return codes, holdridge_classes
+
+
 
 
 ###################################
@@ -250,56 +699,21 @@ def getE(longitude, latitude, raster_file):
 	provided by Chave and available at
 	http://chave.ups-tlse.fr/pantropical_allometry/E.bil.zip. Returns a float.
 	"""
-	out = None
-	min_value = -10.0
-	radius = 0
+	E_raster = open_raster(raster_file)
+	px, py = E_raster.pixel(longitude, latitude)
 
-	if raster_api == "gdal":
-		E_raster = gdal.Open(raster_file)
-		transform = E_raster.GetGeoTransform()
-		xOrigin = transform[0]
-		yOrigin = transform[3]
-		pixelWidth = transform[1]
-		pixelHeight = transform[5]
-		E_band = E_raster.GetRasterBand(1)
-		px = int((longitude - xOrigin) / pixelWidth) #x pixel
-		py = int((latitude - yOrigin) / pixelHeight) #y pixel
-		intval = E_band.ReadAsArray(px,py,1,1)
-		out = float(intval[0][0])
-
-		# Sampling neighbors if E in px,py is -inf
-		rad = 1
-		while abs(out) == np.inf or out < min_value:
-			newee = []
-			for pxi in [(px-rad), (px+rad)]:
-				for pyi in [(py-rad),(py+rad)]:
-					if pxi > 0 and pyi > 0 and pxi <= E_raster.RasterXSize and pyi <= E_raster.RasterYSize:
-						intval = E_band.ReadAsArray(pxi,pyi,1,1)
-						newee.append(float(intval[0][0]))
-			newee = filter(lambda w: abs(w) != np.inf, newee)
-			newee = filter(lambda w: w > min_value, newee)
-			if len(newee):
-				out = sum(newee) / len(newee)
-			rad += 1
-
-	elif raster_api == "rasterio":
-		while out is None:
-			ee = []
-			E_raster = rasterio.open(raster_file)
-			py, px = map(lambda x: int(x), E_raster.index(longitude, latitude))
-			pxs = (px-radius, px+radius+1)
-			pys = (py-radius, py+radius+1)
-			ee = E_raster.read(1, window=(pys, pxs)).flatten()
-			ee = ee[np.where((ee > min_value) & (abs(ee) != np.inf))]
-			if ee.shape[0] > 0:
-				out = ee.mean()
-			radius += 1
+	# Sampling neighbors if E in px,py is -inf
+	out = _neighbour_mean(E_raster, px, py, e_min_value)
 
+	return out
 
-	else:
-		print "Function getE is not available: requires package gdal."
 
-	return out
+def getE_batch(longitudes, latitudes, raster_file):
+	"""
+	Vectorized version of `getE` for arrays of coordinates. Returns an array.
+	"""
+	E_raster = open_raster(raster_file)
+	return _batch_neighbour_mean(E_raster, longitudes, latitudes, e_min_value)
 
 
 def chaveI_forest(precipitation):
@@ -331,6 +745,27 @@ def chaveI_forest(precipitation):
 	return out
 
 
+# Integer codes of the forest types returned by `chave_forest_codes`.
+chave_classes = {1: 'dry', 2: 'moist', 3: 'wet'}
+
+
+def chave_forest_codes(precipitation):
+	"""
+	Vectorized version of `chaveI_forest`, suitable for whole rasters. Returns
+	an integer array of forest type codes, with the shape of the argument, and
+	the dictionary mapping codes to forest type names (`chave_classes`).
+
+	Arguments:
+
+	- precipitation (array): Precipitation (mm / year).
+
+	"""
+	precipitation = np.asarray(precipitation, dtype = float)
+	codes = np.digitize(precipitation, [1500, 3500], right = True) + 1
+
+	return codes, chave_classes
+
+
 def chave_height(diameter, longitude=None, latitude=None, raster_file = None, e_value = None):
 	"""
 	Estimates tree height accordingly to allometric relation proposed by Chave
@@ -341,11 +776,11 @@ def chave_height(diameter, longitude=None, latitude=None, raster_file = None, e_
 	"""
 	height = None
 
-	if GDAL and longitude and latitude and raster_file and e_value is None:
-		E = getE(longitude, latitude, raster_file)
+	if raster_api and longitude and latitude and raster_file and e_value is None:
+		e_value = getE(longitude, latitude, raster_file)
 
 	if isinstance(e_value, float):
-		logH = 0.893 - E + 0.760 * np.log(diameter) - 0.0340 * np.log(diameter)**2
+		logH = 0.893 - e_value + 0.760 * np.log(diameter) - 0.0340 * np.log(diameter)**2
 		height = np.exp(logH + 0.5 * 0.243**2)
 
 	return height
@@ -647,6 +1082,448 @@ def chaveII_dh(diameter, height, density):
 	return AGB
 
 
+###################################
+# Vectorized biomass estimation functions
+###################################
+
+# Columns of the stem feature matrix returned by `stem_features`.
+stem_feature_names = ['intercept', 'ln_d', 'ln_d2', 'ln_d3', 'ln_h', 'ln_wd', 'E']
+
+# Registry of allometric equations, as linear models of the natural logarithm
+# of biomass (Kg) on stem features. `terms` are the features of the model and
+# `coefs` their coefficients, by forest type if the equation depends on a
+# forest classification (`classes`: 'holdridge' or 'chave'), otherwise a single
+# tuple. Keys are the equation names accepted by comm.Plot.biomass.
+allometric_equations = {
+	'Alvarez_d': {
+		'reference': 'Alvarez et al. 2012, type II.1 (see `alvarez`)',
+		'classes': 'holdridge',
+		'terms': ('intercept', 'ln_d', 'ln_d2', 'ln_d3', 'ln_wd'),
+		'coefs': {
+			'tropical_dry': (3.652, -1.697, 1.169, -0.122, 1.285),
+			'tropical_moist': (2.406, -1.289, 1.169, -0.122, 0.445),
+			'tropical_wet': (1.662, -1.114, 1.169, -0.122, 0.331),
+			'premontane_moist': (1.960, -1.098, 1.169, -0.122, 1.061),
+			'lower_montane_wet': (1.836, -1.255, 1.169, -0.122, -0.222),
+			'montane_wet': (3.130, -1.536, 1.169, -0.122, 1.767)}},
+
+	'Alvarez_dh': {
+		'reference': 'Alvarez et al. 2012, type I.1 (see `alvarez_dh`)',
+		'classes': 'holdridge',
+		'terms': ('intercept', 'ln_d', 'ln_h', 'ln_wd'),
+		'coefs': {
+			'tropical_dry': (-2.217, 2.081, 0.587, 1.092),
+			'tropical_moist': (-2.919, 2.081, 0.587, 0.391),
+			'tropical_wet': (-2.857, 2.081, 0.587, 0.453),
+			'premontane_moist': (-2.221, 2.081, 0.587, 1.089),
+			'lower_montane_wet': (-3.670, 2.081, 0.587, -0.360),
+			'montane_wet': (-2.294, 2.081, 0.587, 1.016)}},
+
+	'Chave_I': {
+		'reference': 'Chave et al. 2005, as published by Phillips et al. 2016 (see `chaveI`)',
+		'classes': 'chave',
+		'terms': ('intercept', 'ln_d', 'ln_d2', 'ln_d3', 'ln_wd'),
+		'coefs': {
+			'dry': (-0.667, 1.784, 0.207, -0.028, 1.0),
+			'moist': (-1.499, 2.148, 0.207, -0.028, 1.0),
+			'wet': (-1.239, 1.980, 0.207, -0.028, 1.0)}},
+
+	'Chave_I_original': {
+		'reference': 'Chave et al. 2005 (see `chaveI_original`)',
+		'classes': 'chave',
+		'terms': ('intercept', 'ln_d', 'ln_d2', 'ln_d3', 'ln_wd'),
+		'coefs': {
+			'dry': (-0.730, 1.784, 0.207, -0.028, 1.0),
+			'moist': (-1.562, 2.148, 0.207, -0.028, 1.0),
+			'wet': (-1.302, 1.980, 0.207, -0.028, 1.0)}},
+
+	'Chave_II_d': {
+		'reference': 'Chave et al. 2014, eq 7, corrected (see `chaveII`)',
+		'classes': None,
+		'terms': ('intercept', 'E', 'ln_wd', 'ln_d', 'ln_d2'),
+		'coefs': (-2.1094, -0.8965, 0.9228, 2.7943, -0.0459)},
+
+	'Chave_II_dh': {
+		'reference': 'Chave et al. 2014, eq 4, corrected (see `chaveII_dh`)',
+		'classes': None,
+		'terms': ('intercept', 'ln_wd', 'ln_h', 'ln_d'),
+		'coefs': (np.log(0.06311), 0.9759, 0.9759, 2 * 0.9759)},
+	}
+
+# Coefficient tables of the registry, compiled by `_compile_equation`
+_compiled_equations = {}
+
+
+def _compile_equation(name):
+	"""
+	Coefficient table of an equation of the registry over all stem features:
+	one row per forest type code (NaN rows for types without coefficients), or a
+	single row if the equation has no forest classification.
+	"""
+	if name not in _compiled_equations:
+
+		if name not in allometric_equations:
+			raise ValueError("Unknown allometric equation: {0}".format(name))
+
+		eq = allometric_equations[name]
+		cols = [stem_feature_names.index(x) for x in eq['terms']]
+
+		if eq['classes'] is None:
+			table = np.zeros((1, len(stem_feature_names)))
+			table[0, cols] = eq['coefs']
+
+		else:
+			classes = {'holdridge': holdridge_classes, 'chave': chave_classes}[eq['classes']]
+			table = np.full((max(classes) + 1, len(stem_feature_names)), np.nan)
+			for code in classes:
+				if classes[code] in eq['coefs']:
+					table[code] = 0.0
+					table[code, cols] = eq['coefs'][classes[code]]
+
+		_compiled_equations[name] = table
+
+	return _compiled_equations[name]
+
+
+def _forest_codes(forest_type, classes):
+	"""
+	Forest type codes of `classes` from names or codes (scalar or array). Unknown
+	names are returned as -1.
+	"""
+	forest_type = np.asarray(forest_type)
+
+	if forest_type.dtype.kind not in 'iu':
+		codes = {}
+		for code in classes:
+			codes[classes[code]] = code
+		forest_type = np.vectorize(lambda x: codes.get(x, -1), otypes = [int])(forest_type)
+
+	return forest_type
+
+
+def stem_features(diameter, density, height = None, e_value = None):
+	"""
+	Builds the matrix of stem features shared by all equations of the registry
+	(columns named in `stem_feature_names`): log diameter and its powers, log
+	height, log wood density and E. Missing or non positive diameters yield NaN
+	rows. Returns a 2-dimensional array (stems x features).
+
+	Arguments:
+
+	- diameter (array): Diameter (cm) at breast height.
+
+	- density (array or float): Wood density (gr/cm^3).
+
+	- height (array or float): Tree total height (m).
+
+	- e_value (array or float): Value of coefficient E.
+
+	"""
+	if height is None:
+		height = np.nan
+	if e_value is None:
+		e_value = np.nan
+
+	diameter, density, height, e_value = np.broadcast_arrays(*[np.asarray(x, dtype = float)
+		for x in [diameter, density, height, e_value]])
+
+	out = np.empty((diameter.size, len(stem_feature_names)))
+
+	with np.errstate(invalid = 'ignore', divide = 'ignore'):
+		lnd = np.log(np.where(diameter > 0, diameter, np.nan)).ravel()
+		out[:, 0] = 1.0
+		out[:, 1] = lnd
+		out[:, 2] = lnd ** 2
+		out[:, 3] = lnd ** 3
+		out[:, 4] = np.log(height).ravel()
+		out[:, 5] = np.log(density).ravel()
+		out[:, 6] = e_value.ravel()
+
+	return out
+
+
+def biomass_equations(names, features, forest_types = None):
+	"""
+	Evaluates equations of the registry (`allometric_equations`) on a stem
+	feature matrix (`stem_features`). Equations whose forest types are scalars
+	are evaluated together, as a single matrix product of the features and their
+	coefficients. Returns an array of biomass values (Kg), one row per stem and
+	one column per equation; stems missing any feature required by an equation
+	are NaN.
+
+	Arguments:
+
+	- names (list): Equation names.
+
+	- features (np.ndarray): Stem feature matrix.
+
+	- forest_types (dict): Forest types by classification system ('holdridge',
+	'chave'), as names or codes, either scalars or one per stem.
+
+	"""
+	if forest_types is None:
+		forest_types = {}
+
+	missing = np.isnan(features)
+	filled = np.where(missing, 0.0, features)
+	out = np.zeros((features.shape[0], len(names)))
+	shared = []
+	weights = np.zeros((features.shape[1], len(names)))
+
+	for i, name in enumerate(names):
+		table = _compile_equation(name)
+		system = allometric_equations[name]['classes']
+
+		if system is None:
+			codes = np.array(0)
+		else:
+			classes = {'holdridge': holdridge_classes, 'chave': chave_classes}[system]
+			codes = _forest_codes(forest_types.get(system), classes)
+			if (codes < 0).any() or (codes >= table.shape[0]).any():
+				raise ValueError("Forest type without coefficients for equation {0}.".format(name))
+
+		coefs = table[codes]
+		if np.isnan(coefs).any():
+			raise ValueError("Forest type without coefficients for equation {0}.".format(name))
+
+		if coefs.ndim == 1:
+			shared.append(i)
+			weights[:, i] = coefs
+		else:
+			out[:, i] = (filled * coefs).sum(axis = 1)
+
+		used = np.zeros(features.shape[1], dtype = bool)
+		used[[stem_feature_names.index(x) for x in allometric_equations[name]['terms']]] = True
+		out[missing[:, used].any(axis = 1), i] = np.nan
+
+	if shared:
+		out[:, shared] = np.where(np.isnan(out[:, shared]), np.nan, filled.dot(weights[:, shared]))
+
+	with np.errstate(invalid = 'ignore'):
+		out = np.exp(out)
+
+	return out
+
+
+def _equation_array(name, forest_type, diameter, density, height = None, e_value = None):
+	"""
+	Evaluates a single equation of the registry on arrays, keeping their shape.
+	"""
+	shape = np.broadcast(*[np.asarray(x) for x in [diameter, density, height, e_value,
+		forest_type] if x is not None]).shape
+	features = stem_features(np.broadcast_to(diameter, shape), density, height, e_value)
+	system = allometric_equations[name]['classes']
+	forest_types = {}
+
+	if system is not None:
+		forest_types[system] = np.broadcast_to(forest_type, shape).ravel()
+
+	return biomass_equations([name], features, forest_types)[:, 0].reshape(shape)
+
+
+def chaveI_array(diameter, density, forest_type):
+	"""
+	Vectorized version of `chaveI`. Arguments can be arrays (diameter, density,
+	and forest type names or codes of `chave_classes`, one per stem) or scalars.
+	Returns an array of biomass values (Kg); stems with missing or non positive
+	diameters are NaN.
+	"""
+	return _equation_array('Chave_I', forest_type, diameter, density)
+
+
+def chaveI_original_array(diameter, density, forest_type):
+	"""
+	Vectorized version of `chaveI_original`. Arguments can be arrays (diameter,
+	density, and forest type names or codes of `chave_classes`, one per stem) or
+	scalars. Returns an array of biomass values (Kg); stems with missing or non
+	positive diameters are NaN.
+	"""
+	return _equation_array('Chave_I_original', forest_type, diameter, density)
+
+
+def alvarez_array(diameter, density, forest_type):
+	"""
+	Vectorized version of `alvarez`. Arguments can be arrays (diameter, density,
+	and forest type names or codes of `holdridge_classes`, one per stem) or
+	scalars. Returns an array of biomass values (Kg); stems with missing or non
+	positive diameters are NaN.
+	"""
+	return _equation_array('Alvarez_d', forest_type, diameter, density)
+
+
+def alvarez_dh_array(diameter, height, density, forest_type):
+	"""
+	Vectorized version of `alvarez_dh`. Arguments can be arrays (diameter,
+	height, density, and forest type names or codes of `holdridge_classes`, one
+	per stem) or scalars. Returns an array of biomass values (Kg); stems with
+	missing or non positive diameters are NaN.
+	"""
+	return _equation_array('Alvarez_dh', forest_type, diameter, density, height = height)
+
+
+def chaveII_array(diameter, density, e_value):
+	"""
+	Vectorized version of `chaveII`. Arguments can be arrays (diameter, density,
+	and E, one per stem) or scalars. Returns an array of biomass values (Kg);
+	stems with missing or non positive diameters are NaN.
+	"""
+	return _equation_array('Chave_II_d', None, diameter, density, e_value = e_value)
+
+
+def chaveII_dh_array(diameter, height, density):
+	"""
+	Vectorized version of `chaveII_dh`. Arguments can be arrays (diameter,
+	height and density, one per stem) or scalars. Returns an array of biomass
+	values (Kg); stems with missing or non positive diameters are NaN.
+	"""
+	return _equation_array('Chave_II_dh', None, diameter, density, height = height)
+
+
+def chave_height_array(diameter, e_value):
+	"""
+	Vectorized version of `chave_height`. Arguments can be arrays (diameter and
+	E, one per stem) or scalars. Returns an array of heights (m); stems with
+	missing or non positive diameters are NaN. Heights from the Weibull
+	function can be obtained for arrays directly with `weibull`.
+	"""
+	diameter = np.asarray(diameter, dtype = float)
+
+	with np.errstate(invalid = 'ignore'):
+		lnd = np.log(np.where(diameter > 0, diameter, np.nan))
+
+	logH = 0.893 - np.asarray(e_value, dtype = float) + 0.760 * lnd - 0.0340 * lnd ** 2
+	height = np.exp(logH + 0.5 * 0.243**2)
+
+	return height
+
+
+###################################
+# Error propagation
+###################################
+
+# Standard deviation of wood density (gr/cm^3) and relative error of diameter
+# measurements employed in Monte Carlo error propagation.
+density_sd = 0.07727873895528423
+diameter_error = 0.05
+
+
+def _positive_normal(mean, sd, size, rs):
+	"""
+	Draws normal samples of shape `size` (mean and sd broadcast to it), drawing
+	again non positive values.
+	"""
+	mean = np.broadcast_to(mean, size)
+	sd = np.broadcast_to(sd, size)
+	out = rs.normal(mean, sd)
+	bad = out <= 0
+
+	while bad.any():
+		out[bad] = rs.normal(mean[bad], sd[bad])
+		bad = out <= 0
+
+	return out
+
+
+def _chaveII_log(coefs, e_value, lnwd, lnd):
+	"""
+	Natural logarithm of biomass (Kg) of the Chave II equation. `coefs` is an
+	array whose last axis holds the coefficients of intercept, E, ln_wd, ln_d
+	and ln_d2.
+	"""
+	return coefs[..., 0] + coefs[..., 1] * e_value + coefs[..., 2] * lnwd + \
+		coefs[..., 3] * lnd + coefs[..., 4] * lnd ** 2
+
+
+def chaveII_montecarlo(diameter, density, e_value, area = 1.0, coefficients = None,
+	iters = 100, path_sims = 1000, random_state = None, chunk_size = 2000):
+	"""
+	Propagates the uncertainty of diameter measurements, wood density and the
+	coefficients of the Chave II equation (see `chaveII`) to the biomass of a
+	plot. For every stem `iters` biomass values are simulated, and `path_sims`
+	plot totals are obtained by resampling one simulated value per stem. Returns
+	a dict of arrays of `path_sims` plot totals (Kg / area unit):
+
+	- 'biomass': aggregated uncertainty.
+
+	- 'diameter', 'wood_density', 'allometry': uncertainty due to each source,
+	with the other two fixed at the observed values (or mean coefficients).
+
+	Stems with missing or non positive diameter or density are ignored.
+
+	Arguments:
+
+	- diameter (array): Diameters (cm) at breast height.
+
+	- density (array): Wood densities (gr/cm^3).
+
+	- e_value (float): Value of coefficient E.
+
+	- area (float or array): Sampled area of the plot, or per stem effective area.
+
+	- coefficients (array): Samples of the equation coefficients (intercept, E,
+	ln_wd, ln_d, ln_d2), one per row, such as a posterior sample. Default are
+	the point coefficients of the equation (no allometric uncertainty).
+
+	- iters (int): Simulations per stem.
+
+	- path_sims (int): Simulated plot totals.
+
+	- random_state (int or np.random.RandomState): Seed or random generator.
+
+	- chunk_size (int): Stems resampled at once.
+
+	"""
+	if isinstance(random_state, np.random.RandomState):
+		rs = random_state
+	else:
+		rs = np.random.RandomState(random_state)
+
+	diameter = np.asarray(diameter, dtype = float)
+	density = np.broadcast_to(np.asarray(density, dtype = float), diameter.shape)
+	area = np.broadcast_to(np.asarray(area, dtype = float), diameter.shape)
+
+	with np.errstate(invalid = 'ignore'):
+		ok = (diameter > 0) & (density > 0) & (area > 0)
+	diameter = diameter[ok][:, None]
+	density = density[ok][:, None]
+	area = area[ok][:, None]
+
+	if coefficients is None:
+		coefficients = allometric_equations['Chave_II_d']['coefs']
+	coefficients = np.atleast_2d(np.asarray(coefficients, dtype = float))
+	draws = coefficients[rs.randint(0, coefficients.shape[0], iters)]
+	mean_coefs = coefficients.mean(axis = 0)
+
+	# Simulated and observed values, (stems x iters) and (stems x 1)
+	shape = (diameter.shape[0], iters)
+	lnd = np.log(_positive_normal(diameter, diameter * diameter_error, shape, rs))
+	lnwd = np.log(_positive_normal(density, density_sd, shape, rs))
+	lnd0 = np.log(diameter)
+	lnwd0 = np.log(density)
+
+	sources = [('biomass', draws, lnwd, lnd),
+		('diameter', mean_coefs, lnwd0, lnd),
+		('wood_density', mean_coefs, lnwd, lnd0),
+		('allometry', draws, lnwd0, lnd0)]
+
+	out = {}
+	rows = np.arange(min(chunk_size, diameter.shape[0]))[:, None]
+
+	for name, coefs, lw, ld in sources:
+		agb = np.exp(_chaveII_log(coefs, e_value, lw, ld)) / area
+		agb = np.broadcast_to(agb, shape)
+		totals = np.zeros(path_sims)
+
+		for start in range(0, shape[0], chunk_size):
+			chunk = agb[start:start + chunk_size]
+			picks = rs.randint(0, iters, (chunk.shape[0], path_sims))
+			totals += chunk[rows[:chunk.shape[0]], picks].sum(axis = 0)
+
+		out[name] = totals
+
+	return out
+
+
 def det_vol(diams, length, tilts = None):
 	"""
 	Estimates volumen of detrites per unit area (m^3 / ha).
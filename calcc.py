@@ -21,15 +21,19 @@
 import pandas as pd
 import sqlalchemy as al
 import numpy as np
-import pyproj
 import allometry
 import wood_density as wd
+import db_utils
+import parallel
 
 # Variables de configuración de acceso a la base de datos
 user = ''
 password = ''
 database = ''
 
+# Numero de procesos (None: uno por procesador)
+workers = None
+
 # Nombre del archivo output
 #outfile = 'biomass_Quimera_20180118.csv'
 outfile = 'biomass_IFN_20180118.csv'
@@ -53,26 +57,11 @@ engine = al.create_engine(
 
 conn = engine.connect()
 
-# WGS 84 zone 18 N projection
-inpr = pyproj.Proj('+proj=utm +zone=18 +ellps=WGS84 +datum=WGS84 +units=m +no_defs')
-
-# WGS 84 projection
-outpr = pyproj.Proj(init='epsg:4326')
-
-def conv_coors(row, dim_out):
-	out = None
-	lon, lat = pyproj.transform(inpr, outpr, row.X, row.Y)
-	if dim_out == 'Lat':
-		out = lat
-	elif dim_out == 'Lon':
-		out = lon
-	return out
-
 par = None
 if database == "Quimera":
 	par = pd.read_sql_table(table_name='Parcelas', con = conn, index_col='PlotID')
-	par['Longitud'] = par.apply(lambda x: conv_coors(x, dim_out = 'Lon'), axis=1)
-	par['Latitud'] = par.apply(lambda x: conv_coors(x, dim_out = 'Lat'), axis=1)
+	# Coordenadas UTM 18N convertidas a longitud/latitud WGS 84
+	par['Longitud'], par['Latitud'] = db_utils.to_wgs84(par.X.values, par.Y.values)
 
 elif database == "IFN":
 	par = pd.read_sql_table(table_name='Conglomerados', con = conn)
@@ -85,19 +74,12 @@ elif database == "IFN":
 par['holdridge'] = np.nan
 par['chave_for'] = np.nan
 
-def holdtypes(row):
-	alt = allometry.altitude(row.Longitud, row.Latitud, elevation_raster)
-	prec = allometry.precipitation(row.Longitud, row.Latitud, precipitation_raster)
-	row_holdridge = allometry.holdridge_col(alt, prec)
-	return row_holdridge
+# Valores climaticos de todas las parcelas, una lectura por raster
+par['altitud'] = allometry.altitude_batch(par.Longitud.values, par.Latitud.values, elevation_raster)
+par['precipitacion'] = allometry.precipitation_batch(par.Longitud.values, par.Latitud.values, precipitation_raster)
 
-def chavetypes(row):
-	prec = allometry.precipitation(row.Longitud, row.Latitud, precipitation_raster)
-	row_chave_for = allometry.chaveI_forest(prec)
-	return row_chave_for
-
-par['holdridge'] = par.apply(holdtypes, axis=1)
-par['chave_for'] = par.apply(chavetypes, axis = 1)
+par['holdridge'] = [allometry.holdridge_col(alt, prec) for alt, prec in zip(par.altitud, par.precipitacion)]
+par['chave_for'] = [allometry.chaveI_forest(prec) for prec in par.precipitacion]
 
 # Compilar densidades
 dens = wd.load_data(densities_file)
@@ -105,15 +87,8 @@ dens = wd.load_data(densities_file)
 # Cargar Taxonomia
 tax = pd.read_sql_table(table_name='Taxonomia', con = conn)
 
-tax['TaxonDef'] = np.int64
-
-for t in tax.itertuples():
-	tax_accepted = int(t.TaxonID)
-	dad = t.SinonimoDe
-	while pd.notna(dad):
-		tax_accepted = int(dad)
-		dad = tax[tax.TaxonID == tax_accepted]['SinonimoDe'].item()
-	tax.loc[tax.TaxonID == t.TaxonID, 'TaxonDef' ] = tax_accepted
+taxacc = db_utils.acctax_table(tax)
+tax['TaxonDef'] = taxacc.TaxonDef.values
 
 # Las siguientes familias son taxa prodominantemente no arboreos y son excluidos de los computos
 herb_families =  [u'Aizoaceae', u'Alstroemeriaceae', u'Araceae', u'Aristolochiaceae', u'Athyriaceae', u'Blechnaceae', u'Campanulaceae', u'Commelinaceae', u'Cucurbitaceae', u'Cyatheaceae', u'Cyclanthaceae', u'Cyperaceae', u'Dennstaedtiaceae', u'Dicksoniaceae', u'Dryopteridaceae', u'Francoaceae', u'Gesneriaceae', u'Gunneraceae', u'Heliconiaceae', u'Lomariopsidaceae', u'Marantaceae', u'Marcgraviaceae', u'Musaceae', u'Orchidaceae', u'Poaceae', u'Pteridaceae', u'Smilacaceae', u'Strelitziaceae', u'Woodsiaceae', u'Zingiberaceae']
@@ -121,21 +96,11 @@ herb_families =  [u'Aizoaceae', u'Alstroemeriaceae', u'Araceae', u'Aristolochiac
 herb_tax_def = tax.loc[tax.Familia.isin(herb_families), 'TaxonDef'].tolist()
 
 
-def density_updated(row):
-	taxacc = row.TaxonDef
-	fam = tax[tax.TaxonID == taxacc]['Familia'].item()
-	gen = tax[tax.TaxonID == taxacc]['Genero'].item()
-	epi = tax[tax.TaxonID == taxacc]['Epiteto'].item()
-	return wd.get_density(fam, gen, epi, dens)
-
-tax['Densidad'] = tax.apply(density_updated , axis =1)
+# Densidad de cada taxon es la de su nombre aceptado
+tax['Densidad'] = wd.get_densities(taxacc, dens).values
 
 # Estimacion coefficiente E de Chave
-def estimate_E(row):
-	e_val = allometry.getE(row.Longitud, row.Latitud, chave_E_raster)
-	return e_val
-
-par['E'] = par.apply(estimate_E, axis=1)
+par['E'] = allometry.getE_batch(par.Longitud.values, par.Latitud.values, chave_E_raster)
 
 # Clases de bosque son cambiado a una categoria cercana usada por Alvarez que produzca menor biomasa
 forest_change = {'holdridge' : {'premontane_wet': 'lower_montane_wet',
@@ -156,20 +121,27 @@ par['alvarez'] = np.nan
 par['chaveI'] = np.nan
 par['chaveII'] = np.nan
 
-for pari in par.itertuples():
-
+# Fustes de todas las parcelas en una sola consulta. En IFN, individuos sin Dets
+# son muertos en pie no identificados y son excluidos.
+stems, _ = db_utils.bulk_load(database, conn, accepted_taxa = False)
+stems = stems.rename(columns = {'Diameter': 'Diametro', 'TaxonID': 'Taxon',
+	'TreeID': 'IndividuoID', 'Size': 'Tamano', 'StemID': 'TalloID'})
+meds_cols = ['Diametro', 'Taxon', 'IndividuoID']
+if database == "IFN":
+	meds_cols = ['Diametro', 'Tamano', 'Taxon', 'TalloID', 'IndividuoID']
+plot_stems = dict(db_utils.iter_plots(stems, meds_cols))
+
+
+def plot_biomass(plotid, data, random_state):
+	"""
+	Biomasa de una parcela. Retorna la tupla (plotid, (alvarez, chaveI, chaveII));
+	la biomasa es None si la parcela no es procesada.
+	"""
 	this_alvarez = 0
 	this_chaveI = 0
 	this_chaveII = 0
 
-	if database == "Quimera":
-		query = "SELECT Diametro, Taxon, IndividuoID FROM Individuos LEFT JOIN Determinaciones ON Dets=DetID WHERE Plot = {0}".format(pari.Index)
-
-	elif database == "IFN":
-		# Individuos sin Dets son muetos en pie no identificados
-		query = "SELECT DiametroP AS Diametro, Tamano, Taxon, TalloID, IndividuoID FROM Tallos LEFT JOIN Individuos ON Individuo = IndividuoID LEFT JOIN Determinaciones ON Dets=DetID WHERE Plot = {0} AND Dets IS NOT NULL AND Tamano IN ('L', 'F', 'FG')".format(pari.Index)
-
-	meds = pd.read_sql_query(sql=query, con = conn)
+	meds, holdridge, chave_for, e_value, plot_area = data
 
 	# densidad de madera promedio en la parcela
 	avewd = 0.0
@@ -179,13 +151,11 @@ for pari in par.itertuples():
 	meds.drop(meds[meds.Taxon.isin(herb_tax_def)].index, inplace = True)
 
 	if meds.shape[0] == 0:
-		par_skipped.append(pari.Index)
-		continue
+		return plotid, None
 
 	# Si ningun individuo esta determinado pasar a la siguiente parcela
 	if len(filter(lambda x: tax.loc[tax.TaxonID == int(x), 'TaxonDef'].item() != NNID, meds.Taxon.unique())) == 0:
-		par_skipped.append(pari.Index)
-		continue
+		return plotid, None
 
 	for tree in meds.itertuples():
 		if len(tax.loc[tax.TaxonID == tree.Taxon, 'Densidad']) == 1:
@@ -219,23 +189,36 @@ for pari in par.itertuples():
 
 			area = float()
 			if database == "Quimera":
-				area = pari.Area
+				area = plot_area
 			elif database == "IFN":
 				area = area_ifn[tree.Tamano] / 2000
 
 			try:
-				this_alvarez += allometry.alvarez(tree.Diametro, twd, pari.holdridge) / area
-				#lon, lat = pyproj.transform(inpr, outpr, pari.X, pari.Y)
-				this_chaveII += allometry.chaveII(tree.Diametro, twd, e_value = float(pari.E)) / area
-				this_chaveI += allometry.chaveI(tree.Diametro, twd, pari.chave_for) / area
+				this_alvarez += allometry.alvarez(tree.Diametro, twd, holdridge) / area
+				this_chaveII += allometry.chaveII(tree.Diametro, twd, e_value = float(e_value)) / area
+				this_chaveI += allometry.chaveI(tree.Diametro, twd, chave_for) / area
 			except:
-				print "Plot: {0}, Individuo: {1}, Taxon: {2}, Diametro: {3}, Densidad: {4}, E: {5}".format(pari.Index, tree.IndividuoID, tree.Taxon, tree.Diametro, twd, pari.E)
+				print "Plot: {0}, Individuo: {1}, Taxon: {2}, Diametro: {3}, Densidad: {4}, E: {5}".format(plotid, tree.IndividuoID, tree.Taxon, tree.Diametro, twd, e_value)
+
+
+	return plotid, (this_alvarez, this_chaveI, this_chaveII)
+
 
+def plot_data():
+	"""
+	Fustes y variables de cada parcela, en el orden de la tabla de parcelas.
+	"""
+	for pari in par.itertuples():
+		meds = plot_stems.get(pari.Index, pd.DataFrame(columns = meds_cols))
+		yield pari.Index, (meds, pari.holdridge, pari.chave_for, pari.E, getattr(pari, 'Area', None))
 
-	par.loc[int(pari.Index) , 'alvarez'] = this_alvarez
-	par.loc[int(pari.Index) , 'chaveI'] = this_chaveI
-	par.loc[int(pari.Index) , 'chaveII'] = this_chaveII
 
+# Las parcelas son procesadas en paralelo; los resultados conservan el orden
+for plotid, biomass in parallel.imap_plots(plot_biomass, plot_data(), workers = workers):
+	if biomass is None:
+		par_skipped.append(plotid)
+	else:
+		par.loc[int(plotid), ['alvarez', 'chaveI', 'chaveII']] = biomass
 
 
 conn.close()
@@ -0,0 +1,155 @@
+"""
+Carbon stock reports: per class biomass means of the plots (output of
+`calcc.py`) combined with the forest pixel counts by class (output of
+`gis_rout.py`).
+"""
+import pandas as pd
+
+# Area of each pixel (ha). Each pixel corresponds to 0.008333333333 ** 2
+# degrees = 0.8605507006173293 Km^2
+px_area = 86.05507006173293
+
+# Carbon fraction of the biomass
+carbon_fraction = 0.5
+
+# Allometric equations employed with each classification system (plot table
+# columns)
+equations = {'holdridge': ['alvarez', 'chaveII'], 'chave_for': ['chaveI']}
+
+# Names of the classification systems in pixel count files
+system_aliases = {'holdrigde': 'holdridge', 'chaveI': 'chave_for'}
+
+# Life zones without allometric equations are counted as the equivalent zone
+life_zone_equivalences = {
+	'lower_montane_dry': 'lower_montane_wet',
+	'lower_montane_moist': 'lower_montane_wet',
+	'lower_montane_rain': 'lower_montane_wet',
+	'lower_montane_wet': 'lower_montane_wet',
+	'montane_moist': 'lower_montane_wet',
+	'montane_wet': 'montane_wet',
+	'premontane_moist': 'premontane_moist',
+	'premontane_rain': 'lower_montane_wet',
+	'premontane_wet': 'lower_montane_wet',
+	'tropical_dry': 'tropical_dry',
+	'tropical_moist': 'tropical_moist',
+	'tropical_rain': 'tropical_wet',
+	'tropical_very_dry': 'tropical_dry',
+	'tropical_wet': 'tropical_wet'}
+
+
+def class_means(bio, equations = equations):
+	"""
+	Mean biomass of the plots of each class, for every classification system
+	and its allometric equations. Returns a pandas.DataFrame with columns
+	`System`, `Equation`, `Class` and `Mean`.
+
+	Arguments:
+
+	- bio (pandas.DataFrame): Plot biomass table, with a column per
+	classification system (class of each plot) and per allometric equation.
+
+	- equations (dict): Allometric equations of each system.
+
+	"""
+	out = []
+
+	for syst in equations:
+		means = bio.groupby(syst)[equations[syst]].mean()
+		means = means.rename_axis('Class').reset_index()
+		means = pd.melt(means, id_vars = 'Class', var_name = 'Equation', value_name = 'Mean')
+		means['System'] = syst
+		out.append(means)
+
+	return pd.concat(out, ignore_index = True)[['System', 'Equation', 'Class', 'Mean']]
+
+
+def count_table(counts, equivalences = life_zone_equivalences):
+	"""
+	Forest pixel counts as a table. Holdridge life zones are merged into their
+	equivalent zones (see `life_zone_equivalences`), and classes without pixels
+	are dropped. Returns a pandas.DataFrame with columns `Year`, `System`,
+	`Class` and `Pixels`.
+
+	Arguments:
+
+	- counts (dict): Pixel counts of each year (year: {system: {class:
+	count}}), as stored by `gis_rout.py`. System names are normalized (see
+	`system_aliases`).
+
+	- equivalences (dict): Equivalent Holdridge life zones.
+
+	"""
+	records = []
+	for year in counts:
+		for syst in counts[year]:
+			name = system_aliases.get(syst, syst)
+			for forest in counts[year][syst]:
+				eq = forest
+				if name == 'holdridge':
+					eq = equivalences.get(forest, forest)
+				records.append((year, name, eq, counts[year][syst][forest]))
+
+	out = pd.DataFrame.from_records(records, columns = ['Year', 'System', 'Class', 'Pixels'])
+	out = out.groupby(['Year', 'System', 'Class'], sort = False).Pixels.sum().reset_index()
+
+	return out[out.Pixels > 0].reset_index(drop = True)
+
+
+def report(bio, counts, px_area = px_area, equations = equations,
+	equivalences = life_zone_equivalences):
+	"""
+	Forest area and biomass of each class, year and allometric equation: the
+	mean biomass of the plots of the class times the forest area of the class.
+	Classes without plots have NaN biomass. Rows follow the order of the years
+	and classes in `counts`. Returns a pandas.DataFrame with columns `Year`,
+	`System`, `Equation`, `Class`, `Area` (ha) and `Biomass` (Ton).
+
+	Arguments:
+
+	- bio (pandas.DataFrame): Plot biomass table (Kg / ha), see `class_means`.
+
+	- counts (dict): Pixel counts of each year, see `count_table`.
+
+	- px_area (float): Pixel area (ha).
+
+	- equations (dict): Allometric equations of each system.
+
+	- equivalences (dict): Equivalent Holdridge life zones.
+
+	"""
+	pixels = count_table(counts, equivalences)
+	eqs = pd.DataFrame([(syst, eq) for syst in equations for eq in equations[syst]],
+		columns = ['System', 'Equation'])
+
+	out = pixels.reset_index().merge(eqs, on = 'System').merge(class_means(bio, equations),
+		on = ['System', 'Equation', 'Class'], how = 'left')
+	out['Area'] = out.Pixels * px_area
+	out['Biomass'] = out.Mean * out.Area * 0.001
+
+	# Rows in the order of the pixel counts (year blocks), merge groups them by
+	# system
+	out = out.sort_values('index', kind = 'mergesort').reset_index(drop = True)
+
+	return out[['Year', 'System', 'Equation', 'Class', 'Area', 'Biomass']]
+
+
+def carbon_totals(table):
+	"""
+	Total carbon of each year and allometric equation, from a `report` table.
+	Classes without biomass estimates are ignored. Returns a pandas.DataFrame
+	with columns `Year`, `Equation` and `Carbon` (Ton).
+	"""
+	out = table.groupby(['Year', 'Equation']).Biomass.sum() * carbon_fraction
+
+	return out.rename('Carbon').reset_index()
+
+
+def write_report(table, outfile):
+	"""
+	Writes a `report` table as a csv file without header, values formatted as
+	by `str`.
+	"""
+	table = table.assign(Area = table.Area.map(str), Biomass = table.Biomass.map(str))
+	table.to_csv(outfile, header = False, index = False, na_rep = 'nan')
+
+	return None
@@ -11,6 +11,9 @@
 # 2 = no bosque
 # 3 = nan
 
+import numpy as np
+import pandas as pd
+
 weights = {'Amazonia: Bosque': 0.3501,
 	'Amazonia: No-bosque': 0.0520,
 	'Andes: Bosque': 0.0941,
@@ -46,13 +49,48 @@ areas = {'Amazonia: Bosque': 39927789,
 	'Pacifico: Bosque': 5397941,
 	'Pacifico: No-bosque': 1323911}
 
+def _strata_sums(dtfr, domain, domain_p, var_y, var_x):
+	"""
+	Sumas por estrato empleadas por los estimadores de covarianza, calculadas
+	con un solo groupby. Las sumas de productos son NaN si el estrato tiene
+	valores faltantes (como `sum`). Retorna un pandas.DataFrame indexado por
+	estrato, en el orden de `dtfr.Stratum.unique()`.
+	"""
+	in_y = dtfr.Domain == domain
+	in_x = dtfr.Domain == domain_p
+	in_both = in_y | in_x
+
+	cols = {'rows': pd.Series(1.0, index = dtfr.index),
+		'rows_y': in_y.astype(float),
+		'rows_x': in_x.astype(float),
+		'sum_y': dtfr[var_y].where(in_y, 0).fillna(0),
+		'sum_x': dtfr[var_x].where(in_x, 0).fillna(0),
+		'sum_a': dtfr.Area.fillna(0)}
+	# Sumas que propagan valores faltantes
+	prop = {'A': (dtfr[var_y] * dtfr[var_x]).where(in_both, 0),
+		'B': (dtfr.Area * dtfr[var_x]).where(in_x, 0),
+		'C': (dtfr.Area * dtfr[var_y]).where(in_y, 0),
+		'sum_a2': dtfr.Area ** 2}
+	cols.update(prop)
+
+	frame = pd.DataFrame(cols)
+	grp = frame.groupby(dtfr.Stratum, sort = False)
+	sums = grp.sum()
+	missing = frame[list(prop)].isna().groupby(dtfr.Stratum, sort = False).any()
+	for col in prop:
+		sums.loc[missing[col], col] = np.nan
+
+	return sums.reindex(dtfr.Stratum.unique())
+
+
 def domain_mean(dtfr, domain, variable, areas = areas):
+	sel = dtfr.Domain == domain
+	sum_y = dtfr.loc[sel, variable].groupby(dtfr.loc[sel, 'Stratum']).sum()
+	sum_a = dtfr.Area.groupby(dtfr.Stratum).sum()
 	tot = 0.0
 	for h in areas:
-		if dtfr[(dtfr.Stratum == h) & (dtfr.Domain == domain)].shape[0] > 0:
-			sum_y = dtfr.loc[(dtfr.Stratum == h) & (dtfr.Domain == domain), variable].sum()
-			sum_a = float(dtfr.loc[(dtfr.Stratum == h), "Area"].sum())
-			str_mean = sum_y / sum_a
+		if h in sum_y.index:
+			str_mean = sum_y[h] / float(sum_a[h])
 			tot += str_mean * areas[h]
 	tot /= sum(areas.values())
 	return tot
@@ -190,152 +228,94 @@ def cov_strata(dtfr, domain, domain_p,  var_y, var_x ):
 	"""
 	domain is subset of domain_p.
 	"""
-	covs = {}
-	
-	for h in dtfr.Stratum.unique().tolist():
-		
-		indxs = dtfr[((dtfr.Domain == domain) | (dtfr.Domain == domain_p)) & (dtfr.Stratum == h)].index
-	
-		if dtfr[dtfr.Stratum == h].shape[0] > 1:
-		
-			n_h = float(dtfr[(dtfr.Stratum == h)].shape[0])
-			
-			sum_y = 0.0
-			if dtfr[(dtfr.Stratum == h) & (dtfr.Domain == domain)].shape[0] > 0:
-				sum_y = dtfr.loc[(dtfr.Stratum == h) & (dtfr.Domain == domain), var_y].sum()
-				
-			sum_a = dtfr.loc[(dtfr.Stratum == h), "Area"].sum()
-			mean_y = sum_y / sum_a
-			
-			sum_x = 0.0
-			if dtfr[(dtfr.Stratum == h) & (dtfr.Domain == domain_p)].shape[0] > 0:
-				sum_x = dtfr.loc[(dtfr.Stratum == h) & (dtfr.Domain == domain_p), var_x].sum()
-				
-			mean_x = sum_x / sum_a
-			
-			A = sum(dtfr.loc[indxs, var_y] * dtfr.loc[indxs, var_x])
-			B = mean_y * sum(dtfr.loc[(dtfr.Stratum == h) & (dtfr.Domain == domain_p), "Area"] * dtfr.loc[(dtfr.Stratum == h) & (dtfr.Domain == domain_p), var_x])
-			C =  mean_x * sum(dtfr.loc[(dtfr.Stratum == h) & (dtfr.Domain == domain), "Area"] * dtfr.loc[(dtfr.Stratum == h) & (dtfr.Domain == domain), var_y])
-			D = sum(dtfr.loc[dtfr.Stratum == h, "Area"] ** 2) * mean_y * mean_x
-			
-			num = A - B - C + D
-			den = dtfr.loc[dtfr.Stratum == h, "Area"].sum() ** 2
-			
-			covs[h] = (n_h ** 2 / (n_h - 1)) * (num / den)
-		
-		else:
-			covs[h] = 0.0
-			
-	return covs
+	sums = _strata_sums(dtfr, domain, domain_p, var_y, var_x)
+	n_h = sums.rows
+
+	mean_y = sums.sum_y.where(sums.rows_y > 0, 0.0) / sums.sum_a
+	mean_x = sums.sum_x.where(sums.rows_x > 0, 0.0) / sums.sum_a
+
+	num = sums.A - mean_y * sums.B - mean_x * sums.C + sums.sum_a2 * mean_y * mean_x
+	den = sums.sum_a ** 2
+
+	covs = ((n_h ** 2 / (n_h - 1)) * (num / den)).where(n_h > 1, 0.0)
+
+	return covs.to_dict()
+
+
+def _strata_cov_terms(dtfr, domain, domain_p, var_y, var_x, myareas):
+	"""
+	Terminos por estrato de las covarianzas con doble muestreo: numero de
+	filas, y diferencias entre las medias del estrato y las del dominio.
+	"""
+	sums = _strata_sums(dtfr, domain, domain_p, var_y, var_x)
+	mean_y = domain_mean(dtfr, domain, var_y, myareas)
+	mean_x = domain_mean(dtfr, domain_p, var_x, myareas)
+	mean_hy = sums.sum_y.where(sums.rows_y > 0, 0.0) / sums.sum_a
+	mean_hx = sums.sum_x.where(sums.rows_x > 0, 0.0) / sums.sum_a
+
+	return sums.rows, (mean_hy - mean_y) * (mean_hx - mean_x)
 
 
 def cov_simple_stratified(dtfr, domain, domain_p,  var_y, var_x, strata_weights, myareas ):
 	tcov = 0.0
 	covs = cov_strata(dtfr, domain, domain_p,  var_y, var_x )
-	
+	rows = dtfr.Stratum.value_counts()
+
 	for h in strata_weights:
-		
-		if dtfr[dtfr.Stratum == h].shape[0] > 0:
-			tcov_h = strata_weights[h] ** 2 * covs[h] / dtfr[dtfr.Stratum == h].shape[0]
-		else:
-			tcov_h = 0.0
-		
-		tcov += tcov_h
-		
+		if h in rows.index:
+			tcov += strata_weights[h] ** 2 * covs[h] / rows[h]
+
 	# In Chip's formula the sum of the areas is not exponentiated
 	tcov *= sum(myareas.values()) ** 2
-	
+
 	return tcov
-	
-	
+
+
 def cov_simple_post_stratified(dtfr, domain, domain_p,  var_y, var_x, strata_weights, myareas ):
 	tcov = 0.0
 	covs = cov_strata(dtfr, domain, domain_p,  var_y, var_x )
-	
+	n = float(dtfr.shape[0])
+
 	for h in strata_weights:
-		if dtfr[dtfr.Stratum == h].shape[0] > 0:
-			tcov_h = (1 / float(dtfr.shape[0])) * ((strata_weights[h] * covs[h]) + ((1 - strata_weights[h]) * covs[h] / float(dtfr.shape[0])))
-		else:
-			tcov_h = 0.0
-			
-		tcov += tcov_h
-		
+		if h in covs:
+			tcov += (1 / n) * ((strata_weights[h] * covs[h]) + ((1 - strata_weights[h]) * covs[h] / n))
+
 	# In Chip's formula the sum of the areas is not exponentiated
 	tcov *= sum(myareas.values()) ** 2
-	
+
 	return tcov
-	
+
 
 def cov_double_stratified(dtfr, domain, domain_p,  var_y, var_x, strata_weights, myareas, map_strata_points):
 	tcov = 0.0
 	covs = cov_strata(dtfr, domain, domain_p,  var_y, var_x )
-	tot_points = float(sum(map_strata_points.values()))	
-	mean_y = domain_mean(dtfr, domain, var_y, myareas)	
-	mean_x = domain_mean(dtfr, domain_p, var_x, myareas)
-	
+	tot_points = float(sum(map_strata_points.values()))
+	n_h, dev = _strata_cov_terms(dtfr, domain, domain_p, var_y, var_x, myareas)
+
 	for h in strata_weights:
-		if dtfr[dtfr.Stratum == h].shape[0] > 0:
-			n_h = float(dtfr[dtfr.Stratum == h].shape[0])
-			
-			sum_y = 0.0
-			if dtfr[(dtfr.Stratum == h) & (dtfr.Domain == domain)].shape[0] > 0:
-				sum_y = dtfr.loc[(dtfr.Stratum == h) & (dtfr.Domain == domain), var_y].sum()
-				
-			sum_a = dtfr.loc[(dtfr.Stratum == h), "Area"].sum()
-			mean_hy = sum_y / sum_a
-			
-			sum_x = 0.0
-			if dtfr[(dtfr.Stratum == h) & (dtfr.Domain == domain_p)].shape[0] > 0:
-				sum_x = dtfr.loc[(dtfr.Stratum == h) & (dtfr.Domain == domain_p), var_x].sum()
-				
-			mean_hx = sum_x / sum_a
+		if h in covs:
+			tcov += strata_weights[h] * (map_strata_points[h] - 1) / (tot_points - 1) * covs[h] / n_h[h]
+			tcov += 1 / (tot_points - 1) * strata_weights[h] * dev[h]
 
-			tcov_h = strata_weights[h] * (map_strata_points[h] - 1) / (tot_points - 1) * covs[h] / n_h
-			tcov += 1 / (tot_points - 1) * strata_weights[h] * (mean_hy - mean_y) * (mean_hx - mean_x)
-		else:
-			tcov_h = 0.0
-			
-		tcov += tcov_h
-		
 	tcov *= sum(myareas.values()) ** 2
-	
+
 	return tcov
-	
-	
+
+
 def cov_double_post_stratified(dtfr, domain, domain_p,  var_y, var_x, strata_weights, myareas, map_strata_points):
 	tcov = 0.0
 	covs = cov_strata(dtfr, domain, domain_p,  var_y, var_x )
 	tot_points = float(sum(map_strata_points.values()))
-	mean_y = domain_mean(dtfr, domain, var_y, myareas)
-	mean_x = domain_mean(dtfr, domain_p, var_x, myareas)
-	
-	for h in strata_weights:
-		if dtfr[dtfr.Stratum == h].shape[0] > 0:
-			n_h = float(dtfr[dtfr.Stratum == h].shape[0])
-			
-			sum_y = 0.0
-			if dtfr[(dtfr.Stratum == h) & (dtfr.Domain == domain)].shape[0] > 0:
-				sum_y = dtfr.loc[(dtfr.Stratum == h) & (dtfr.Domain == domain), var_y].sum()
-				
-			sum_a = dtfr.loc[(dtfr.Stratum == h), "Area"].sum()
-			mean_hy = sum_y / sum_a
-			
-			sum_x = 0.0
-			if dtfr[(dtfr.Stratum == h) & (dtfr.Domain == domain_p)].shape[0] > 0:
-				sum_x = dtfr.loc[(dtfr.Stratum == h) & (dtfr.Domain == domain_p), var_x].sum()
-				
-			mean_hx = sum_x / sum_a
-			l = (map_strata_points[h] - 1) / (tot_points - 1) * covs[h] / float(dtfr.shape[0])
-			c = (1 - strata_weights[h]) *  covs[h] / float(dtfr.shape[0]) ** 2
-			r = 1 / (tot_points - 1) * strata_weights[h] * (mean_hy - mean_y) * (mean_hx - mean_x)
-			tcov_h = l + c + r
+	n = float(dtfr.shape[0])
+	n_h, dev = _strata_cov_terms(dtfr, domain, domain_p, var_y, var_x, myareas)
 
-		else:
-			tcov_h = 0.0
+	for h in strata_weights:
+		if h in covs:
+			l = (map_strata_points[h] - 1) / (tot_points - 1) * covs[h] / n
+			c = (1 - strata_weights[h]) *  covs[h] / n ** 2
+			r = 1 / (tot_points - 1) * strata_weights[h] * dev[h]
+			tcov += l + c + r
 
-		print tcov_h
-		tcov += tcov_h
-		
 	tcov *= sum(myareas.values()) ** 2
-	
+
 	return tcov
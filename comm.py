@@ -3,6 +3,9 @@ import numpy as np
 import allometry
 import wood_density as wd
 
+# Default lower limits (cm) of diameter classes in structural summaries
+diameter_class_limits = [0, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100]
+
 class Plot(object):
 	"""
 	Main data structure for tree ecological data.
@@ -68,6 +71,8 @@ class Plot(object):
 			
 			self.basal_area = None
 			self.basal_area_sps = {}
+			self.structure = None # Structural metrics per subplot and size class
+			self.diameter_distribution = None # Stems / ha per diameter class
 
 			self.alvarez_d = 0.0 # Tons / ha
 			self.alvarez_d_sps = {}
@@ -79,6 +84,7 @@ class Plot(object):
 			self.chave_ii_d_sps = {}
 			self.chave_ii_dh = 0.0 # Tons / ha
 			self.chave_ii_dh_sps = {}
+			self.montecarlo = None # Simulated biomass (Kg/ha) by uncertainty source
 			# optional fields
 			fields = ['Diameter','Height','TaxonID']
 
@@ -251,20 +257,9 @@ class Plot(object):
 		Fill wood density missing entries with the average (by stem frequency)
 		wood density in the plot.
 		"""
-		avewd = 0.0
-		avecount = 0
-
-		for tree in self.stems.itertuples():
-
-			thisdens = self.taxa.loc[self.taxa.TaxonID == tree.TaxonID, 'Density'].item()
-			if pd.notna(thisdens):
-				avewd += thisdens
-				avecount += 1
+		avewd = self.stems.TaxonID.map(self.taxa.set_index('TaxonID').Density).mean()
 
-		if avecount > 0:
-			avewd /= avecount
-
-		if avewd == 0:
+		if pd.isna(avewd) or avewd == 0:
 			raise ValueError("Plot average density is zero")
 
 		self.taxa.loc[self.taxa.Density.isna(), 'Density'] = avewd
@@ -272,20 +267,24 @@ class Plot(object):
 		return None
 
 
-	def densities_from_file(self, densities_file):
+	def densities_from_file(self, densities_file, binary = False):
 		"""
 		Retrieve wood density from a csv table. If especies or genus is not
 		included in the table, the average of the genus or famly is assigned,
-		respectively.
+		respectively. The table is parsed once per process (see
+		wood_density.load_data).
+
+		Arguments:
+
+		- densities_file (str): Path to the wood density csv table.
+
+		- binary (bool): Use the binary copy of the table.
 		"""
 		self.taxa['Density'] = np.nan
 
-		dens = wd.load_data(densities_file)
-
-		def density_updated(row):
-			return wd.get_density(row.Family, row.Genus, row.Epithet, dens)
+		dens = wd.load_data(densities_file, binary)
 
-		self.taxa['Density'] = self.taxa.apply(density_updated, axis = 1)
+		self.taxa['Density'] = wd.get_densities(self.taxa, dens)
 
 		self.miss_densi()
 
@@ -314,31 +313,34 @@ class Plot(object):
 		return num
 
 
-	def biomass(self, method = 'deterministic', equations = ['Chave_II_d'], per_subplot = False):
+	def biomass(self, method = 'deterministic', equations = ['Chave_II_d'], per_subplot = False,
+		structure = False, iters = 100, path_sims = 1000, coefficients = None,
+		random_state = None):
 		"""
 		Estimates biomass (ton/ha) from plant community data.
 
 		Arguments:
 
-		- method (string): Method to be employed in calculations.
+		- method (string): Method to be employed in calculations: 'deterministic'
+		or 'montecarlo'. The later propagates diameter, wood density and allometric
+		errors of the Chave II equation and stores the simulated plot biomass in
+		`self.montecarlo` (see `allometry.chaveII_montecarlo`).
+
+		- structure (bool): Estimate structural metrics (see `estimate_structure`)
+		from the same stem table.
+
+		- iters, path_sims, coefficients, random_state: Monte Carlo settings, see
+		`allometry.chaveII_montecarlo`.
 		"""
-		palmid = []
-		fernid = []
 		if self.det_stems() <= 0:
 			raise ValueError("No stems have density values available.")
-		
-		if 'Arecaceae' in self.taxa.Family.unique():	
-			palmid.append(self.taxa.loc[self.taxa.Family == 'Arecaceae', 'TaxonID'].iloc[0].item())
-		
-		if 'Cyatheaceae' in self.taxa.Family.unique():
-			fernid.append(self.taxa.loc[self.taxa.Family == 'Cyatheaceae', 'TaxonID'][0].item())
-		elif 'Dicksoniaceae' in self.taxa.Family.unique():
-			fernid.append(self.taxa.loc[self.taxa.Family == 'Dicksoniaceae', 'TaxonID'][0].item())
-		elif 'Metaxyaceae' in self.taxa.Family.unique():
-			fernid.append(self.taxa.loc[self.taxa.Family == 'Metaxyaceae', 'TaxonID'][0].item())
-		elif 'Cibotiaceae' in self.taxa.Family.unique():
-			fernid.append(self.taxa.loc[self.taxa.Family == 'Cibotiaceae', 'TaxonID'][0].item())
-			
+
+		# Palms and arborescent ferns are estimated from height in dh equations
+		palms = self.stems.TaxonID.isin(self.taxa.loc[self.taxa.Family == 'Arecaceae',
+			'TaxonID']).values
+		ferns = self.stems.TaxonID.isin(self.taxa.loc[self.taxa.Family.isin(['Cyatheaceae',
+			'Dicksoniaceae', 'Metaxyaceae', 'Cibotiaceae']), 'TaxonID']).values
+
 		if method == 'deterministic':
 			self.alvarez_d = 0.0 # Tons / ha
 			self.alvarez_dh = 0.0 # Tons / ha
@@ -346,111 +348,217 @@ class Plot(object):
 			self.chave_ii_d = 0.0 # Tons / ha
 			self.chave_ii_dh = 0.0 # Tons / ha
 
-			for tree in self.stems.itertuples():
-				
-				# Move this check to __init__
-				if tree.Diameter <= 0:
-					if u'StemID' in self.stems.columns:
-						print "Stem {0} (StemID) has illegal diameter.".format(tree.StemID)
-					else:
-						print "Stem {0} (row in self.stems) has illegal diameter.".format(tree.name)
-
-				dens = self.taxa.loc[self.taxa.TaxonID == tree.TaxonID, 'Density'].item()
-
-				#na = self.name
-				area = 0
-				if self.size_area:
-					area = self.size_area[tree.Size]
-				elif self.area:
-					area = self.area
+			# Move this check to __init__
+			for tree in self.stems[self.stems.Diameter <= 0].itertuples():
+				if u'StemID' in self.stems.columns:
+					print "Stem {0} (StemID) has illegal diameter.".format(tree.StemID)
 				else:
-					raise ValueError("Plot area has not been set.")
-
-				#try:
-				if 'Alvarez_d' in equations and pd.notna(tree.Diameter):
-					ta = allometry.alvarez(tree.Diameter, dens, self.holdridge) / area
-					
-					if 'Subplot' in self.stems.columns:
-						self.alvarez_d_sps[tree.Subplot] += ta
-					else:
-						self.alvarez_d += ta
-
-				if 'Alvarez_dh' in equations and pd.notna(tree.Diameter) and pd.notna(tree.Height):
-					if tree.TaxonID in palmid:
-						ta = allometry.palm(tree.Height) / area
-					elif tree.TaxonID in fernid:
-						ta = allometry.fern(tree.Height) / area
-					else:
-						ta = allometry.alvarez_dh(tree.Diameter, tree.Height, dens, self.holdridge) / area
-					
-					if 'Subplot' in self.stems.columns:
-						self.alvarez_dh_sps[tree.Subplot] += ta
-					else:
-						self.alvarez_dh += ta
-
-				if 'Chave_II_d' in equations and pd.notna(tree.Diameter):
-					ci = allometry.chaveII(tree.Diameter, dens, e_value = float(self.E)) / area
-					if 'Subplot' in self.stems.columns:
-						self.chave_ii_d_sps[tree.Subplot] += ci
-					else:
-						self.chave_ii_d += ci
-
-				if 'Chave_II_dh' in equations and pd.notna(tree.Diameter) and pd.notna(tree.Height):
-					if tree.TaxonID in palmid:
-						cii = allometry.palm(tree.Height) / area
-					elif tree.TaxonID in fernid:
-						cii = allometry.fern(tree.Height) / area
-					else:
-						cii = allometry.chaveII_dh(tree.Diameter, tree.Height, dens) / area
-					
-					if 'Subplot' in self.stems.columns:
-						self.chave_ii_dh_sps[tree.Subplot] += cii
-					else:
-						self.chave_ii_dh += cii
-
-				if 'Chave_I' in equations and pd.notna(tree.Diameter):
-					ci = allometry.chaveI(tree.Diameter, dens, self.chave_forest) / area
-					if 'Subplot' in self.stems.columns:
-						self.chave_i_sps[tree.Subplot] += ci
-					else:
-						self.chave_i += ci
-
-				"""
-				except:
-					if u'StemID' in self.stems.columns:
-						print "Plot: {0}, StemID: {1}, TaxonID: {2}, Diameter: {3}, Density: {4}, E: {5}".format(self.name, tree.StemID, tree.TaxonID, tree.Diameter, dens, self.E)
-					else:
-						print "Plot: {0}, Stems row: {1}, TaxonID: {2}, Diameter: {3}, Density: {4}, E: {5}".format(self.name, tree.Index, tree.TaxonID, tree.Diameter, dens, self.E)
-				"""
-			if len(self.alvarez_dh_sps) > 1:
-				self.alvarez_d = sum(self.alvarez_d_sps.values())
-				self.alvarez_dh = sum(self.alvarez_dh_sps.values())
-				self.chave_i = sum(self.chave_i_sps.values())
-				self.chave_ii_d = sum(self.chave_ii_d_sps.values())
-				self.chave_ii_dh = sum(self.chave_ii_dh_sps.values())
-			
+					print "Stem {0} (row in self.stems) has illegal diameter.".format(tree.Index)
+
+			table = self._stem_table()
+			diameter = table.Diameter.values
+			height = table.Height.values
+			dens = table.Density.values
+			area = table.Area.values
+
+			if 'Chave_II_d' in equations and self.E is None:
+				raise ValueError("E value has not been set.")
+
+			# Shared log terms are computed once for all equations
+			features = allometry.stem_features(diameter, dens, height, self.E)
+			agbs = allometry.biomass_equations(equations, features,
+				{'holdridge': self.holdridge, 'chave': self.chave_forest})
+
+			for i, eq in enumerate(equations):
+				agb = agbs[:, i]
+
+				if eq.endswith('_dh'):
+					agb[palms] = allometry.palm_tiepolo(height[palms])
+					agb[ferns] = allometry.fern(height[ferns])
+					agb[np.isnan(diameter) | np.isnan(height)] = np.nan
+
+				self._add_biomass(eq, agb / area, table)
+
+			if structure:
+				self.estimate_structure(table = table)
+
+		elif method == 'montecarlo':
+			if self.E is None:
+				raise ValueError("E value has not been set.")
+
+			table = self._stem_table()
+			self.montecarlo = allometry.chaveII_montecarlo(table.Diameter.values,
+				table.Density.values, self.E, table.Area.values, coefficients, iters,
+				path_sims, random_state)
+
+			if structure:
+				self.estimate_structure(table = table)
+
+		else:
+			raise ValueError("Unknown biomass method {0}.".format(method))
+
+		return None
+
+
+	def _stem_table(self):
+		"""
+		Columnar view of the stems for plot level computations: diameter, height,
+		wood density, effective sampled area (ha) and subplot code (-1 if the plot
+		has no subplots) of every stem. Returns a pd.DataFrame aligned with
+		self.stems.
+		"""
+		table = pd.DataFrame({'Diameter': self.stems.Diameter.astype(float),
+			'Height': self.stems.Height.astype(float)}, index = self.stems.index)
+
+		table['Density'] = np.nan
+		if 'Density' in self.taxa.columns:
+			table['Density'] = self.stems.TaxonID.map(self.taxa.set_index('TaxonID').Density).astype(float)
+
+		if self.size_area:
+			table['Area'] = self.stems.Size.map(self.size_area).astype(float)
+		elif self.area:
+			table['Area'] = float(self.area)
+		else:
+			raise ValueError("Plot area has not been set.")
+
+		table['SubplotCode'] = -1
+		if 'Subplot' in self.stems.columns:
+			table['SubplotCode'] = pd.factorize(self.stems.Subplot, sort = True)[0]
+
+		return table
+
+
+	def _subplot_sums(self, values, table):
+		"""
+		Sums per stem values by subplot, ignoring missing values. Returns a dict
+		(subplot: sum).
+		"""
+		labels = np.sort(self.stems.Subplot.dropna().unique())
+		codes = table.SubplotCode.values
+		ok = codes >= 0
+		sums = np.bincount(codes[ok], weights = np.nan_to_num(values[ok]), minlength = labels.shape[0])
+
+		return dict(zip(labels, sums))
+
+
+	def _add_biomass(self, equation, agb, table):
+		"""
+		Stores per stem biomass (ton/ha) as the plot and subplot totals of an
+		equation.
+		"""
+		attr = {'Alvarez_d': 'alvarez_d', 'Alvarez_dh': 'alvarez_dh', 'Chave_I': 'chave_i',
+			'Chave_II_d': 'chave_ii_d', 'Chave_II_dh': 'chave_ii_dh'}.get(equation)
+
+		if attr is None:
+			raise ValueError("Plot does not store biomass of equation {0}.".format(equation))
+
+		self._store_sums(attr, agb, table)
+
+		return None
+
+
+	def _store_sums(self, attr, values, table):
+		"""
+		Stores per stem values as the plot total (`attr`) and subplot totals
+		(`attr`_sps) of a plot attribute.
+		"""
+		if 'Subplot' in self.stems.columns:
+			sps = getattr(self, attr + '_sps')
+			for c in sps:
+				sps[c] = 0.0
+			sps.update(self._subplot_sums(values, table))
+			setattr(self, attr, sum(sps.values()))
+
+		else:
+			setattr(self, attr, np.nansum(values))
+
 		return None
 
 
 	def estimate_basal_area(self):
+		"""
+		Estimates basal area (cm2/ha) of the plot and its subplots.
+		"""
+		table = self._stem_table()
+		ba = ((table.Diameter.values / 2.0) ** 2) * np.pi / table.Area.values
+		self._store_sums('basal_area', ba, table)
 
-		self.basal_area = 0.0
-		
-		for tree in self.stems.itertuples():
-			if pd.notna(tree.Diameter):
-				area = 0
-				if self.size_area:
-					area = self.size_area[tree.Size]
-				elif self.area:
-					area = self.area
-				else:
-					raise ValueError("Plot area has not been set.")
+		return None
 
-				tba = (((tree.Diameter / 2.0) ** 2) * np.pi) / area
-				if 'Subplot' in self.stems.columns:
-					self.basal_area_sps[tree.Subplot] += tba
-				else:
-					self.basal_area += tba
+
+	def estimate_structure(self, diameter_classes = None, table = None):
+		"""
+		Estimates stand structure by subplot and size class: basal area (cm2/ha),
+		stem density (stems/ha), quadratic mean diameter (cm) and stem density per
+		diameter class (stems/ha). Results are stored in `self.structure` and
+		`self.diameter_distribution` (pd.DataFrames indexed by subplot and size
+		code), plot and subplot basal area are updated as well.
+
+		Arguments:
+
+		- diameter_classes (list): Lower limits (cm) of the diameter classes. Stems
+		smaller than the first limit are not included in the distribution. Default
+		are 10 cm classes starting at 0.
+
+		- table (pd.DataFrame): Stem table as returned by `self._stem_table`.
+		"""
+		if table is None:
+			table = self._stem_table()
+
+		if diameter_classes is None:
+			diameter_classes = diameter_class_limits
+
+		limits = np.asarray(diameter_classes, dtype = float)
+
+		# Every stem is assigned a group code out of its subplot and size class
+		keys = []
+		if 'Subplot' in self.stems.columns:
+			keys.append('Subplot')
+		if self.size_area:
+			keys.append('Size')
+
+		ok = table.Diameter.notna().values & self.stems[keys].notna().all(axis = 1).values
+		diameter = table.Diameter.values[ok]
+		weight = 1.0 / table.Area.values[ok] # Stems per hectare
+
+		if keys:
+			factors = [pd.factorize(self.stems[k].values[ok], sort = True) for k in keys]
+			combined = np.ravel_multi_index([f[0] for f in factors],
+				[max(f[1].shape[0], 1) for f in factors])
+			combined, group = np.unique(combined, return_inverse = True)
+			levels = np.unravel_index(combined, [max(f[1].shape[0], 1) for f in factors])
+			if len(keys) > 1:
+				index = pd.MultiIndex.from_arrays([f[1][l] for f, l in zip(factors, levels)],
+					names = keys)
+			else:
+				index = pd.Index(factors[0][1][levels[0]], name = keys[0])
+		else:
+			group = np.zeros(diameter.shape[0], dtype = int)
+			index = pd.Index([self.name], name = 'Plot')
+
+		ngroups = index.shape[0]
+		stems = np.bincount(group, weights = weight, minlength = ngroups)
+		basal = np.bincount(group, weights = weight * ((diameter / 2.0) ** 2) * np.pi,
+			minlength = ngroups)
+		squares = np.bincount(group, weights = weight * diameter ** 2, minlength = ngroups)
+
+		with np.errstate(invalid = 'ignore', divide = 'ignore'):
+			qmd = np.sqrt(squares / stems)
+
+		self.structure = pd.DataFrame({'BasalArea': basal, 'StemDensity': stems,
+			'QMD': qmd}, index = index, columns = ['BasalArea', 'StemDensity', 'QMD'])
+
+		classes = np.digitize(diameter, limits) - 1
+		inclass = classes >= 0
+		hist = np.bincount(group[inclass] * limits.shape[0] + classes[inclass],
+			weights = weight[inclass], minlength = ngroups * limits.shape[0])
+
+		self.diameter_distribution = pd.DataFrame(hist.reshape(ngroups, limits.shape[0]),
+			index = index, columns = limits)
+
+		ba = np.zeros(table.shape[0])
+		ba[ok] = weight * ((diameter / 2.0) ** 2) * np.pi
+		self._store_sums('basal_area', ba, table)
 
 		return None
 			
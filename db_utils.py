@@ -1,27 +1,118 @@
 import pandas as pd
+import numpy as np
 #import sqlalchemy as al
 import pyproj
 
+# WGS 84 zone 18 N projection, empleada en las coordenadas de Quimera
+utm18n = '+proj=utm +zone=18 +ellps=WGS84 +datum=WGS84 +units=m +no_defs'
+
+# Transformaciones creadas: (proyeccion origen, proyeccion destino) -> funcion
+_transformers = {}
+
+
+def transformer(source = utm18n, target = 'epsg:4326'):
+	"""
+	Produce (una sola vez por proceso) una funcion que reproyecta arrays de
+	coordenadas x, y de la proyeccion `source` a `target`. La funcion retorna la
+	tupla (x, y) de numpy.arrays; en proyecciones geograficas x es la longitud.
+
+	Argumentos:
+
+	- source (str): Proyeccion de origen (proj4 o 'epsg:<codigo>').
+
+	- target (str): Proyeccion de destino (proj4 o 'epsg:<codigo>').
+	"""
+	key = (source, target)
+
+	if key not in _transformers:
+		if hasattr(pyproj, 'Transformer'):
+			trans = pyproj.Transformer.from_crs(source, target, always_xy = True)
+
+			def reproject(x, y):
+				return trans.transform(np.asarray(x, dtype = float), np.asarray(y, dtype = float))
+
+		else:
+			inpr, outpr = [pyproj.Proj(init = p) if p.startswith('epsg:') else pyproj.Proj(p)
+				for p in (source, target)]
+
+			def reproject(x, y):
+				return pyproj.transform(inpr, outpr, np.asarray(x, dtype = float),
+					np.asarray(y, dtype = float))
+
+		_transformers[key] = reproject
+
+	return _transformers[key]
+
+
+def to_wgs84(x, y, source = utm18n):
+	"""
+	Reproyecta arrays de coordenadas a WGS 84. Retorna la tupla (longitud, latitud).
+	"""
+	return transformer(source, 'epsg:4326')(x, y)
+
+
+def resolve_synonyms(taxon_ids, parents):
+	"""
+	Resuelve el nombre aceptado de cada taxon siguiendo las cadenas de sinonimia
+	(TaxonID -> SinonimoDe) por saltos de punteros. Retorna un numpy.array con el
+	TaxonID aceptado de cada taxon. Genera ValueError si alguna cadena apunta a
+	un taxon inexistente o forma un ciclo (incluyendo autoreferencias).
+
+	Argumentos:
+
+	- taxon_ids (array): TaxonID de cada taxon.
+
+	- parents (array): SinonimoDe de cada taxon (NaN o None si es aceptado).
+	"""
+	ids = np.asarray(taxon_ids).astype(np.int64)
+	parents = pd.Series(parents, dtype = float).values
+	accepted = np.isnan(parents)
+
+	ptr = pd.Index(ids).get_indexer(np.where(accepted, ids, parents))
+
+	dangling = ptr < 0
+	if dangling.any():
+		raise ValueError("Taxa {0} are synonyms of non existing taxa.".format(ids[dangling].tolist()))
+
+	for i in range(ids.shape[0].bit_length() + 1):
+		nxt = ptr[ptr]
+		if (nxt == ptr).all():
+			break
+		ptr = nxt
+
+	cyclic = ~accepted[ptr]
+	if cyclic.any():
+		raise ValueError("Taxa {0} are part of synonymy cycles.".format(ids[cyclic].tolist()))
+
+	return ids[ptr]
+
+
+def acctax_table(tax):
+	"""
+	Produce un Pandas.DataFrame (indice TaxonID) con el nombre aceptado de cada
+	taxon de la tabla Taxonomia: TaxonDef, Family, Genus y Epithet.
+
+	Argumentos:
+
+	- tax (pd.DataFrame): Tabla Taxonomia.
+	"""
+	taxdef = resolve_synonyms(tax.TaxonID.values, tax.SinonimoDe.values)
+
+	out = tax.set_index(tax.TaxonID.astype(np.int64)).loc[taxdef, ['Familia', 'Genero', 'Epiteto']]
+	out.columns = ['Family', 'Genus', 'Epithet']
+	out.index = pd.Index(tax.TaxonID.astype(np.int64).values, name = 'TaxonID')
+	out.insert(0, 'TaxonDef', taxdef)
+
+	return out
+
 
 def acctax(connection):
 	"""Adquiere listado de taxa acceptados de la tabla Taxonomia."""
 
 	tax = pd.read_sql_table(table_name='Taxonomia', con = connection)
-	acc = {}
-
-	for t in tax.itertuples():
-		tax_accepted = int(t.TaxonID)
-		dad = t.SinonimoDe
-		while pd.notna(dad):
-			tax_accepted = int(dad)
-			dad = tax[tax.TaxonID == tax_accepted]['SinonimoDe'].item()
-		#tax.loc[tax.TaxonID == t.TaxonID, 'TaxonDef' ] = tax_accepted
-		fam = tax[tax.TaxonID == tax_accepted]['Familia'].item()
-		gen = tax[tax.TaxonID == tax_accepted]['Genero'].item()
-		epi = tax[tax.TaxonID == tax_accepted]['Epiteto'].item()
-		acc[int(t.TaxonID)] = [fam, gen, epi]
-		
-	return acc
+	acc = acctax_table(tax)
+
+	return dict(zip(acc.index.tolist(), acc[['Family', 'Genus', 'Epithet']].values.tolist()))
 
 def dasotab(database, connection, plot, accepted_taxa = False):
 	"""
@@ -68,15 +159,11 @@ def coords(database, connection, plot, subplot = None):
 	
 	if database == 'Quimera':
 
-		# WGS 84 zone 18 N projection
-		inpr = pyproj.Proj('+proj=utm +zone=18 +ellps=WGS84 +datum=WGS84 +units=m +no_defs')
-		# WGS 84 projection
-		outpr = pyproj.Proj(init='epsg:4326')
-		
 		query = 'SELECT X,Y FROM Parcelas WHERE PlotID = {0}'.format(plot)
 		point = pd.read_sql_query(sql = query, con = connection)
 
-		mycoords = pyproj.transform(inpr, outpr, point.X[0], point.Y[0])
+		lon, lat = to_wgs84(point.X.values[:1], point.Y.values[:1])
+		mycoords = lon[0], lat[0]
 
 	elif database == 'IFN':
 
@@ -88,3 +175,71 @@ def coords(database, connection, plot, subplot = None):
 
 	return mycoords
 	
+
+def bulk_load(database, connection, accepted_taxa = True):
+	"""
+	Adquiere los datos dasometricos, taxonomicos y las coordenadas de todas las
+	parcelas de una base de datos ('Quimera' o 'IFN') con una consulta por tabla.
+	Retorna una tupla de Pandas.DataFrame:
+
+	- stems: un registro por fuste con columnas Plot, TaxonID, TreeID, Family,
+	Genus, Epithet, Diameter, Height y, en IFN, StemID, Size y Subplot.
+
+	- plots: indice PlotID con columnas Longitud, Latitud y, en Quimera, Area.
+
+	Argumentos:
+
+	- accepted_taxa (bool): Emplear el nombre aceptado de cada taxon.
+	"""
+	stems_query = ''
+	
+	if database == 'Quimera':
+		stems_query = 'SELECT Plot, Taxon AS TaxonID, IndividuoID AS TreeID, Diametro AS Diameter, Altura AS Height FROM Individuos LEFT JOIN Determinaciones ON Dets=DetID'
+		
+	elif database == 'IFN':
+		stems_query = "SELECT PlotID AS Plot, Taxon AS TaxonID, IndividuoID AS TreeID, DiametroP AS Diameter, AlturaTotal AS Height, TalloID AS StemID, Tamano AS Size, Subparcela as Subplot FROM Tallos LEFT JOIN Individuos ON Individuo = IndividuoID LEFT JOIN Determinaciones ON Dets = DetID LEFT JOIN Conglomerados on Plot = PlotID WHERE Dets IS NOT NULL AND Tamano IN ('L', 'F', 'FG')"
+
+	else:
+		raise ValueError("Unknown database {0}.".format(database))
+
+	stems = pd.read_sql_query(sql = stems_query, con = connection)
+	tax = pd.read_sql_table(table_name='Taxonomia', con = connection)
+
+	if accepted_taxa:
+		names = acctax_table(tax)[['Family', 'Genus', 'Epithet']]
+	else:
+		names = tax.set_index(tax.TaxonID.astype(np.int64))[['Familia', 'Genero', 'Epiteto']]
+		names.columns = ['Family', 'Genus', 'Epithet']
+
+	names = names.reindex(stems.TaxonID.values)
+	for col in names.columns:
+		stems[col] = names[col].values
+
+	if database == 'Quimera':
+		plots = pd.read_sql_query(sql = 'SELECT PlotID, X, Y, Area FROM Parcelas', con = connection)
+		plots['Longitud'], plots['Latitud'] = to_wgs84(plots.X.values, plots.Y.values)
+		plots = plots.set_index('PlotID')[['Longitud', 'Latitud', 'Area']]
+
+	else:
+		plots = pd.read_sql_query(sql = 'SELECT PlotID, Longitud, Latitud FROM Conglomerados LEFT JOIN Coordenadas ON Plot = PlotID WHERE SPF = 1', con = connection)
+		plots = plots.groupby('PlotID')[['Longitud', 'Latitud']].first()
+
+	return stems, plots
+
+
+def iter_plots(stems, columns = None):
+	"""
+	Itera sobre los fustes de cada parcela, en orden de PlotID. Produce tuplas
+	(PlotID, Pandas.DataFrame) listas para comm.Plot.
+
+	Argumentos:
+
+	- stems (pd.DataFrame): Tabla de fustes producida por db_utils.bulk_load.
+
+	- columns (list): Columnas a incluir (por defecto todas excepto Plot).
+	"""
+	if columns is None:
+		columns = [c for c in stems.columns if c != 'Plot']
+
+	for plot, frame in stems.groupby('Plot', sort = True):
+		yield plot, frame[columns].reset_index(drop = True)
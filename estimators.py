@@ -1,4 +1,6 @@
 import pandas as pd
+import numpy as np
+from multiprocessing.pool import ThreadPool
 from scipy.stats import t
 
 weights = {'Amazonia: Bosque': 0.3501,
@@ -37,12 +39,37 @@ areas = {'Amazonia: Bosque': 39927789,
 	'Pacifico: No-bosque': 1323911}
 
 
+def _propagated_sum(values, keys):
+	"""
+	Sums of `values` by `keys`, NaN if the group contains any missing value (as
+	the builtin `sum`).
+	"""
+	sums = values.groupby(keys, sort = False).sum()
+	sums[values.isna().groupby(keys, sort = False).any()] = np.nan
+
+	return sums
+
+
+def _lookup(table, key, column, default = 0.0):
+	"""
+	Value of a sufficient statistics table, `default` if the group is absent.
+	"""
+	try:
+		return table.at[key, column]
+	except KeyError:
+		return default
+
+
 class Estimator(object):
 
 	def __init__(self, dtfr, areas, weights):
 		"""
 		Dataframe mandatory columns: `Plot`, `Subplot`, `Stratum`, `Area`, and
 		`Domain`.
+
+		Estimates are computed from sufficient statistics of the dataframe, built
+		once per variable (see `strata_stats`, `variable_stats` and `cross_stats`).
+		If the dataframe is modified `clear_stats` should be called.
 		"""
 		if isinstance(dtfr, pd.DataFrame):
 			self.dtfr = dtfr
@@ -52,14 +79,113 @@ class Estimator(object):
 		self.s2 = None # Strata variances
 		self.map_points = None
 		self.covs = None
+		self.clear_stats()
 
 
-	def stratum_mean(self, stratum, domain, variable):
-		sum_y = 0.0
-		if self.dtfr[(self.dtfr.Stratum == stratum) & (self.dtfr.Domain == domain)].shape[0] > 0:
-			sum_y = self.dtfr.loc[(self.dtfr.Stratum == stratum) & (self.dtfr.Domain == domain), variable].sum()
+	def clear_stats(self):
+		"""
+		Drops the sufficient statistics computed so far.
+		"""
+		self._strata = None
+		self._n_plots = None
+		self._stats = {}
+		self._cross = {}
+
+		return None
+
+
+	def strata_stats(self):
+		"""
+		Per stratum sufficient statistics: sum (`sum_a`) and sum of squares
+		(`sum_a2`) of the areas, number of rows (`rows`) and of plots (`plots`).
+		Returns a pd.DataFrame indexed by stratum.
+		"""
+		if self._strata is None:
+			grp = self.dtfr.groupby('Stratum', sort = False)
+			self._strata = pd.DataFrame({'sum_a': grp.Area.sum(),
+				'sum_a2': _propagated_sum(self.dtfr.Area ** 2, self.dtfr.Stratum),
+				'rows': grp.size(),
+				'plots': grp.Plot.nunique(dropna = False)},
+				columns = ['sum_a', 'sum_a2', 'rows', 'plots'])
+			self._n_plots = len(self.dtfr.Plot.unique())
+
+		return self._strata
+
+
+	def n_plots(self):
+		"""
+		Number of plots in the sample.
+		"""
+		self.strata_stats()
+
+		return self._n_plots
+
+
+	def variable_stats(self, variable):
+		"""
+		Per stratum and domain sufficient statistics of a variable (y): number of
+		rows (`rows`), sum of y (`sum_y`, ignoring missing values), and sums of y
+		squared (`sum_y2`) and y times the area (`sum_ya`). Returns a pd.DataFrame
+		indexed by (stratum, domain).
+		"""
+		if variable not in self._stats:
+			keys = [self.dtfr.Stratum, self.dtfr.Domain]
+			y = self.dtfr[variable]
+			grp = y.groupby(keys, sort = False)
+			self._stats[variable] = pd.DataFrame({'rows': grp.size(),
+				'sum_y': grp.sum(),
+				'sum_y2': _propagated_sum(y ** 2, keys),
+				'sum_ya': _propagated_sum(y * self.dtfr.Area, keys)},
+				columns = ['rows', 'sum_y', 'sum_y2', 'sum_ya'])
+
+		return self._stats[variable]
+
+
+	def cross_stats(self, var_y, var_x):
+		"""
+		Per stratum and domain sums of the product of two variables. Returns a
+		pd.Series indexed by (stratum, domain).
+		"""
+		return self.cross_stats_many([(var_y, var_x)])[0]
+
+
+	def cross_stats_many(self, pairs):
+		"""
+		Per stratum and domain sums of the products of several pairs of variables
+		(var_y, var_x), computed with a single groupby. Returns a list of
+		pd.Series indexed by (stratum, domain).
+		"""
+		missing = []
+		for pair in pairs:
+			if pair not in self._cross and pair not in missing:
+				missing.append(pair)
+
+		if missing:
+			keys = [self.dtfr.Stratum, self.dtfr.Domain]
+			products = pd.DataFrame(dict((i, self.dtfr[y] * self.dtfr[x])
+				for i, (y, x) in enumerate(missing)), columns = range(len(missing)))
+			sums = _propagated_sum(products, keys)
+			for i, pair in enumerate(missing):
+				self._cross[pair] = sums[i]
+
+		return [self._cross[pair] for pair in pairs]
 
-		sum_a = self.dtfr.loc[(self.dtfr.Stratum == stratum), "Area"].sum()
+
+	def _stratum_sum(self, stratum, domain, variable, min_rows = 0):
+		"""
+		Sum of a variable in a stratum and domain, zero if the group has `min_rows`
+		rows or less.
+		"""
+		stats = self.variable_stats(variable)
+		if _lookup(stats, (stratum, domain), 'rows', 0) > min_rows:
+			return stats.at[(stratum, domain), 'sum_y']
+
+		return 0.0
+
+
+	def stratum_mean(self, stratum, domain, variable):
+		sum_y = self._stratum_sum(stratum, domain, variable)
+		sum_a = _lookup(self.strata_stats(), stratum, 'sum_a')
 		str_mean = sum_y / float(sum_a)
 		return str_mean
 
@@ -75,15 +201,20 @@ class Estimator(object):
 		return tot
 
 
+	def domain_sum(self, domain, variable):
+		"""
+		Sum of a variable over the plots of a domain.
+		"""
+		stats = self.variable_stats(variable)
+		return stats.loc[stats.index.get_level_values(1) == domain, 'sum_y'].sum()
+
+
 	def total(self, domain, variable):
-		#print ">>> In total <<<"
 		tot = 0.0
-		for h in self.dtfr.Stratum.unique():
+		for h in self.strata_stats().index:
 			str_mean = self.stratum_mean(h, domain, variable)
 			if pd.notna(str_mean):
-				#print ">>>",str_mean, self.areas[h], "<<<"
 				tot += str_mean * self.areas[h]
-		#print ">>>", tot, "<<<"
 		return tot
 
 
@@ -96,7 +227,8 @@ class Estimator(object):
 
 		for h in self.areas:
 
-			if self.dtfr[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain)].shape[0] > 0 and self.dtfr[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain_p)].shape[0] > 0:
+			if _lookup(self.variable_stats(var_y), (h, domain), 'rows', 0) > 0 and \
+				_lookup(self.variable_stats(var_x), (h, domain_p), 'rows', 0) > 0:
 
 				y = self.stratum_mean(h, domain, var_y) * self.areas[h]
 				x = self.stratum_mean(h, domain_p, var_x) * self.areas[h]
@@ -113,52 +245,51 @@ class Estimator(object):
 		return sum(self.areas.values()) ** 2 * sum(var_dict.values())
 
 
-	def get_strata_var(self, domain, variable):
-		#print ">>> In get_strata_var <<<"
-		self.s2 = {}
-		sum_y = 0.0
-		sum_a = 0.0
-		str_mean = 0.0
-
-		for h in self.dtfr.Stratum.unique():
-			self.s2[h] = 0.0
+	def strata_var(self, domain, variable):
+		"""
+		Variance of a variable within each stratum. Returns a dict (stratum:
+		variance).
+		"""
+		out = {}
+		strata = self.strata_stats()
+		stats = self.variable_stats(variable)
+
+		for h in strata.index:
 			# Sample size in stratum h
-			n_h = float(len(self.dtfr.loc[self.dtfr.Stratum == h, 'Plot'].unique()))
-			#n_h = float(self.dtfr[self.dtfr.Stratum == h].shape[0])
+			n_h = float(strata.at[h, 'plots'])
 
 			if n_h > 1:
 
 				fact = n_h ** 2 / (n_h - 1)
-				#print "fact", fact
 
-				A = sum(self.dtfr.loc[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain), variable] ** 2)
-				B = sum(self.dtfr.loc[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain), variable] * self.dtfr.loc[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain), 'Area'])
-				C = sum(self.dtfr.loc[(self.dtfr.Stratum == h), 'Area'] ** 2)
-				#print "1", A, B, C
+				A = _lookup(stats, (h, domain), 'sum_y2')
+				B = _lookup(stats, (h, domain), 'sum_ya')
+				C = strata.at[h, 'sum_a2']
 
-				sum_y = 0.0
-				if self.dtfr[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain)].shape[0] > 0:
-					sum_y = self.dtfr.loc[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain), variable].sum()
+				sum_y = self._stratum_sum(h, domain, variable)
 
-				sum_a = self.dtfr.loc[(self.dtfr.Stratum == h), "Area"].sum()
+				sum_a = strata.at[h, 'sum_a']
 				if pd.isna(sum_a) or sum_a == 0:
 					str_mean = 0.0
 				else:
 					str_mean = sum_y / float(sum_a)
-				#print "2", sum_y, sum_a, str_mean
 
 				num = A - 2 * str_mean * B + str_mean ** 2 * C
-				den = self.dtfr.loc[(self.dtfr.Stratum == h), 'Area'].sum() ** 2
+				den = sum_a ** 2
 
 				if den == 0:
-					self.s2[h] = 0.0
+					out[h] = 0.0
 				else:
-					self.s2[h] = fact * num / float(den)
-				#print "3", num, den, self.s2[h]
+					out[h] = fact * num / float(den)
 
 			else:
-				self.s2[h] = 0
-		#print "Strata vars:", self.s2
+				out[h] = 0
+
+		return out
+
+
+	def get_strata_var(self, domain, variable):
+		self.s2 = self.strata_var(domain, variable)
 
 		return None
 
@@ -166,16 +297,18 @@ class Estimator(object):
 	def stratified_mean_var(self, domain, variable, confidence = 0.95):
 		sv = {}
 		self.get_strata_var(domain, variable)
+		strata = self.strata_stats()
+		n_plots = self.n_plots()
 
 		for h in self.s2:
-			sv[h] = (self.weights[h] ** 2 * self.s2[h]) / len(self.dtfr.loc[self.dtfr.Stratum == h, 'Plot'].unique())
+			sv[h] = (self.weights[h] ** 2 * self.s2[h]) / strata.at[h, 'plots']
 
 		vartot = self.var_total(sv)
-		std_err = (vartot / len(self.dtfr.Plot.unique())) ** 0.5
-		mean = self.dtfr.loc[self.dtfr.Domain == domain, variable].sum() / float(len(self.dtfr.Plot.unique()))
+		std_err = (vartot / n_plots) ** 0.5
+		mean = self.domain_sum(domain, variable) / float(n_plots)
 		poptot = self.total(domain, variable)
-		rel_error = vartot ** 0.5 / self.total(domain, variable) * 100
-		conf_inter = t.interval(confidence, len(self.dtfr.Plot.unique()) - 1, poptot, std_err)
+		rel_error = vartot ** 0.5 / poptot * 100
+		conf_inter = t.interval(confidence, n_plots - 1, poptot, std_err)
 		out = {'Domain mean': mean,
 			'Population total': poptot,
 			'Strata variances': sv,
@@ -186,25 +319,23 @@ class Estimator(object):
 		return out
 
 	def post_stratified_mean_var(self, domain, variable, confidence = 0.95):
-		#print ">>> In post_stratified_mean_var <<<"
 		pv = {}
 		pt = {}
-		#print domain, variable
 		self.get_strata_var(domain, variable)
+		n_plots = self.n_plots()
 
 		for h in self.s2:
-			#print ">>> {0}, {1} <<<".format(self.weights[h], self.s2[h])
 			pv[h] = self.weights[h] * self.s2[h]
-			pv[h] += ((1 - self.weights[h]) * self.s2[h]) / len(self.dtfr.Plot.unique())
-			pv[h] /= len(self.dtfr.Plot.unique())
+			pv[h] += ((1 - self.weights[h]) * self.s2[h]) / n_plots
+			pv[h] /= n_plots
 			pt[h] = self.stratum_mean(h, domain, variable) * self.areas[h]
 
 		vartot = self.var_total(pv)
-		std_err = (vartot / len(self.dtfr.Plot.unique())) ** 0.5
-		mean = self.dtfr.loc[self.dtfr.Domain == domain, variable].sum() / float(len(self.dtfr.Plot.unique()))
+		std_err = (vartot / n_plots) ** 0.5
+		mean = self.domain_sum(domain, variable) / float(n_plots)
 		poptot = self.total(domain, variable) #sum(self.areas.values()) * mean
 		cv = vartot ** 0.5 / poptot * 100
-		conf_inter = t.interval(confidence, len(self.dtfr.Plot.unique()) - 1, poptot, std_err)
+		conf_inter = t.interval(confidence, n_plots - 1, poptot, std_err)
 		out = {'Domain mean': mean,
 			'Population total': poptot,
 			'Coefficient of variation' : cv,
@@ -219,10 +350,11 @@ class Estimator(object):
 	def double_stratified_mean_var(self, domain,  variable, confidence = 0.95):
 
 		self.get_strata_var(domain, variable)
+		strata = self.strata_stats()
+		n_rows = self.dtfr.shape[0]
 
 		N = float(sum(self.map_points.values()))
 		sv = {}
-		sm = {}
 		left = 0.0
 		right = 0.0
 
@@ -232,11 +364,8 @@ class Estimator(object):
 
 			sv[h] = 1.0 / (N - 1)
 
-			sum_y = 0.0
-			if self.dtfr[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain)].shape[0] > 1:
-				sum_y = self.dtfr.loc[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain), variable].sum()
-
-			sum_a = self.dtfr.loc[(self.dtfr.Stratum == h), "Area"].sum()
+			sum_y = self._stratum_sum(h, domain, variable, min_rows = 1)
+			sum_a = strata.at[h, 'sum_a']
 			str_mean = sum_y / float(sum_a)
 
 			right = self.weights[h] * (mean - str_mean) ** 2
@@ -244,7 +373,7 @@ class Estimator(object):
 			if self.map_points[h] > 0:
 
 				left = self.weights[h] * self.s2[h] * float(self.map_points[h] - 1) \
-					/ (float(self.dtfr[self.dtfr.Stratum == h].shape[0]) * (N - 1))
+					/ (float(strata.at[h, 'rows']) * (N - 1))
 
 			else:
 				left = 0.0
@@ -253,11 +382,11 @@ class Estimator(object):
 			sv[h] += left
 
 		vartot = self.var_total(sv)
-		std_err = (vartot / self.dtfr.shape[0]) ** 0.5
-		mean = self.dtfr.loc[self.dtfr.Domain == domain, variable].sum() / float(self.dtfr.shape[0])
+		std_err = (vartot / n_rows) ** 0.5
+		mean = self.domain_sum(domain, variable) / float(n_rows)
 		poptot = self.total(domain, variable) #sum(self.areas.values()) * mean
-		rel_error = vartot ** 0.5 / self.total(domain, variable) * 100
-		conf_inter = t.interval(confidence, self.dtfr.shape[0] - 1, poptot, std_err)
+		rel_error = vartot ** 0.5 / poptot * 100
+		conf_inter = t.interval(confidence, n_rows - 1, poptot, std_err)
 		out = {'Domain mean': mean,
 			'Population total': poptot,
 			'Strata variances': sv,
@@ -271,6 +400,8 @@ class Estimator(object):
 	def double_post_stratified_mean_var(self, domain,  variable, confidence = 0.95):
 
 		self.get_strata_var(domain, variable)
+		strata = self.strata_stats()
+		n_rows = self.dtfr.shape[0]
 		sv = {}
 
 		N = float(sum(self.map_points.values()))
@@ -283,18 +414,15 @@ class Estimator(object):
 			center = 0.0
 			right = 0.0
 
-			sum_y = 0.0
-			if self.dtfr[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain)].shape[0] > 1:
-				sum_y = self.dtfr.loc[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain), variable].sum()
-
-			sum_a = self.dtfr.loc[(self.dtfr.Stratum == h), "Area"].sum()
+			sum_y = self._stratum_sum(h, domain, variable, min_rows = 1)
+			sum_a = strata.at[h, 'sum_a']
 			str_mean = sum_y / sum_a
 
 			left = (self.map_points[h] - 1) * self.s2[h] \
-				/ ((N - 1) * float(self.dtfr.shape[0]))
+				/ ((N - 1) * float(n_rows))
 
 			center = (1 - self.weights[h]) * self.s2[h] \
-				/ self.dtfr.shape[0] ** 2
+				/ n_rows ** 2
 
 			right = (self.map_points[h] / N) * (mean - str_mean) ** 2
 
@@ -302,11 +430,11 @@ class Estimator(object):
 			sv[h] += left + center
 
 		vartot = self.var_total(sv)
-		std_err = (vartot / self.dtfr.shape[0]) ** 0.5
-		mean = self.dtfr.loc[self.dtfr.Domain == domain, variable].sum() / float(self.dtfr.shape[0])
+		std_err = (vartot / n_rows) ** 0.5
+		mean = self.domain_sum(domain, variable) / float(n_rows)
 		poptot = self.total(domain, variable) #sum(self.areas.values()) * mean
-		rel_error = vartot ** 0.5 / self.total(domain, variable) * 100
-		conf_inter = t.interval(confidence, self.dtfr.shape[0] - 1, poptot, std_err)
+		rel_error = vartot ** 0.5 / poptot * 100
+		conf_inter = t.interval(confidence, n_rows - 1, poptot, std_err)
 		out = {'Domain mean': mean,
 			'Population total': poptot,
 			'Strata variances': sv,
@@ -317,49 +445,192 @@ class Estimator(object):
 		return out
 
 
-	def get_cov_strata(self, domain, domain_p,  var_y, var_x ):
+	def _strata_vector(self, values, strata = None):
 		"""
-		`domain` is subset of `domain_p`.
+		Values of a per stratum dict (e.g., `weights`) as a column vector
+		following the order of `strata` (default: the strata of the sample).
 		"""
-		self.covs = {}
+		if strata is None:
+			strata = self.strata_stats().index
 
-		for h in self.dtfr.Stratum.unique().tolist():
-			#print h
+		return np.array([values[h] for h in strata], dtype = float)[:, np.newaxis]
 
-			indxs = self.dtfr[((self.dtfr.Domain == domain) | (self.dtfr.Domain == domain_p)) & (self.dtfr.Stratum == h)].index
-			#print indxs
 
-			#n_h = float(self.dtfr[(self.dtfr.Stratum == h)].shape[0])
-			n_h = float(len(self.dtfr.loc[(self.dtfr.Stratum == h), 'Plot'].unique()))
+	def stats_matrix(self, domains, variables, min_rows = 0):
+		"""
+		Sufficient statistics of every (domain, variable) combination as
+		strata x combinations arrays, combinations ordered by domain and then
+		variable. Sums of groups with `min_rows` rows or less are set to zero
+		(`sum_y`). Returns a dict of np.arrays (keys as in `variable_stats`).
+		"""
+		strata = self.strata_stats().index
+		index = pd.MultiIndex.from_product([strata, domains])
+		out = {}
 
-			if n_h > 1:
+		for var in variables:
+			stats = self.variable_stats(var).reindex(index, fill_value = 0)
+			for col in stats.columns:
+				out.setdefault(col, []).append(stats[col].values.astype(float)
+					.reshape(len(strata), len(domains)))
+
+		for col in out:
+			out[col] = np.stack(out[col], axis = 2).reshape(len(strata), -1)
+
+		out['sum_y'] = np.where(out['rows'] > min_rows, out['sum_y'], 0.0)
+
+		return out
+
+
+	def estimate(self, domains, variables, method = 'post_stratified', confidence = 0.95):
+		"""
+		Estimates totals and variances of several variables in several domains at
+		once. Strata variances of all combinations are computed as arrays from the
+		sufficient statistics, without modifying the estimator (`s2`). Results
+		are the same as those of the `method`_mean_var methods.
+
+		Arguments:
+
+		- domains (list): Domains.
+
+		- variables (list): Variables (dataframe columns).
+
+		- method (str): Sampling design: `stratified`, `post_stratified`,
+		`double_stratified` or `double_post_stratified`. Double sampling requires
+		`map_points`.
+
+		- confidence (float): Confidence level of the intervals.
+
+		Returns a pd.DataFrame with a row per domain and variable, and columns
+		`Domain`, `Variable`, `Mean`, `Total`, `Variance`, `StdError`,
+		`RelativeError`, `CILower` and `CIUpper`.
+
+		"""
+		if method not in ('stratified', 'post_stratified', 'double_stratified',
+			'double_post_stratified'):
+			raise ValueError("Unknown estimation method {0}.".format(method))
+
+		domains = list(domains)
+		variables = list(variables)
+		strata = self.strata_stats()
+		stats = self.stats_matrix(domains, variables)
+
+		sum_a = strata.sum_a.values.astype(float)[:, np.newaxis]
+		n_h = strata.plots.values.astype(float)[:, np.newaxis]
+		area_h = self._strata_vector(self.areas)
+		weight_h = self._strata_vector(self.weights)
+		tot_area = sum(self.areas.values())
+
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+
+			# Strata means and population totals
+			str_mean = stats['sum_y'] / sum_a
+			total = np.where(pd.notna(str_mean), str_mean * area_h, 0.0).sum(axis = 0)
+
+			# Strata variances
+			mean_h = np.where(pd.notna(sum_a) & (sum_a != 0), str_mean, 0.0)
+			num = stats['sum_y2'] - 2 * mean_h * stats['sum_ya'] + \
+				mean_h ** 2 * strata.sum_a2.values[:, np.newaxis]
+			den = sum_a ** 2
+			s2 = np.where(den == 0, 0.0, n_h ** 2 / (n_h - 1) * num / den)
+			s2 = np.where(n_h > 1, s2, 0.0)
+
+			if method.startswith('double'):
+				n = float(self.dtfr.shape[0])
+				points_h = self._strata_vector(self.map_points)
+				N = float(sum(self.map_points.values()))
+
+				if set(self.areas) == set(strata.index):
+					dom_mean = (str_mean * area_h).sum(axis = 0) / tot_area
+				else:
+					dom_mean = np.full(str_mean.shape[1], np.nan)
+
+				sum_y = self.stats_matrix(domains, variables, min_rows = 1)['sum_y']
+				diff = (dom_mean - sum_y / sum_a) ** 2
+
+				if method == 'double_stratified':
+					left = np.where(points_h > 0, weight_h * s2 * (points_h - 1) /
+						(strata.rows.values[:, np.newaxis] * (N - 1)), 0.0)
+					sv = weight_h * diff / (N - 1) + left
 
-				sum_y = 0.0
-				if self.dtfr[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain)].shape[0] > 0:
-					sum_y = self.dtfr.loc[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain), var_y].sum()
+				else:
+					left = (points_h - 1) * s2 / ((N - 1) * n)
+					center = (1 - weight_h) * s2 / n ** 2
+					sv = (points_h / N) * diff / (N - 1) + left + center
+
+			else:
+				n = float(self.n_plots())
+
+				if method == 'stratified':
+					sv = weight_h ** 2 * s2 / n_h
+
+				else:
+					sv = (weight_h * s2 + (1 - weight_h) * s2 / n) / n
+
+			vartot = tot_area ** 2 * sv.sum(axis = 0)
+			std_err = (vartot / n) ** 0.5
+			rel_error = vartot ** 0.5 / total * 100
+			lower, upper = t.interval(confidence, n - 1, total, std_err)
+
+		out = pd.DataFrame({'Domain': [d for d in domains for v in variables],
+			'Variable': [v for d in domains for v in variables],
+			'Mean': stats['sum_y'].sum(axis = 0) / n,
+			'Total': total,
+			'Variance': vartot,
+			'StdError': std_err,
+			'RelativeError': rel_error,
+			'CILower': lower,
+			'CIUpper': upper},
+			columns = ['Domain', 'Variable', 'Mean', 'Total', 'Variance', 'StdError',
+			'RelativeError', 'CILower', 'CIUpper'])
+
+		return out
 
-				sum_a = self.dtfr.loc[(self.dtfr.Stratum == h), "Area"].sum()
-				mean_y = sum_y / sum_a
 
-				sum_x = 0.0
-				if self.dtfr[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain_p)].shape[0] > 0:
-					sum_x = self.dtfr.loc[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain_p), var_x].sum()
+	def cov_strata(self, domain, domain_p, var_y, var_x):
+		"""
+		Covariance of two variables within each stratum. `domain` is subset of
+		`domain_p`. Returns a dict (stratum: covariance).
+		"""
+		out = {}
+		strata = self.strata_stats()
+		stats_y = self.variable_stats(var_y)
+		stats_x = self.variable_stats(var_x)
+		cross = self.cross_stats(var_y, var_x)
 
-				mean_x = sum_x / sum_a
+		for h in strata.index:
 
-				A = sum(self.dtfr.loc[indxs, var_y] * self.dtfr.loc[indxs, var_x])
-				B = mean_y * sum(self.dtfr.loc[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain_p), "Area"] * self.dtfr.loc[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain_p), var_x])
-				C =  mean_x * sum(self.dtfr.loc[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain), "Area"] * self.dtfr.loc[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain), var_y])
-				D = sum(self.dtfr.loc[self.dtfr.Stratum == h, "Area"] ** 2) * mean_y * mean_x
+			n_h = float(strata.at[h, 'plots'])
+
+			if n_h > 1:
+
+				sum_a = strata.at[h, 'sum_a']
+				mean_y = self._stratum_sum(h, domain, var_y) / sum_a
+				mean_x = self._stratum_sum(h, domain_p, var_x) / sum_a
+
+				# Rows in either domain
+				A = cross.get((h, domain), 0.0)
+				if domain_p != domain:
+					A += cross.get((h, domain_p), 0.0)
+				B = mean_y * _lookup(stats_x, (h, domain_p), 'sum_ya')
+				C = mean_x * _lookup(stats_y, (h, domain), 'sum_ya')
+				D = strata.at[h, 'sum_a2'] * mean_y * mean_x
 
-				#print A, B, C, D
 				num = A - B - C + D
-				den = self.dtfr.loc[self.dtfr.Stratum == h, "Area"].sum() ** 2
+				den = sum_a ** 2
 
-				self.covs[h] = (n_h ** 2 / (n_h - 1)) * (num / den)
+				out[h] = (n_h ** 2 / (n_h - 1)) * (num / den)
 
 			else:
-				self.covs[h] = 0.0
+				out[h] = 0.0
+
+		return out
+
+
+	def get_cov_strata(self, domain, domain_p,  var_y, var_x ):
+		"""
+		`domain` is subset of `domain_p`.
+		"""
+		self.covs = self.cov_strata(domain, domain_p, var_y, var_x)
 
 		return None
 
@@ -367,13 +638,13 @@ class Estimator(object):
 	def cov_stratified(self, domain, domain_p,  var_y, var_x):
 
 		self.get_cov_strata(domain, domain_p,  var_y, var_x )
+		strata = self.strata_stats()
 		tcov = 0.0
 
 		for h in self.weights:
 
-			if self.dtfr[self.dtfr.Stratum == h].shape[0] > 0:
-				#tcov_h = self.weights[h] ** 2 * self.covs[h] / self.dtfr[self.dtfr.Stratum == h].shape[0]
-				tcov_h = self.weights[h] ** 2 * self.covs[h] / len(self.dtfr.loc[(self.dtfr.Stratum == h), 'Plot'].unique())
+			if _lookup(strata, h, 'rows', 0) > 0:
+				tcov_h = self.weights[h] ** 2 * self.covs[h] / strata.at[h, 'plots']
 			else:
 				tcov_h = 0.0
 
@@ -387,24 +658,27 @@ class Estimator(object):
 	def cov_post_stratified(self, domain, domain_p, var_y, var_x):
 
 		self.get_cov_strata(domain, domain_p,  var_y, var_x )
+		strata = self.strata_stats()
+		n_plots = float(self.n_plots())
 		tcov = 0.0
 		for h in self.weights:
-			if self.dtfr[self.dtfr.Stratum == h].shape[0] > 0:
+			if _lookup(strata, h, 'rows', 0) > 0:
 
-				tcov_h = ((self.weights[h] * self.covs[h]) + ((1 - self.weights[h]) * self.covs[h] / float(len(self.dtfr.Plot.unique()))))
+				tcov_h = ((self.weights[h] * self.covs[h]) + ((1 - self.weights[h]) * self.covs[h] / n_plots))
 			else:
 				tcov_h = 0.0
 
 			tcov += tcov_h
 
 		# In Chip's formula the sum of the areas is not exponentiated
-		tcov *= sum(self.areas.values()) ** 2 / float(len(self.dtfr.Plot.unique()))
+		tcov *= sum(self.areas.values()) ** 2 / n_plots
 
 		return tcov
 
 
 	def cov_double_stratified(self, domain, domain_p,  var_y, var_x):
 		self.get_cov_strata(domain, domain_p,  var_y, var_x )
+		strata = self.strata_stats()
 		tcov = 0.0
 
 		tot_points = float(sum(self.map_points.values()))
@@ -412,22 +686,12 @@ class Estimator(object):
 		mean_x = self.domain_mean(domain_p, var_x)
 
 		for h in self.weights:
-			if self.dtfr[self.dtfr.Stratum == h].shape[0] > 0:
-				#n_h = float(self.dtfr[self.dtfr.Stratum == h].shape[0])
-				n_h = float(len(self.dtfr.loc[self.dtfr.Stratum == h, 'Plot'].unique()))
-
-				sum_y = 0.0
-				if self.dtfr[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain)].shape[0] > 0:
-					sum_y = self.dtfr.loc[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain), var_y].sum()
+			if _lookup(strata, h, 'rows', 0) > 0:
+				n_h = float(strata.at[h, 'plots'])
 
-				sum_a = self.dtfr.loc[(self.dtfr.Stratum == h), "Area"].sum()
-				mean_hy = sum_y / sum_a
-
-				sum_x = 0.0
-				if self.dtfr[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain_p)].shape[0] > 0:
-					sum_x = self.dtfr.loc[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain_p), var_x].sum()
-
-				mean_hx = sum_x / sum_a
+				sum_a = strata.at[h, 'sum_a']
+				mean_hy = self._stratum_sum(h, domain, var_y) / sum_a
+				mean_hx = self._stratum_sum(h, domain_p, var_x) / sum_a
 
 				tcov_h = self.weights[h] * (self.map_points[h] - 1) / (tot_points - 1) * self.covs[h] / n_h
 				tcov += 1 / (tot_points - 1) * self.weights[h] * (mean_hy - mean_y) * (mean_hx - mean_x)
@@ -444,29 +708,21 @@ class Estimator(object):
 	def cov_double_post_stratified(self, domain, domain_p,  var_y, var_x):
 		tcov = 0.0
 		self.get_cov_strata(domain, domain_p, var_y, var_x )
+		strata = self.strata_stats()
+		n_plots = float(self.n_plots())
 		tot_points = float(sum(self.map_points.values()))
 		mean_y = self.domain_mean(domain, var_y)
 		mean_x = self.domain_mean(domain_p, var_x)
 
 		for h in self.weights:
-			if self.dtfr[self.dtfr.Stratum == h].shape[0] > 0:
-				#n_h = float(self.dtfr[self.dtfr.Stratum == h].shape[0])
-				n_h = float(len(self.dtfr.loc[self.dtfr.Stratum == h, 'Plot'].unique()))
-
-				sum_y = 0.0
-				if self.dtfr[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain)].shape[0] > 0:
-					sum_y = self.dtfr.loc[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain), var_y].sum()
+			if _lookup(strata, h, 'rows', 0) > 0:
 
-				sum_a = self.dtfr.loc[(self.dtfr.Stratum == h), "Area"].sum()
-				mean_hy = sum_y / sum_a
+				sum_a = strata.at[h, 'sum_a']
+				mean_hy = self._stratum_sum(h, domain, var_y) / sum_a
+				mean_hx = self._stratum_sum(h, domain_p, var_x) / sum_a
 
-				sum_x = 0.0
-				if self.dtfr[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain_p)].shape[0] > 0:
-					sum_x = self.dtfr.loc[(self.dtfr.Stratum == h) & (self.dtfr.Domain == domain_p), var_x].sum()
-
-				mean_hx = sum_x / sum_a
-				l = (self.map_points[h] - 1) / (tot_points - 1) * self.covs[h] / float(len(self.dtfr.Plot.unique()))
-				c = (1 - self.weights[h]) *  self.covs[h] / float(len(self.dtfr.Plot.unique())) ** 2
+				l = (self.map_points[h] - 1) / (tot_points - 1) * self.covs[h] / n_plots
+				c = (1 - self.weights[h]) *  self.covs[h] / n_plots ** 2
 				r = 1 / (tot_points - 1) * self.weights[h] * (mean_hy - mean_y) * (mean_hx - mean_x)
 				tcov_h = l + c + r
 
@@ -480,6 +736,128 @@ class Estimator(object):
 		return tcov
 
 
+	def cov_strata_matrix(self, pairs):
+		"""
+		Covariances within each stratum of several pairs of variables, computed
+		from the sufficient statistics as arrays (see `cov_strata`).
+
+		Arguments:
+
+		- pairs (list): (domain, domain_p, var_y, var_x) tuples. `domain` is subset
+		of `domain_p`.
+
+		Returns a strata x pairs np.array, strata ordered as in `strata_stats`.
+
+		"""
+		strata = self.strata_stats()
+		cross = self.cross_stats_many([(y, x) for d, dp, y, x in pairs])
+		sum_a = strata.sum_a.values.astype(float)[:, np.newaxis]
+		n_h = strata.plots.values.astype(float)[:, np.newaxis]
+
+		def column(stats, key, col):
+			return stats.reindex(pd.MultiIndex.from_tuples([(h, key) for h in strata.index]),
+				fill_value = 0)[col].values.astype(float)
+
+		sum_y = np.empty((len(strata), len(pairs)))
+		sum_x = np.empty_like(sum_y)
+		ya = np.empty_like(sum_y)
+		xa = np.empty_like(sum_y)
+		A = np.empty_like(sum_y)
+
+		for k, (d, dp, y, x) in enumerate(pairs):
+			stats_y = self.variable_stats(y)
+			stats_x = self.variable_stats(x)
+			sum_y[:, k] = np.where(column(stats_y, d, 'rows') > 0, column(stats_y, d, 'sum_y'), 0.0)
+			sum_x[:, k] = np.where(column(stats_x, dp, 'rows') > 0, column(stats_x, dp, 'sum_y'), 0.0)
+			ya[:, k] = column(stats_y, d, 'sum_ya')
+			xa[:, k] = column(stats_x, dp, 'sum_ya')
+
+			# Rows in either domain
+			prods = cross[k].to_frame('sum')
+			A[:, k] = column(prods, d, 'sum')
+			if dp != d:
+				A[:, k] += column(prods, dp, 'sum')
+
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			mean_y = sum_y / sum_a
+			mean_x = sum_x / sum_a
+			num = A - mean_y * xa - mean_x * ya + \
+				strata.sum_a2.values[:, np.newaxis] * mean_y * mean_x
+			covs = np.where(n_h > 1, (n_h ** 2 / (n_h - 1)) * (num / sum_a ** 2), 0.0)
+
+		return covs
+
+
+	def cov_totals(self, pairs, method = 'post_stratified'):
+		"""
+		Covariances of the population totals of several pairs of variables (see
+		`cov_stratified`, `cov_post_stratified`, `cov_double_stratified` and
+		`cov_double_post_stratified`), computed as a single array operation.
+
+		Arguments:
+
+		- pairs (list): (domain, domain_p, var_y, var_x) tuples.
+
+		- method (str): Sampling design: `stratified`, `post_stratified`,
+		`double_stratified` or `double_post_stratified`.
+
+		Returns a np.array of covariances, one per pair.
+
+		"""
+		if method not in ('stratified', 'post_stratified', 'double_stratified',
+			'double_post_stratified'):
+			raise ValueError("Unknown estimation method {0}.".format(method))
+
+		strata = self.strata_stats()
+		covs = self.cov_strata_matrix(pairs)
+		weight_h = self._strata_vector(self.weights)
+		n_h = strata.plots.values.astype(float)[:, np.newaxis]
+		n = float(self.n_plots())
+		tot_area = sum(self.areas.values())
+
+		if method == 'stratified':
+			tcov = (weight_h ** 2 * covs / n_h).sum(axis = 0) * tot_area ** 2
+
+		elif method == 'post_stratified':
+			tcov = (weight_h * covs + (1 - weight_h) * covs / n).sum(axis = 0)
+			tcov *= tot_area ** 2 / n
+
+		else:
+			points_h = self._strata_vector(self.map_points)
+			tot_points = float(sum(self.map_points.values()))
+			domains = [p[0] for p in pairs] + [p[1] for p in pairs]
+			domains = [d for i, d in enumerate(domains) if d not in domains[:i]]
+			variables = [p[2] for p in pairs] + [p[3] for p in pairs]
+			variables = [v for i, v in enumerate(variables) if v not in variables[:i]]
+			stats = self.stats_matrix(domains, variables)
+			col = dict(((d, v), i * len(variables) + j) for i, d in enumerate(domains)
+				for j, v in enumerate(variables))
+			iy = [col[(p[0], p[2])] for p in pairs]
+			ix = [col[(p[1], p[3])] for p in pairs]
+			area_h = self._strata_vector(self.areas)
+
+			with np.errstate(divide = 'ignore', invalid = 'ignore'):
+				str_mean = stats['sum_y'] / strata.sum_a.values.astype(float)[:, np.newaxis]
+				if set(self.areas) == set(strata.index):
+					dom_mean = (str_mean * area_h).sum(axis = 0) / tot_area
+				else:
+					dom_mean = np.full(str_mean.shape[1], np.nan)
+
+				r = weight_h * (str_mean[:, iy] - dom_mean[iy]) * \
+					(str_mean[:, ix] - dom_mean[ix]) / (tot_points - 1)
+
+				if method == 'double_stratified':
+					tcov_h = weight_h * (points_h - 1) / (tot_points - 1) * covs / n_h + r
+
+				else:
+					tcov_h = (points_h - 1) / (tot_points - 1) * covs / n + \
+						(1 - weight_h) * covs / n ** 2 + r
+
+			tcov = tcov_h.sum(axis = 0) * tot_area ** 2
+
+		return tcov
+
+
 	def ratio_var(self, domain, domain_p, var_y, var_x, double_sampl = False, post_strat = True):
 		cov = None
 		var_y_dict = None
@@ -545,3 +923,235 @@ class Estimator(object):
 			'Variance of the ratio': var,
 			'Coefficient of variation': cv,
 			'Strata ratios': str_ratios}
+
+
+	def ratios(self, pairs, method = 'post_stratified', confidence = 0.95):
+		"""
+		Estimates several ratios of population totals and their variances at
+		once (see `ratio_var`). Totals, variances and covariances of all pairs
+		are computed as arrays, without modifying the estimator.
+
+		Arguments:
+
+		- pairs (list): (domain, domain_p, var_y, var_x) tuples, ratio of the total
+		of `var_y` in `domain` over the total of `var_x` in `domain_p`.
+
+		- method (str): Sampling design: `stratified`, `post_stratified`,
+		`double_stratified` or `double_post_stratified`.
+
+		- confidence (float): Confidence level of Fieller's (two-sided) interval.
+		Note that `ratio_var` uses the one-sided 0.95 quantile of t, i.e., a 90%
+		interval, which corresponds here to `confidence = 0.9`.
+
+		Returns a pd.DataFrame with a row per pair, and columns `Domain`,
+		`DomainP`, `VariableY`, `VariableX`, `Ratio`, `Variance`, `CV`, `CILower`
+		and `CIUpper`.
+
+		"""
+		pairs = list(pairs)
+		domains = [p[0] for p in pairs] + [p[1] for p in pairs]
+		domains = [d for i, d in enumerate(domains) if d not in domains[:i]]
+		variables = [p[2] for p in pairs] + [p[3] for p in pairs]
+		variables = [v for i, v in enumerate(variables) if v not in variables[:i]]
+
+		totals = self.estimate(domains, variables, method).set_index(['Domain', 'Variable'])
+		Y = totals.Total.loc[[(p[0], p[2]) for p in pairs]].values
+		X = totals.Total.loc[[(p[1], p[3]) for p in pairs]].values
+		vY = totals.Variance.loc[[(p[0], p[2]) for p in pairs]].values
+		vX = totals.Variance.loc[[(p[1], p[3]) for p in pairs]].values
+		cov = self.cov_totals(pairs, method)
+
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			R = Y / X
+			var = (vY + R ** 2 * vX - 2 * R * cov) / X ** 2
+			cv = var ** 0.5 / R * 100
+
+			# Confidence interval via Fieller's method
+			t_val = t.ppf(0.5 + confidence / 2.0, self.dtfr.shape[0] - 1)
+			A = X * Y - t_val ** 2 * cov
+			B = X ** 2 - t_val ** 2 * vX
+			C = Y ** 2 - t_val ** 2 * vY
+			lower = (A - (A ** 2 - B * C) ** 0.5) / B
+			upper = (A + (A ** 2 - B * C) ** 0.5) / B
+
+		out = pd.DataFrame({'Domain': [p[0] for p in pairs],
+			'DomainP': [p[1] for p in pairs],
+			'VariableY': [p[2] for p in pairs],
+			'VariableX': [p[3] for p in pairs],
+			'Ratio': R,
+			'Variance': var,
+			'CV': cv,
+			'CILower': lower,
+			'CIUpper': upper},
+			columns = ['Domain', 'DomainP', 'VariableY', 'VariableX', 'Ratio', 'Variance',
+			'CV', 'CILower', 'CIUpper'])
+
+		return out
+
+
+	def sampling_units(self, domains, variables):
+		"""
+		Sampling units of the bootstrap: plots within strata. Returns a tuple
+		(stratum of each unit, sum of the areas of each unit, units x
+		combinations array of the sums of each (domain, variable) combination,
+		ordered by domain and then variable). Missing values are ignored.
+		"""
+		grp = self.dtfr.groupby(['Stratum', 'Plot'], sort = False)
+		codes = grp.ngroup().values
+		units = grp.size().index
+		valid = codes >= 0
+		codes = codes[valid]
+
+		area = np.bincount(codes, self.dtfr.Area.fillna(0).values[valid], len(units))
+
+		sums = np.empty((len(units), len(domains) * len(variables)))
+		k = 0
+		for domain in domains:
+			in_domain = (self.dtfr.Domain == domain).values[valid]
+			for var in variables:
+				y = self.dtfr[var].fillna(0).values[valid]
+				sums[:, k] = np.bincount(codes, np.where(in_domain, y, 0.0), len(units))
+				k += 1
+
+		return units.get_level_values(0), area, sums
+
+
+	def replicate_weights(self, unit_strata, replicates, random_state = None):
+		"""
+		Bootstrap replicate weights: number of times each sampling unit is drawn
+		when `n_h` units are resampled with replacement within each stratum.
+		Returns a dict (stratum: replicates x units of the stratum np.array).
+		"""
+		if random_state is None:
+			random_state = np.random.RandomState()
+
+		out = {}
+		for h in pd.unique(unit_strata):
+			n_h = int((unit_strata == h).sum())
+			out[h] = random_state.multinomial(n_h, np.ones(n_h) / n_h, size = replicates)
+
+		return out
+
+
+	def _replicate_totals(self, unit_strata, area, sums, weights):
+		"""
+		Population totals of every replicate, computed as matrix products of the
+		replicate weights. Strata with undefined means are skipped, as in
+		`total`. Returns a replicates x combinations np.array.
+		"""
+		out = None
+		for h in weights:
+			units = np.asarray(unit_strata == h)
+			with np.errstate(divide = 'ignore', invalid = 'ignore'):
+				str_mean = weights[h].dot(sums[units]) / weights[h].dot(area[units])[:, np.newaxis]
+			tot = np.where(np.isnan(str_mean), 0.0, str_mean * self.areas[h])
+			out = tot if out is None else out + tot
+
+		return out
+
+
+	def bootstrap(self, domains, variables, ratios = (), replicates = 1000,
+		confidence = 0.95, random_state = None, chunk_size = 1000, workers = 1):
+		"""
+		Bootstrap estimates of population totals and ratios. Plots are resampled
+		with replacement within each stratum, and replicate totals of all
+		domains and variables are computed as products of the replicate weight
+		matrices and the plot sums. Intervals are bootstrap percentiles.
+
+		Arguments:
+
+		- domains (list): Domains of the totals.
+
+		- variables (list): Variables (dataframe columns) of the totals.
+
+		- ratios (list): Ratios to estimate, as (domain, domain_p, var_y, var_x)
+		tuples (total of `var_y` in `domain` over total of `var_x` in
+		`domain_p`).
+
+		- replicates (int): Number of bootstrap replicates.
+
+		- confidence (float): Confidence level of the intervals.
+
+		- random_state (int or np.random.RandomState): Seed or random generator.
+
+		- chunk_size (int): Replicates computed at once.
+
+		- workers (int): Threads computing replicate chunks.
+
+		Returns a pd.DataFrame with a row per total and ratio, and columns
+		`Domain`, `Variable`, `DomainP` and `VariableP` (denominator of ratios),
+		`Estimate`, `Variance`, `StdError`, `RelativeError`, `CILower` and
+		`CIUpper`.
+
+		"""
+		if not isinstance(random_state, np.random.RandomState):
+			random_state = np.random.RandomState(random_state)
+
+		domains = list(domains)
+		variables = list(variables)
+		ratios = list(ratios)
+
+		# Domains and variables of the ratios are added to the totals
+		doms = domains + [d for r in ratios for d in r[:2] if d not in domains]
+		doms = [d for i, d in enumerate(doms) if d not in doms[:i]]
+		vars_ = variables + [v for r in ratios for v in r[2:] if v not in variables]
+		vars_ = [v for i, v in enumerate(vars_) if v not in vars_[:i]]
+		col = dict(((d, v), i * len(vars_) + j) for i, d in enumerate(doms)
+			for j, v in enumerate(vars_))
+
+		unit_strata, area, sums = self.sampling_units(doms, vars_)
+		num = [col[(r[0], r[2])] for r in ratios]
+		den = [col[(r[1], r[3])] for r in ratios]
+
+		# Chunk seeds do not depend on the number of workers
+		sizes = [min(chunk_size, replicates - s) for s in range(0, replicates, chunk_size)]
+		seeds = random_state.randint(np.iinfo(np.int32).max, size = len(sizes))
+
+		def chunk(args):
+			size, seed = args
+			weights = self.replicate_weights(unit_strata, size, np.random.RandomState(seed))
+			tots = self._replicate_totals(unit_strata, area, sums, weights)
+			with np.errstate(divide = 'ignore', invalid = 'ignore'):
+				return np.hstack([tots, tots[:, num] / tots[:, den]])
+
+		if workers > 1:
+			pool = ThreadPool(workers)
+			try:
+				reps = pool.map(chunk, zip(sizes, seeds))
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			reps = [chunk(args) for args in zip(sizes, seeds)]
+
+		reps = np.vstack(reps)
+
+		# Estimates from the sample
+		ones = dict((h, np.ones((1, int((unit_strata == h).sum())), dtype = int))
+			for h in pd.unique(unit_strata))
+		point = self._replicate_totals(unit_strata, area, sums, ones)[0]
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			point = np.concatenate([point, point[num] / point[den]])
+
+		rows = [(d, v, None, None, col[(d, v)]) for d in domains for v in variables]
+		rows += [(r[0], r[2], r[1], r[3], len(col) + i) for i, r in enumerate(ratios)]
+		idx = [r[4] for r in rows]
+
+		alpha = (1 - confidence) / 2.0 * 100
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			variance = reps[:, idx].var(axis = 0, ddof = 1)
+			lower, upper = np.percentile(reps[:, idx], [alpha, 100 - alpha], axis = 0)
+			out = pd.DataFrame({'Domain': [r[0] for r in rows],
+				'Variable': [r[1] for r in rows],
+				'DomainP': [r[2] for r in rows],
+				'VariableP': [r[3] for r in rows],
+				'Estimate': point[idx],
+				'Variance': variance,
+				'StdError': variance ** 0.5,
+				'RelativeError': variance ** 0.5 / point[idx] * 100,
+				'CILower': lower,
+				'CIUpper': upper},
+				columns = ['Domain', 'Variable', 'DomainP', 'VariableP', 'Estimate',
+				'Variance', 'StdError', 'RelativeError', 'CILower', 'CIUpper'])
+
+		return out
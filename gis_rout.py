@@ -10,81 +10,45 @@
 # ('holdridge' o 'chave'), las claves del segundo son las clases, y los valores
 # son el conteo de pixeles correspondiente.    
 #
+# Se pueden procesar varios ráster de bosque (uno por año) en una sola pasada
+# por los ráster climáticos. Se escribe un archivo de conteo por año y un
+# archivo con las transiciones entre años consecutivos (bosque, perdida de
+# bosque, ganancia de bosque y no bosque) por clase.
+#
+# Los ráster se procesan por bloques (ver `raster_blocks.count_years`): el
+# ráster de bosque se remuestrea sobre la grilla climática una vez por bloque.
+#
 ################################################################################
-import gdal
-import numpy as np
-import allometry
+import raster_blocks
 import pickle
 
 # Archivos de entrada
 alt_file = "/home/nelsonsalinas/Documents/cust_layers/alt/vent_alt.tif"
 prec_file = "/home/nelsonsalinas/Documents/cust_layers/precp/precp.tif"
-#for_file = "/home/nelsonsalinas/Documents/Cartografia_SIAC/bosque_no_bosque_2016/BQNBQ_2016_EPSG4326.tif"
-for_file = "/home/nelsonsalinas/Documents/Cartografia_SIAC/bosque_no_bosque_2015/BQNBQ_2015_EPSG4326.tif"
-
-# Archivo de salida
-outfile = "for_pix_count.pkl"
-
-alt_ras = gdal.Open(alt_file)
-prec_ras = gdal.Open(prec_file)
-for_ras = gdal.Open(for_file)
-
-transform = alt_ras.GetGeoTransform()
-altXOrigin = transform[0]
-altYOrigin = transform[3]
-altPixelWidth = transform[1]
-altPixelHeight = transform[5]
-
-transform = for_ras.GetGeoTransform()
-forXOrigin = transform[0]
-forYOrigin = transform[3]
-forPixelWidth = transform[1]
-forPixelHeight = transform[5]
-
-for_band = for_ras.GetRasterBand(1)
-
-#for_band = for_ras.GetRasterBand(1)
-
-#for_arr = for_band.ReadAsArray(0,0,for_ras.RasterXSize, for_ras.RasterYSize)
-
-alt_band = alt_ras.GetRasterBand(1)
-alt_arr = alt_band.ReadAsArray(0,0,alt_ras.RasterXSize, alt_ras.RasterYSize)
-
-prec_band = prec_ras.GetRasterBand(1)
-prec_arr = prec_band.ReadAsArray(0,0,prec_ras.RasterXSize, prec_ras.RasterYSize)
-
-for_type_count ={'holdrigde':{}, 'chaveI':{}}
-
+# Ráster de bosque por año
+for_files = {
+	2015: "/home/nelsonsalinas/Documents/Cartografia_SIAC/bosque_no_bosque_2015/BQNBQ_2015_EPSG4326.tif",
+	2016: "/home/nelsonsalinas/Documents/Cartografia_SIAC/bosque_no_bosque_2016/BQNBQ_2016_EPSG4326.tif"}
 
-it = np.nditer((alt_arr, prec_arr), flags=['multi_index'])
-while not it.finished:
-	if it[0] >= 0 and it[1] > 0:
-		holdr = allometry.holdridge_col(it[0], it[1])
-		chave = allometry.chaveI_forest(it[1])
+# Archivos de salida (conteo por año y transiciones)
+outfile = "for_pix_count_{0}.pkl"
+transitions_file = "for_transitions.pkl"
 
-		if holdr and chave:
-			row = it.multi_index[0]
-			col = it.multi_index[1]
-			lon = col * altPixelWidth + altXOrigin
-			lat = row * altPixelHeight + altYOrigin
+# Numero de procesos (None: uno por procesador)
+workers = None
 
-			if lon >= forXOrigin and lat <= forYOrigin:
-				fpx = int((lon - forXOrigin) / forPixelWidth)
-				fpy = int((lat - forYOrigin) / forPixelHeight)
+years = sorted(for_files)
 
-				if fpx <= for_ras.RasterXSize and fpy <= for_ras.RasterYSize:
-					for_val = for_band.ReadAsArray(fpx, fpy, 1, 1)
+# Conteo de pixeles de bosque por combinacion de clases climaticas
+counts, transitions = raster_blocks.count_years(alt_file, prec_file,
+	[for_files[y] for y in years], workers = workers)
 
-					if for_val and for_val[0][0] == 1:
+for i, year in enumerate(years):
+	for_type_count = raster_blocks.count_dict(counts[i])
+	pickle.dump(for_type_count, open(outfile.format(year),"w"))
 
-						if not holdr in for_type_count['holdrigde']:
-							for_type_count['holdrigde'][holdr] = 1
-						else:
-							for_type_count['holdrigde'][holdr] += 1
-						if not chave in for_type_count['chaveI']:
-							for_type_count['chaveI'][chave] = 1
-						else:
-							for_type_count['chaveI'][chave] += 1
-	it.iternext()
+for_transitions = {}
+for i in range(len(years) - 1):
+	for_transitions[(years[i], years[i + 1])] = raster_blocks.transition_dict(transitions[i])
 
-pickle.dump(for_type_count, open(outfile,"w"))
+pickle.dump(for_transitions, open(transitions_file,"w"))
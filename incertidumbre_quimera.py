@@ -13,6 +13,8 @@ import numpy as np
 import sqlalchemy as al
 import db_utils
 import comm
+import sim_store
+import parallel
 import pymc3
 import pickle
 #import matplotlib.pyplot as plt
@@ -24,11 +26,13 @@ iters = 100
 # Iteraciones para la simulacion de biomasa por parcela
 path_sims = 1000
 
-# Contenedores de distribuciones finales:
-biomass_distr = np.empty((0, path_sims)) # incertidumbre agregada
-diam_distr = np.empty((0, path_sims)) # incertidumbre debida al diametro
-wd_distr = np.empty((0, path_sims)) # incertidumbre debida a la densidad
-allo_distr = np.empty((0, path_sims)) # incertidumbre debida a la ecuacion alometrica
+# Semilla de las simulaciones y numero de procesos (None: uno por procesador)
+seed = 20180227
+workers = None
+
+# Distribuciones finales: incertidumbre agregada (biomass) y debida al diametro,
+# la densidad y la ecuacion alometrica
+variables = ['biomass', 'diameter', 'wood_density', 'allometry']
 
 # Nucleo del nombre de los archivos de salida
 outfile_root = "test_20180227"
@@ -37,18 +41,9 @@ outfile_root = "test_20180227"
 # de Chave et al. (2014).
 trace = pickle.load(open("trace_20180224.pkl", "r"))
 
-# Obtencion de un muestreo aleatorio de la distribucion posterior de los
-# coefficientes alometricos.
-myas = np.random.choice(trace.get_values('a', burn = 1000, combine=True), iters)
-myas = np.append(myas, myas.mean())
-mybs = np.random.choice(trace.get_values('b', burn = 1000, combine=True), iters)
-mybs = np.append(mybs, mybs.mean())
-mycs = np.random.choice(trace.get_values('c', burn = 1000, combine=True), iters)
-mycs = np.append(mycs, mycs.mean())
-myds = np.random.choice(trace.get_values('d', burn = 1000, combine=True), iters)
-myds = np.append(myds, myds.mean())
-myes = np.random.choice(trace.get_values('e', burn = 1000, combine=True), iters)
-myes = np.append(myes, myes.mean())
+# Muestreo de la distribucion posterior de los coefficientes alometricos
+# (intercepto, E, ln densidad, ln diametro, ln diametro ^ 2), un vector por fila.
+coefs = np.column_stack([trace.get_values(c, burn = 1000, combine=True) for c in 'abcde'])
 
 
 # Archivos raster
@@ -79,19 +74,25 @@ engine = al.create_engine(
 conn = engine.connect()
 
 
-# Tabla de equivalencia taxonomica. Contiene dos columnas: ID del taxon y ID del taxon acceptado.
-accnames = db_utils.acctax(conn)
-
+# Datos dasometricos (con nombres aceptados), coordenadas y area de todas las
+# parcelas.
+stems, pars = db_utils.bulk_load('Quimera', conn)
+tables = dict(db_utils.iter_plots(stems, ['Diameter', 'Height', 'Family', 'Genus', 'Epithet']))
+pars = pars.reset_index()
 
-# Area e indice de parcelas
-pars = pd.read_sql_query('SELECT PlotID, Area FROM Parcelas', conn)
+# Las distribuciones de cada parcela se guardan en disco al terminar la parcela
+# ({outfile_root}_{variable}.npy). Parcelas ya guardadas por una ejecucion
+# previa no son procesadas de nuevo.
+sink = sim_store.DistributionSink(outfile_root, variables, path_sims, pars.shape[0])
 
-t0 = time.time()
-for parcela in pars.itertuples():
-#for p in xrange(1, 11):
 
-	# Tabla simple con todos los datos de una parcela: datos dasometricos, nombres de las especies y densidades.
-	table = db_utils.dasotab('Quimera', conn, parcela.PlotID, accepted_taxa = accnames)
+def plot_montecarlo(plotid, data, random_state):
+	"""
+	Simulacion de la biomasa de una parcela. Retorna la tupla (plotid, dict de
+	distribuciones, ver comm.Plot.biomass); las distribuciones son None si la
+	parcela no puede ser procesada.
+	"""
+	table, longitude, latitude, area = data
 
 	try:
 
@@ -100,123 +101,64 @@ for parcela in pars.itertuples():
 		myplot.name = 1
 		fam, gen, spp = myplot.floristic_summary()
 		if fam == 0: # Todos los individuos de las parcela estan indeterminados
-			continue
+			return plotid, None
 		myplot.purify()
-		myplot.coordinates = db_utils.coords('Quimera', conn, parcela.PlotID)
+		myplot.coordinates = longitude, latitude
 		myplot.set_holdridge(elevation_raster, precipitation_raster)
 		myplot.set_chave_forest(precipitation_raster)
 		myplot.set_E(chave_E_raster)
 		myplot.densities_from_file(densities_file)
 
-		# Arrays multidimensionales de los datos simuladops. Cada fila contiene
-		# los datos simulados para cada arbol
-		AGB = []
-		diamUnc = []
-		wdUnc = []
-		alloUnc = []
-
 		if myplot.det_stems() > 0:
 
-			for tree in myplot.stems.itertuples():
-				AGB.append([])
-				diamUnc.append([])
-				wdUnc.append([])
-				alloUnc.append([])
-
-				# Incertidumbre del diametro
-				sdd = tree.Diameter / 20.0
-				diams = np.random.normal(tree.Diameter, sdd, iters)
-				diams = np.append(diams, tree.Diameter)
-
-				# Incertidumbre de la densidad de madera
-				wd = myplot.taxa[myplot.taxa.TaxonID == tree.TaxonID]['Density'].item()
-				sdwd = 0.07727873895528423
-				wds = np.random.normal(wd, sdwd, iters)
-				wds = np.append(wds, wd)
-
-				# Incertidumbre total
-				for sdi, swd, sa, sb, sc, sd, se in zip(diams[:-1], wds[:-1], myas[:-1], mybs[:-1],
-														mycs[:-1], myds[:-1], myes[:-1]):
-					agb = sa + sb * myplot.E + sc * np.log(swd) + sd * np.log(sdi) + se * np.log(sdi)**2
-					AGB[-1].append(agb)
-
-				# Incertidumbre debida a los errores de diametro
-				for sdi in diams[:-1]:
-					agb = myas[-1] + mybs[-1] * myplot.E + mycs[-1] * np.log(wds[-1]) + myds[-1] * \
-						np.log(sdi) + myes[-1] * np.log(sdi)**2
-					diamUnc[-1].append(agb)
-
-				# Incertidumbre debida a los errores de la densidad de madera
-				for swd in wds[:-1]:
-					agb = myas[-1] + mybs[-1] * myplot.E + mycs[-1] * np.log(swd) + myds[-1] * \
-						np.log(diams[-1]) + myes[-1] * np.log(diams[-1])**2
-					wdUnc[-1].append(agb)
-
-				# Incertidumbre debida a los errores de la ecuacion alometrica
-				for sa, sb, sc, sd, se in zip(myas[:-1], mybs[:-1], mycs[:-1], myds[:-1], myes[:-1]):
-					agb = sa + sb * myplot.E + sc * np.log(wds[-1]) + sd * np.log(diams[-1]) + se * \
-						np.log(diams[-1])**2
-					alloUnc[-1].append(agb)
-
-
-			AGB = np.array(AGB)
-			diamUnc = np.array(diamUnc)
-			wdUnc = np.array(wdUnc)
-			alloUnc = np.array(alloUnc)
-
-			# Muestreo combinatorio para obtener la biomasa de la parcela
-			total_agb = np.empty((0, path_sims))
-			for t in xrange(AGB.shape[0]):
-				sample = np.random.choice(AGB[t], path_sims)
-				sample = sample.reshape(1, path_sims)
-				total_agb = np.append(total_agb , sample, axis=0)
-			total_agb = total_agb.sum(axis=0)
-			total_agb = np.divide(total_agb, parcela.Area)
-			total_agb = total_agb.reshape(1,path_sims)
-			biomass_distr = np.append(biomass_distr, total_agb, axis=0)
-
-
-			total_diam_unc = np.empty((0, path_sims))
-			for t in xrange(AGB.shape[0]):
-				sample = np.random.choice(diamUnc[t], path_sims)
-				sample = sample.reshape(1, path_sims)
-				total_diam_unc = np.append(total_diam_unc , sample, axis=0)
-			total_diam_unc = total_diam_unc.sum(axis=0)
-			total_diam_unc = np.divide(total_diam_unc, parcela.Area)
-			total_diam_unc = total_diam_unc.reshape(1,path_sims)
-			diam_distr = np.append(diam_distr, total_diam_unc, axis=0)
-
-
-			total_wood_unc = np.empty((0, path_sims))
-			for t in xrange(AGB.shape[0]):
-				sample = np.random.choice(wdUnc[t], path_sims)
-				sample = sample.reshape(1, path_sims)
-				total_wood_unc = np.append(total_wood_unc , sample, axis=0)
-			total_wood_unc = total_wood_unc.sum(axis=0)
-			total_wood_unc = np.divide(total_wood_unc, parcela.Area)
-			total_wood_unc = total_wood_unc.reshape(1,path_sims)
-			wd_distr = np.append(wd_distr, total_wood_unc, axis=0)
-
-
-			total_allo_unc = np.empty((0, path_sims))
-			for t in xrange(AGB.shape[0]):
-				sample = np.random.choice(alloUnc[t], path_sims)
-				sample = sample.reshape(1, path_sims)
-				total_allo_unc = np.append(total_allo_unc , sample, axis=0)
-			total_allo_unc = total_allo_unc.sum(axis=0)
-			total_allo_unc = np.divide(total_allo_unc, parcela.Area)
-			total_allo_unc = total_allo_unc.reshape(1,path_sims)
-			allo_distr = np.append(allo_distr, total_allo_unc, axis=0)
+			# Simulacion de la biomasa de la parcela (Kg/ha) y de la incertidumbre
+			# debida al diametro, la densidad de madera y la ecuacion alometrica.
+			myplot.area = area
+			myplot.biomass(method = 'montecarlo', iters = iters, path_sims = path_sims,
+				coefficients = coefs, random_state = random_state)
+
+			return plotid, myplot.montecarlo
 
 	except:
-		print "Error al procesar parcela", parcela.PlotID
+		print "Error al procesar parcela", plotid
+
+	return plotid, None
+
+
+def plot_data():
+	"""
+	Datos de las parcelas que no han sido procesadas.
+	"""
+	for parcela in pars.itertuples():
+	#for p in xrange(1, 11):
+
+		if parcela.PlotID in sink.done:
+			continue
+
+		# Tabla simple con todos los datos de una parcela: datos dasometricos, nombres de las especies y densidades.
+		table = tables.get(parcela.PlotID)
+		if table is None:
+			continue
+
+		yield parcela.PlotID, (table, parcela.Longitud, parcela.Latitud, parcela.Area)
+
+
+# Las parcelas son procesadas en paralelo, cada una con su propia semilla; los
+# resultados se guardan en el orden de las parcelas.
+t0 = time.time()
+for plotid, simulated in parallel.imap_plots(plot_montecarlo, plot_data(), workers = workers,
+	rasters = [elevation_raster, precipitation_raster, chave_E_raster],
+	densities_file = densities_file, seed = seed):
+
+	if simulated is not None:
+		sink.add(plotid, simulated)
 
 conn.close()
 
-np.save( "{0}_biomass".format(outfile_root) , biomass_distr)
-np.save( "{0}_diameter".format(outfile_root) , diam_distr)
-np.save( "{0}_wood_density".format(outfile_root) , wd_distr)
-np.save( "{0}_allometry".format(outfile_root) , allo_distr)
+for var in variables:
+	print var, sink.summary(var)
+
+sink.close()
 
 tf = time.time()
 print "Tiempo de ejecucion:", tf-t0,"segundos."
@@ -0,0 +1,193 @@
+"""
+Parallel processing of independent plots.
+"""
+import zlib
+import collections
+import multiprocessing
+import numpy as np
+import allometry
+import wood_density as wd
+
+try:
+	from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+	ProcessPoolExecutor = None
+
+
+def plot_seed(seed, plot):
+	"""
+	Seed of the random generator of a plot, derived from a base seed and the plot
+	identifier. It does not depend on the worker or the order of processing, so
+	stochastic results of a plot are reproducible. Returns an int.
+
+	Arguments:
+
+	- seed (int): Base seed of the run.
+
+	- plot: Plot identifier.
+
+	"""
+	return zlib.crc32("{0}:{1}".format(seed, plot).encode('utf-8')) & 0xffffffff
+
+
+def init_worker(rasters = (), densities_file = None, binary = False, sidecar = False):
+	"""
+	Loads the state shared by all plots processed by a worker: rasters are kept
+	in memory (memory mapped from their sidecars if `sidecar`, see
+	`allometry.load_raster`) and the wood density database is parsed and cached
+	(see `wood_density.load_data`).
+
+	Arguments:
+
+	- rasters (list): Raster file paths.
+
+	- densities_file (str): Path to the wood density csv table.
+
+	- binary (bool): Use the binary copy of the wood density table.
+
+	- sidecar (bool): Use raster sidecars, shared by all workers through the
+	page cache instead of a copy of the rasters per worker.
+
+	"""
+	# Raster handles inherited from the parent process are not reused
+	allometry.close_rasters()
+
+	return _load_state(rasters, densities_file, binary, sidecar)
+
+
+def _load_state(rasters = (), densities_file = None, binary = False, sidecar = False):
+	"""
+	Loads the worker state (see `init_worker`) on top of the rasters already
+	open in the current process.
+	"""
+	for raster in rasters:
+		allometry.load_raster(raster, sidecar)
+
+	if densities_file:
+		wd.load_data(densities_file, binary)
+
+	return None
+
+
+def _call(args):
+	"""
+	Processes one plot in a worker.
+	"""
+	function, plot, data, seed = args
+	random_state = None
+	if seed is not None:
+		random_state = np.random.RandomState(seed)
+
+	return function(plot, data, random_state)
+
+
+def _bounded(submit, get, tasks, pending):
+	"""
+	Submits tasks keeping at most `pending` of them not yet yielded, and yields
+	their results in order.
+
+	Arguments:
+
+	- submit (callable): Submits a task, returns its future.
+
+	- get (callable): Waits for a future and returns its result.
+
+	- tasks (iterable): Tasks.
+
+	- pending (int): Maximum number of submitted tasks not yet yielded.
+
+	"""
+	futures = collections.deque()
+
+	for task in tasks:
+		futures.append(submit(task))
+		if len(futures) >= pending:
+			yield get(futures.popleft())
+
+	while futures:
+		yield get(futures.popleft())
+
+
+def imap_plots(function, plots, workers = None, rasters = (), densities_file = None,
+	binary = False, sidecar = False, seed = None, chunk_size = 1, pending = None):
+	"""
+	Processes plots in parallel, yielding the results in the same order as the
+	plots. Each worker process loads the rasters and wood density database once
+	(see `init_worker`).
+
+	Arguments:
+
+	- function (callable): Function processing a plot, called as
+	function(plot, data, random_state), where `random_state` is a
+	np.random.RandomState seeded by `plot_seed` (None if `seed` is None). It has
+	to be defined at the top level of a module.
+
+	- plots (iterable): (plot identifier, data) tuples, as produced by
+	db_utils.iter_plots.
+
+	- workers (int): Number of worker processes. Default is the number of cpus.
+	With 1 plots are processed in the calling process, keeping its open rasters.
+
+	- rasters, densities_file, binary, sidecar: Worker state, see `init_worker`.
+
+	- seed (int): Base seed of stochastic computations.
+
+	- chunk_size (int): Plots sent to a worker at once.
+
+	- pending (int): Maximum number of plots submitted and not yet yielded, which
+	bounds the memory held by results waiting for earlier plots. Plots are then
+	sent one at a time (`chunk_size` is ignored). Default is no limit, all plots
+	are queued at once.
+
+	"""
+	tasks = ((function, plot, data, None if seed is None else plot_seed(seed, plot))
+		for plot, data in plots)
+	initargs = (tuple(rasters), densities_file, binary, sidecar)
+
+	if workers is None:
+		workers = multiprocessing.cpu_count()
+
+	if workers == 1:
+		_load_state(*initargs)
+		for task in tasks:
+			yield _call(task)
+		return
+
+	if ProcessPoolExecutor is not None:
+		try:
+			executor = ProcessPoolExecutor(max_workers = workers, initializer = init_worker,
+				initargs = initargs)
+		except TypeError: # No initializer before python 3.7
+			executor = None
+
+		if executor is not None:
+			with executor:
+				if pending is None:
+					results = executor.map(_call, tasks, chunksize = chunk_size)
+				else:
+					results = _bounded(lambda task: executor.submit(_call, task),
+						lambda future: future.result(), tasks, pending)
+				for result in results:
+					yield result
+			return
+
+	pool = multiprocessing.Pool(workers, init_worker, initargs)
+	try:
+		if pending is None:
+			results = pool.imap(_call, tasks, chunk_size)
+		else:
+			results = _bounded(lambda task: pool.apply_async(_call, (task,)),
+				lambda future: future.get(), tasks, pending)
+		for result in results:
+			yield result
+	finally:
+		pool.close()
+		pool.join()
+
+
+def map_plots(function, plots, **kwargs):
+	"""
+	Processes plots in parallel (see `imap_plots`). Returns the list of results,
+	in the same order as the plots.
+	"""
+	return list(imap_plots(function, plots, **kwargs))
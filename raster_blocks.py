@@ -0,0 +1,438 @@
+"""
+Block-wise processing of national rasters: forest masks and climatic rasters
+are read in windows aligned with the raster blocks, so whole maps are processed
+in bounded memory.
+"""
+import multiprocessing
+import numpy as np
+import allometry
+import parallel
+
+if allometry.raster_api == "gdal":
+	import gdal
+
+elif allometry.raster_api == "rasterio":
+	import rasterio
+
+# Values of forest and non-forest pixels in the forest masks. Other values
+# (e.g., 3, no information, or nodata) have unknown forest state.
+forest_value = 1
+nonforest_value = 2
+
+# Default size (columns, rows) of the processing tiles. Tiles are rounded up to
+# whole raster blocks.
+tile_size = (1024, 256)
+
+# Carbon fraction of the biomass
+carbon_fraction = 0.5
+
+
+def block_windows(handle, size = None):
+	"""
+	Windows covering a raster, aligned with its native blocks. Yields
+	(column, row, columns, rows) tuples.
+
+	Arguments:
+
+	- handle (allometry.RasterHandle): Raster.
+
+	- size (tuple): Approximate window size (columns, rows), rounded up to whole
+	blocks. Default is `tile_size`.
+
+	"""
+	if size is None:
+		size = tile_size
+
+	bx, by = handle.block_size
+	wx = min(max(bx, -(-size[0] // bx) * bx), handle.xsize)
+	wy = min(max(by, -(-size[1] // by) * by), handle.ysize)
+
+	for py in range(0, handle.ysize, wy):
+		for px in range(0, handle.xsize, wx):
+			yield px, py, min(wx, handle.xsize - px), min(wy, handle.ysize - py)
+
+
+def resample_nearest(handle, transform, window, mask = None):
+	"""
+	Values of a raster at the pixels of a window of another grid, taken at the
+	upper left corner of each pixel of the grid. Source blocks are read only
+	once per window. Pixels out of the source raster are NaN.
+
+	Arguments:
+
+	- handle (allometry.RasterHandle): Source raster.
+
+	- transform (tuple): Geotransform of the target grid, GDAL coefficient
+	order.
+
+	- window (tuple): Target window (column, row, columns, rows).
+
+	- mask (np.ndarray): Boolean array with the shape of the window. If given,
+	only pixels in the mask are sampled, the others are NaN.
+
+	"""
+	px, py, xsize, ysize = window
+	lon = (np.arange(px, px + xsize) * transform[1] + transform[0])[np.newaxis, :]
+	lat = (np.arange(py, py + ysize) * transform[5] + transform[3])[:, np.newaxis]
+
+	cols = np.floor((lon - handle.transform[0]) / handle.transform[1]).astype(int)
+	rows = np.floor((lat - handle.transform[3]) / handle.transform[5]).astype(int)
+	cols, rows = np.broadcast_arrays(cols, rows)
+
+	if mask is None:
+		return handle.sample(cols.ravel(), rows.ravel()).reshape(ysize, xsize)
+
+	out = np.full((ysize, xsize), np.nan)
+	out[mask] = handle.sample(cols[mask], rows[mask])
+
+	return out
+
+
+def classify_window(altitude_handle, precipitation_handle, window):
+	"""
+	Climatic classification of a window of the altitude and precipitation
+	rasters (which share the same grid). Returns three arrays: Holdridge life
+	zone codes, Chave forest type codes (see `allometry.holdridge_codes` and
+	`allometry.chave_forest_codes`) and valid pixels (forest life zones with
+	altitude and precipitation values).
+	"""
+	alt = np.asarray(altitude_handle.read(*window), dtype = float)
+	prec = np.asarray(precipitation_handle.read(*window), dtype = float)
+
+	holdr, _ = allometry.holdridge_codes(alt, prec)
+	chave, _ = allometry.chave_forest_codes(prec)
+	with np.errstate(invalid = 'ignore'):
+		valid = (alt >= 0) & (prec > 0) & (holdr > 0)
+
+	return holdr, chave, valid
+
+
+def class_table(system, class_values, fill = np.nan):
+	"""
+	Lookup array of a value per class code of a classification system.
+
+	Arguments:
+
+	- system (str): `holdridge` or `chave`.
+
+	- class_values (dict): Value of each class (class name: value). Absent
+	classes get `fill`.
+
+	"""
+	if system == 'holdridge':
+		classes = allometry.holdridge_classes
+	elif system == 'chave':
+		classes = allometry.chave_classes
+	else:
+		raise ValueError("Unknown classification system {0}.".format(system))
+
+	out = np.full(max(classes) + 1, fill, dtype = float)
+	for code, name in classes.items():
+		if name in class_values:
+			out[code] = class_values[name]
+
+	return out
+
+
+class GeoTiffWriter(object):
+	"""
+	Single band GeoTIFF file written window by window, with the grid (and
+	projection, if available) of a reference raster.
+
+	Arguments:
+
+	- path (str): Output file path.
+
+	- reference (allometry.RasterHandle): Raster defining the grid.
+
+	- nodata (float): Nodata value.
+
+	- block_size (tuple): Columns and rows of the output tiles.
+
+	"""
+	def __init__(self, path, reference, nodata = -9999.0, block_size = (256, 256)):
+
+		self.path = path
+		self.nodata = nodata
+		self.dataset = None
+		self.band = None
+		options = ['TILED=YES', 'COMPRESS=LZW',
+			'BLOCKXSIZE={0}'.format(block_size[0]), 'BLOCKYSIZE={0}'.format(block_size[1])]
+
+		if allometry.raster_api == "gdal":
+			driver = gdal.GetDriverByName('GTiff')
+			self.dataset = driver.Create(path, reference.xsize, reference.ysize, 1,
+				gdal.GDT_Float32, options)
+			self.dataset.SetGeoTransform(reference.transform)
+			if reference.dataset is not None:
+				self.dataset.SetProjection(reference.dataset.GetProjection())
+			self.band = self.dataset.GetRasterBand(1)
+			self.band.SetNoDataValue(nodata)
+
+		elif allometry.raster_api == "rasterio":
+			crs = None
+			if reference.dataset is not None:
+				crs = reference.dataset.crs
+			self.dataset = rasterio.open(path, 'w', driver = 'GTiff', width = reference.xsize,
+				height = reference.ysize, count = 1, dtype = 'float32', nodata = nodata, crs = crs,
+				transform = rasterio.Affine.from_gdal(*reference.transform), tiled = True,
+				blockxsize = block_size[0], blockysize = block_size[1], compress = 'lzw')
+
+		else:
+			raise ValueError("Raster {0} could not be written: no SIG library found.".format(path))
+
+
+	def write(self, array, px, py):
+		"""
+		Writes a window, with upper left pixel (px, py).
+		"""
+		array = np.where(np.isnan(array), self.nodata, array).astype(np.float32)
+
+		if allometry.raster_api == "gdal":
+			self.band.WriteArray(array, px, py)
+		else:
+			self.dataset.write(array, 1, window = ((py, py + array.shape[0]),
+				(px, px + array.shape[1])))
+
+		return None
+
+
+	def close(self):
+		if allometry.raster_api == "gdal":
+			self.band.FlushCache()
+		elif self.dataset is not None:
+			self.dataset.close()
+		self.band = None
+		self.dataset = None
+
+		return None
+
+
+def _carbon_tile(window, args, random_state = None):
+	"""
+	Carbon density of a tile. Rasters are opened through the raster pool of the
+	worker process.
+	"""
+	altitude_file, precipitation_file, forest_file, system, table = args
+	alt = allometry.open_raster(altitude_file)
+	prec = allometry.open_raster(precipitation_file)
+	forest = allometry.open_raster(forest_file)
+
+	holdr, chave, valid = classify_window(alt, prec, window)
+	valid &= resample_nearest(forest, alt.transform, window, valid) == forest_value
+	codes = holdr if system == 'holdridge' else chave
+
+	return window, np.where(valid, table[codes], np.nan)
+
+
+def carbon_map(out_file, altitude_file, precipitation_file, forest_file, class_biomass,
+	system = 'holdridge', size = None, workers = None, nodata = -9999.0):
+	"""
+	Writes a carbon density map (GeoTIFF) on the grid of the climatic rasters.
+	Forest pixels are classified with the Holdridge or Chave rules and get the
+	carbon (`carbon_fraction`) of the biomass density of their class; other
+	pixels are nodata. Tiles aligned with the raster blocks are processed in
+	parallel and written as soon as they are ready; at most two tiles per
+	worker are in flight, so memory use does not depend on the size of the map.
+
+	Arguments:
+
+	- out_file (str): Output GeoTIFF path.
+
+	- altitude_file, precipitation_file (str): Climatic rasters (same grid).
+
+	- forest_file (str): Forest mask raster (forest pixels equal to
+	`forest_value`), sampled at the upper left corner of the climatic pixels.
+
+	- class_biomass (dict): Biomass density of each class (class name: biomass),
+	e.g., the mean of the plots of the class. Output units are those of the
+	biomass densities.
+
+	- system (str): Classification system, `holdridge` or `chave`.
+
+	- size (tuple): Approximate tile size (columns, rows), see `block_windows`.
+
+	- workers (int): Number of worker processes, see `parallel.imap_plots`.
+
+	- nodata (float): Nodata value of the output.
+
+	"""
+	table = carbon_fraction * class_table(system, class_biomass)
+	reference = allometry.open_raster(altitude_file)
+	writer = GeoTiffWriter(out_file, reference, nodata)
+	args = (altitude_file, precipitation_file, forest_file, system, table)
+
+	if workers is None:
+		workers = multiprocessing.cpu_count()
+
+	try:
+		tiles = ((window, args) for window in block_windows(reference, size))
+		for window, carbon in parallel.imap_plots(_carbon_tile, tiles, workers = workers,
+			pending = 2 * workers):
+			writer.write(carbon, window[0], window[1])
+	finally:
+		writer.close()
+
+	return None
+
+
+def _class_shape():
+	"""
+	Number of Holdridge and Chave class codes.
+	"""
+	return max(allometry.holdridge_classes) + 1, max(allometry.chave_classes) + 1
+
+
+def _count_tile(window, args, random_state = None):
+	"""
+	Forest pixel counts of a tile for each forest mask, and transition counts
+	between consecutive masks, by (Holdridge, Chave) class combination. Returns
+	a flat array: counts of every mask followed by the transitions.
+	"""
+	altitude_file, precipitation_file, forest_files = args
+	alt = allometry.open_raster(altitude_file)
+	prec = allometry.open_raster(precipitation_file)
+
+	holdr, chave, valid = classify_window(alt, prec, window)
+	n_holdr, n_chave = _class_shape()
+	codes = holdr[valid] * n_chave + chave[valid]
+	size = n_holdr * n_chave
+
+	# Forest mask values at the valid pixels
+	masks = []
+	for forest_file in forest_files:
+		forest = allometry.open_raster(forest_file)
+		masks.append(resample_nearest(forest, alt.transform, window, valid)[valid])
+
+	out = [np.bincount(codes[mask == forest_value], minlength = size) for mask in masks]
+
+	for before, after in zip(masks[:-1], masks[1:]):
+		known = np.isin(before, [forest_value, nonforest_value]) & \
+			np.isin(after, [forest_value, nonforest_value])
+		state = (before[known] == forest_value) * 2 + (after[known] == forest_value)
+		out.append(np.bincount(state * size + codes[known], minlength = 4 * size))
+
+	return np.concatenate(out)
+
+
+def count_years(altitude_file, precipitation_file, forest_files, size = None, workers = None):
+	"""
+	Counts the forest pixels of several forest masks (e.g., yearly maps) and
+	the transitions between consecutive masks, by combination of Holdridge life
+	zone and Chave forest type, in a single pass over the climatic rasters (see
+	`count_classes`).
+
+	Arguments:
+
+	- altitude_file, precipitation_file (str): Climatic rasters (same grid).
+
+	- forest_files (list): Forest mask rasters, in chronological order.
+
+	- size (tuple): Approximate tile size (columns, rows), see `block_windows`.
+
+	- workers (int): Number of worker processes, see `parallel.imap_plots`.
+
+	Returns two integer arrays: forest pixel counts indexed by (mask, Holdridge
+	code, Chave code), and transition counts indexed by (pair of consecutive
+	masks, state in the first mask, state in the second mask, Holdridge code,
+	Chave code), states being 1 for forest and 0 for non-forest. Transitions
+	only include pixels that are forest (`forest_value`) or non-forest
+	(`nonforest_value`) in both masks.
+
+	"""
+	forest_files = list(forest_files)
+	reference = allometry.open_raster(altitude_file)
+	args = (altitude_file, precipitation_file, forest_files)
+	tiles = ((window, args) for window in block_windows(reference, size))
+
+	counts = 0
+	for tile in parallel.imap_plots(_count_tile, tiles, workers = workers):
+		counts = counts + tile
+
+	n_holdr, n_chave = _class_shape()
+	split = len(forest_files) * n_holdr * n_chave
+	years = np.reshape(counts[:split], (len(forest_files), n_holdr, n_chave))
+	transitions = np.reshape(counts[split:], (max(len(forest_files) - 1, 0), 2, 2,
+		n_holdr, n_chave))
+
+	return years, transitions
+
+
+def count_classes(altitude_file, precipitation_file, forest_file, size = None, workers = None):
+	"""
+	Counts the forest pixels of every combination of Holdridge life zone and
+	Chave forest type, on the grid of the climatic rasters (see `carbon_map`).
+	Tiles aligned with the raster blocks are counted in parallel. Returns an
+	integer array indexed by (Holdridge code, Chave code).
+
+	Arguments:
+
+	- altitude_file, precipitation_file (str): Climatic rasters (same grid).
+
+	- forest_file (str): Forest mask raster.
+
+	- size (tuple): Approximate tile size (columns, rows), see `block_windows`.
+
+	- workers (int): Number of worker processes, see `parallel.imap_plots`.
+
+	"""
+	years, _ = count_years(altitude_file, precipitation_file, [forest_file], size, workers)
+
+	return years[0]
+
+
+def count_dict(counts):
+	"""
+	Pixel counts by class of each classification system, as stored by
+	`gis_rout.py`: {'holdrigde': {life zone: count}, 'chaveI': {forest type:
+	count}}. Only classes with pixels are included.
+
+	Arguments:
+
+	- counts (np.ndarray): Counts by (Holdridge code, Chave code), see
+	`count_classes`.
+
+	"""
+	out = {'holdrigde': {}, 'chaveI': {}}
+
+	for code, count in enumerate(counts.sum(axis = 1)):
+		if count > 0:
+			out['holdrigde'][allometry.holdridge_classes[code]] = int(count)
+
+	for code, count in enumerate(counts.sum(axis = 0)):
+		if count > 0:
+			out['chaveI'][allometry.chave_classes[code]] = int(count)
+
+	return out
+
+
+# Names of the transitions between forest states (first mask, second mask)
+transition_names = {(1, 1): 'forest', (1, 0): 'forest_loss', (0, 1): 'forest_gain',
+	(0, 0): 'non_forest'}
+
+
+def transition_dict(transitions):
+	"""
+	Transition counts between two forest masks by class of each classification
+	system: {'holdrigde': {life zone: {transition: count}}, 'chaveI': {forest
+	type: {transition: count}}}, transitions named as in `transition_names`.
+	Only classes with pixels are included.
+
+	Arguments:
+
+	- transitions (np.ndarray): Transition counts of a pair of masks, indexed
+	by (first state, second state, Holdridge code, Chave code), see
+	`count_years`.
+
+	"""
+	out = {'holdrigde': {}, 'chaveI': {}}
+	systems = [('holdrigde', allometry.holdridge_classes, transitions.sum(axis = 3)),
+		('chaveI', allometry.chave_classes, transitions.sum(axis = 2))]
+
+	for syst, classes, counts in systems:
+		for code in range(counts.shape[2]):
+			if counts[:, :, code].sum() > 0:
+				out[syst][classes[code]] = dict((name, int(counts[state][code]))
+					for state, name in transition_names.items())
+
+	return out
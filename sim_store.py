@@ -0,0 +1,222 @@
+"""
+Storage of simulated distributions of plot variables (e.g., Monte Carlo biomass
+estimates) that grows as plots are processed.
+"""
+import os
+import numpy as np
+
+# Percentiles reported in plot and global summaries
+percentiles = [2.5, 50, 97.5]
+
+# Plot identifier of empty rows
+_empty_id = np.iinfo(np.int64).min
+
+
+class DistributionSink(object):
+	"""
+	Stores the simulated distribution of every plot as a row of a memory mapped
+	.npy file per variable (`root`_`variable`.npy), written to disk as soon as
+	the plot is added, so a run can be resumed after a failure. Plot identifiers
+	are stored in `root`_plots.npy and per plot summaries (mean, standard
+	deviation and percentiles) in `root`_`variable`_summary.npy. Running global
+	moments and a fixed size random sample (reservoir) of the simulated values of
+	all plots are kept for the global summary.
+
+	Arguments:
+
+	- root (str): Root of the output file names.
+
+	- variables (list): Names of the simulated variables.
+
+	- path_sims (int): Simulations per plot.
+
+	- capacity (int): Maximum number of plots.
+
+	- resume (bool): Keep the plots stored by a previous run with the same root.
+	Otherwise existing files are overwritten.
+
+	- sketch_size (int): Size of the random sample employed to estimate global
+	percentiles.
+
+	- seed (int): Seed of the reservoir sampling.
+
+	"""
+	def __init__(self, root, variables, path_sims, capacity, resume = True,
+		sketch_size = 100000, seed = 0):
+
+		self.root = root
+		self.variables = list(variables)
+		self.path_sims = path_sims
+		self.capacity = capacity
+		self.sketch_size = sketch_size
+		self._rs = np.random.RandomState(seed)
+
+		self.plots = self._open('plots', (capacity,), np.int64, _empty_id, resume)
+		self.rows = {}
+		self.summaries = {}
+		for var in self.variables:
+			self.rows[var] = self._open(var, (capacity, path_sims), float, 0.0, resume)
+			self.summaries[var] = self._open(var + '_summary', (capacity, 2 + len(percentiles)),
+				float, np.nan, resume)
+
+		# Rows are written before their plot id, so the stored plots are those
+		# previous to the first empty id
+		empty = np.nonzero(self.plots == _empty_id)[0]
+		self.count = empty[0] if empty.shape[0] else capacity
+		self.done = set(self.plots[:self.count].tolist())
+
+		self.n = {}
+		self.mean = {}
+		self._m2 = {}
+		self.sketch = {}
+		self._seen = {}
+		for var in self.variables:
+			self.n[var] = 0
+			self.mean[var] = 0.0
+			self._m2[var] = 0.0
+			self.sketch[var] = np.empty(sketch_size)
+			self._seen[var] = 0
+			for start in range(0, self.count, 1000):
+				for row in self.rows[var][start:min(start + 1000, self.count)]:
+					self._update(var, row)
+
+
+	def _path(self, name):
+		return "{0}_{1}.npy".format(self.root, name)
+
+
+	def _open(self, name, shape, dtype, fill, resume):
+		"""
+		Opens (or creates) a memory mapped .npy file with `shape` rows, growing
+		the file of a previous run if needed.
+		"""
+		path = self._path(name)
+
+		if resume and os.path.exists(path):
+			mm = np.lib.format.open_memmap(path, mode = 'r+')
+			if mm.shape[1:] != shape[1:] or mm.dtype != np.dtype(dtype):
+				raise ValueError("File {0} does not match the sink dimensions.".format(path))
+
+			if mm.shape[0] < shape[0]:
+				tmp = path + '.tmp'
+				new = np.lib.format.open_memmap(tmp, mode = 'w+', dtype = dtype, shape = shape)
+				new[mm.shape[0]:] = fill
+				for start in range(0, mm.shape[0], 1000):
+					stop = min(start + 1000, mm.shape[0])
+					new[start:stop] = mm[start:stop]
+				new.flush()
+				del mm, new
+				os.rename(tmp, path)
+				mm = np.lib.format.open_memmap(path, mode = 'r+')
+
+		else:
+			mm = np.lib.format.open_memmap(path, mode = 'w+', dtype = dtype, shape = shape)
+			mm[:] = fill
+
+		return mm
+
+
+	def _update(self, var, values):
+		"""
+		Adds simulated values to the running moments (Chan et al. parallel
+		algorithm) and the reservoir sample of a variable.
+		"""
+		values = values[~np.isnan(values)]
+		m = values.shape[0]
+		if m == 0:
+			return None
+
+		n = self.n[var]
+		delta = values.mean() - self.mean[var]
+		self.mean[var] += delta * m / float(n + m)
+		self._m2[var] += ((values - values.mean()) ** 2).sum() + delta ** 2 * n * m / float(n + m)
+		self.n[var] = n + m
+
+		seen = self._seen[var]
+		free = max(min(self.sketch_size - seen, m), 0)
+		self.sketch[var][seen:seen + free] = values[:free]
+		if free < m:
+			position = seen + np.arange(free, m)
+			slot = (self._rs.random_sample(m - free) * (position + 1)).astype(np.int64)
+			keep = slot < self.sketch_size
+			self.sketch[var][slot[keep]] = values[free:][keep]
+		self._seen[var] = seen + m
+
+		return None
+
+
+	def add(self, plot, values):
+		"""
+		Stores the simulated distributions of a plot.
+
+		Arguments:
+
+		- plot (int): Plot identifier.
+
+		- values (dict): Simulated values (array of `path_sims` elements) of every
+		variable.
+
+		"""
+		if self.count >= self.capacity:
+			raise ValueError("Sink is full ({0} plots).".format(self.capacity))
+
+		for var in self.variables:
+			row = np.asarray(values[var], dtype = float)
+			self.rows[var][self.count] = row
+			self.summaries[var][self.count] = np.concatenate([[np.nanmean(row),
+				np.nanstd(row)], np.nanpercentile(row, percentiles)])
+			self.rows[var].flush()
+			self.summaries[var].flush()
+			self._update(var, row)
+
+		self.plots[self.count] = plot
+		self.plots.flush()
+		self.done.add(plot)
+		self.count += 1
+
+		return None
+
+
+	def summary(self, var):
+		"""
+		Global summary of a variable over the simulated values of all plots.
+		Returns a dict with the number of values (`n`), `mean`, standard deviation
+		(`sd`) and the percentiles (estimated from the reservoir sample).
+		"""
+		out = {'n': self.n[var], 'mean': np.nan, 'sd': np.nan}
+		if self.n[var] > 0:
+			out['mean'] = self.mean[var]
+			out['sd'] = np.sqrt(self._m2[var] / self.n[var])
+			sample = self.sketch[var][:min(self._seen[var], self.sketch_size)]
+			out.update(zip(percentiles, np.percentile(sample, percentiles)))
+
+		return out
+
+
+	def close(self, trim = True):
+		"""
+		Flushes all files. If `trim`, files are cut to the stored plots.
+		"""
+		names = ['plots'] + self.variables + [v + '_summary' for v in self.variables]
+		arrays = [self.plots] + [self.rows[v] for v in self.variables] + \
+			[self.summaries[v] for v in self.variables]
+
+		for name, mm in zip(names, arrays):
+			mm.flush()
+			if trim and mm.shape[0] > self.count:
+				path = self._path(name)
+				tmp = path + '.tmp'
+				new = np.lib.format.open_memmap(tmp, mode = 'w+', dtype = mm.dtype,
+					shape = (self.count,) + mm.shape[1:])
+				for start in range(0, self.count, 1000):
+					stop = min(start + 1000, self.count)
+					new[start:stop] = mm[start:stop]
+				new.flush()
+				del new
+				os.rename(tmp, path)
+
+		self.plots = None
+		self.rows = {}
+		self.summaries = {}
+
+		return None
@@ -1,24 +1,144 @@
 """
 Wood density functions.
 """
+import os
+import numpy as np
 from math import log, exp
-from pandas import isna, notna
+from pandas import isna, notna, DataFrame
 
+# Parsed databases: (path, modification time) -> DensityIndex
+_cache = {}
+
+
+class DensityIndex(dict):
+	"""
+	Wood density database as loaded by wood_density.load_data. Behaves as the
+	2-dimensional dictionary of wood density values (dict[Family][Genus][Epithet]
+	= list of values) and holds precomputed means and record counts of every
+	species, genus and family:
+
+	- species (dict): (family, genus, epithet) -> (mean, count)
+
+	- genera (dict): (family, genus) -> (mean, count)
+
+	- families (dict): family -> (mean, count)
+
+	Genus and family means are weighted by the number of records of each species.
+
+	Arguments:
+
+	- data (dict): Nested dictionary of wood density values.
 
-def load_data(csv_file):
+	"""
+	def __init__(self, data = None):
+		super(DensityIndex, self).__init__(data or {})
+		self.compile()
+
+
+	def compile(self):
+		"""
+		Computes species, genus and family means and counts.
+		"""
+		self.species = {}
+		self.genera = {}
+		self.families = {}
+
+		for family in self:
+			fam_sum = 0.0
+			fam_count = 0
+			for genus in self[family]:
+				gen_sum = 0.0
+				gen_count = 0
+				for epithet in self[family][genus]:
+					values = self[family][genus][epithet]
+					gen_sum += sum(values)
+					gen_count += len(values)
+					fam_sum += sum(values)
+					fam_count += len(values)
+					if epithet is not None and len(values) >= 1:
+						self.species[(family, genus, epithet)] = (sum(values) / len(values), len(values))
+				if gen_count:
+					self.genera[(family, genus)] = (gen_sum / gen_count, gen_count)
+			if fam_count:
+				self.families[family] = (fam_sum / fam_count, fam_count)
+
+		return None
+
+
+	def tables(self):
+		"""
+		Species, genus and family means as pd.DataFrames (columns `Family`,
+		`Genus`, `Epithet` and `Density`).
+		"""
+		spp = DataFrame([k + (v[0],) for k, v in self.species.items()],
+			columns = ['Family', 'Genus', 'Epithet', 'Density'])
+		gen = DataFrame([k + (v[0],) for k, v in self.genera.items()],
+			columns = ['Family', 'Genus', 'Density'])
+		fam = DataFrame([(k, v[0]) for k, v in self.families.items()],
+			columns = ['Family', 'Density'])
+
+		return spp, gen, fam
+
+
+def load_data(csv_file, binary = False):
 	"""
 	Loads wood density values from a csv table. Columns in the file should follow
 	the order presented by Chave et al. in the Global Wood Density Database
 	(http://datadryad.org/handle/10255/dryad.235): index, family, species name,
-	wood density, region, and reference number. Returns a 2-dimensional
-	dictionary (dict[Family][Species] = list of wood density values).
+	wood density, region, and reference number. Returns a wood_density.DensityIndex,
+	a 2-dimensional dictionary (dict[Family][Species] = list of wood density values)
+	with precomputed species, genus and family means.
+
+	Parsed databases are cached for the life of the process (by path and
+	modification time), so the returned object is shared among callers and
+	should not be modified.
 
 	Arguments:
 
 	- csv_file (str): Path to the woo density data file.
 
+	- binary (bool): Read the database from a compact binary copy (`csv_file`.npz),
+	which is created if missing or older than the csv file.
+
 	"""
-	out = {}
+	key = (os.path.abspath(csv_file), os.path.getmtime(csv_file))
+
+	if key not in _cache:
+		npz_file = csv_file + '.npz'
+
+		if binary and os.path.exists(npz_file) and \
+			os.path.getmtime(npz_file) >= os.path.getmtime(csv_file):
+			records = _read_binary(npz_file)
+
+		else:
+			records = _parse(csv_file)
+			if binary:
+				_write_binary(records, npz_file)
+
+		# Entries of previous versions of the file are dropped
+		for old in [k for k in _cache if k[0] == key[0]]:
+			del _cache[old]
+
+		_cache[key] = _build(records)
+
+	return _cache[key]
+
+
+def clear_cache():
+	"""
+	Drops all wood density databases cached by wood_density.load_data.
+	"""
+	_cache.clear()
+
+	return None
+
+
+def _parse(csv_file):
+	"""
+	Parses a Global Wood Density Database csv table. Returns a list of tuples
+	(family, genus, epithet, wood density) in file order.
+	"""
+	out = []
 	with open(csv_file,"r") as fh:
 		for ir, row in enumerate(fh):
 			if ir > 0:
@@ -35,17 +155,64 @@ def load_data(csv_file):
 					elif len(tidbits) == 3 and tidbits[1].upper() == "X":
 						genus = tidbits[0].title()
 						epitet = tidbits[2].lower()
-					if family not in out:
-						out[family] = {genus: { epitet: [float(bits[3])]}}
-					elif genus not in out[family]:
-						out[family][genus] = {epitet: [float(bits[3])]}
-					elif epitet not in out[family][genus]:
-						out[family][genus][epitet] = [float(bits[3])]
-					else:
-						out[family][genus][epitet].append(float(bits[3]))
+					out.append((family, genus, epitet, float(bits[3])))
 	return out
 
 
+def _build(records):
+	"""
+	Builds a wood_density.DensityIndex from a list of records (family, genus,
+	epithet, wood density).
+	"""
+	out = {}
+	for family, genus, epitet, value in records:
+		if family not in out:
+			out[family] = {genus: { epitet: [value]}}
+		elif genus not in out[family]:
+			out[family][genus] = {epitet: [value]}
+		elif epitet not in out[family][genus]:
+			out[family][genus][epitet] = [value]
+		else:
+			out[family][genus][epitet].append(value)
+	return DensityIndex(out)
+
+
+def _write_binary(records, npz_file):
+	"""
+	Saves wood density records as a npz file of categorical codes: `families`,
+	`genera` and `epithets` hold the category names and `family`, `genus` and
+	`epithet` the code of each record (-1 for missing epithets).
+	"""
+	arrays = {}
+	for i, (names, codes) in enumerate([('families', 'family'), ('genera', 'genus'),
+		('epithets', 'epithet')]):
+		column = [r[i] for r in records]
+		cats = sorted(set(c for c in column if c is not None))
+		lookup = {c: j for j, c in enumerate(cats)}
+		arrays[names] = np.array(cats)
+		arrays[codes] = np.array([lookup.get(c, -1) for c in column], dtype = np.int32)
+	arrays['density'] = np.array([r[3] for r in records], dtype = float)
+
+	with open(npz_file, 'wb') as fh:
+		np.savez(fh, **arrays)
+
+	return None
+
+
+def _read_binary(npz_file):
+	"""
+	Reads wood density records saved by wood_density._write_binary.
+	"""
+	with np.load(npz_file) as data:
+		families = data['families'].tolist()
+		genera = data['genera'].tolist()
+		epithets = data['epithets'].tolist() + [None]
+		codes = list(zip(data['family'].tolist(), data['genus'].tolist(),
+			data['epithet'].tolist(), data['density'].tolist()))
+
+	return [(families[f], genera[g], epithets[e], d) for f, g, e, d in codes]
+
+
 def get_density(family, genus, epithet, wd_data):
 	"""
 	Retrieves wood density of a taxon from a wood density database object. If
@@ -64,6 +231,9 @@ def get_density(family, genus, epithet, wd_data):
 	wood_density.load_data.
 
 	"""
+	if not isinstance(wd_data, DensityIndex):
+		wd_data = DensityIndex(wd_data)
+
 	out = None
 	if notna(family):
 		family = family.title()
@@ -72,28 +242,49 @@ def get_density(family, genus, epithet, wd_data):
 	if notna(epithet):
 		epithet = epithet.lower()
 
-	if notna(family) and family in wd_data:
-		out = 0.0
-		if notna(genus) and genus in wd_data[family]:
-			if notna(epithet) and epithet in wd_data[family][genus]:
-				if len(wd_data[family][genus][epithet]) >= 1:
-					out = sum(wd_data[family][genus][epithet])
-					out /= len(wd_data[family][genus][epithet])
-				else:
-					print "{0} {1} included in the wood density DB but no values associated.".format(genus, epitet)
+	if notna(family) and family in wd_data.families:
+		if notna(genus) and (family, genus) in wd_data.genera:
+			if notna(epithet) and (family, genus, epithet) in wd_data.species:
+				out = wd_data.species[(family, genus, epithet)][0]
 			else:
-				spp_count = 0
-				for other_sp in wd_data[family][genus]:
-					out += sum(wd_data[family][genus][other_sp])
-					spp_count += len(wd_data[family][genus][other_sp])
-				out /= spp_count
+				out = wd_data.genera[(family, genus)][0]
 		else:
-			spp_count = 0
-			for other_gen in wd_data[family]:
-				for other_sp in wd_data[family][other_gen]:
-					out += sum(wd_data[family][other_gen][other_sp])
-					spp_count += len(wd_data[family][other_gen][other_sp])
-			out /= spp_count
+			out = wd_data.families[family][0]
+
+	return out
+
+
+def get_densities(taxa, wd_data):
+	"""
+	Retrieves wood density of all taxa in a table, following the same rules of
+	wood_density.get_density. Returns a pd.Series aligned with the table (NaN
+	for families absent in the DB).
+
+	Arguments:
+
+	- taxa (pd.DataFrame): Table with columns `Family`, `Genus` and `Epithet`.
+
+	- wd_data (dict): Data base with wood density values as loaded by function
+	wood_density.load_data.
+
+	"""
+	if not isinstance(wd_data, DensityIndex):
+		wd_data = DensityIndex(wd_data)
+
+	spp, gen, fam = wd_data.tables()
+
+	keys = DataFrame({'Family': taxa.Family.astype(object).str.title().values,
+		'Genus': taxa.Genus.astype(object).str.title().values,
+		'Epithet': taxa.Epithet.astype(object).str.lower().values})
+
+	# Taxa without family or genus are matched at the upper levels only
+	keys.loc[keys.Family.isna(), ['Genus', 'Epithet']] = None
+	keys.loc[keys.Genus.isna(), 'Epithet'] = None
+
+	out = keys.merge(spp, how = 'left', on = ['Family', 'Genus', 'Epithet'])['Density']
+	out = out.fillna(keys.merge(gen, how = 'left', on = ['Family', 'Genus'])['Density'])
+	out = out.fillna(keys.merge(fam, how = 'left', on = 'Family')['Density'])
+	out.index = taxa.index
 
 	return out
 